@@ -0,0 +1,97 @@
+"""
+    Copyright 2019 Ipregistry (https://ipregistry.co).
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       https://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# Replay a lookup trace against InMemoryCache, backed by an LRU TTLCache, and
+# TinyLfuCache, and report their hit ratios. Each lookup reads the cache and
+# stores the entry on a miss, as clients do. The default synthetic trace mixes
+# interactive traffic, drawn from a Zipf distribution over a hot set of IPs,
+# with batch enrichment jobs scanning one-off IPs; a trace file with one key
+# per line can be replayed instead.
+#
+# Usage: python benchmarks/cache_admission.py [--maxsize 2048] [--trace FILE]
+
+import argparse
+import bisect
+import itertools
+import random
+import time
+
+from ipregistry import InMemoryCache, TinyLfuCache
+
+
+def synthetic_trace(lookups, hot_keys, scan_ratio, scan_length, seed=42):
+    """Yield (key, interactive) pairs, with scans in bursts of scan_length keys."""
+    rng = random.Random(seed)
+    weights = list(itertools.accumulate(1 / rank for rank in range(1, hot_keys + 1)))
+    one_off = itertools.count()
+    emitted = 0
+    while emitted < lookups:
+        if rng.random() < scan_ratio / scan_length:
+            for _ in range(min(scan_length, lookups - emitted)):
+                yield 'scan-{}'.format(next(one_off)), False
+                emitted += 1
+        else:
+            rank = bisect.bisect_left(weights, rng.random() * weights[-1])
+            yield 'hot-{}'.format(rank), True
+            emitted += 1
+
+
+def file_trace(path):
+    with open(path) as trace:
+        for line in trace:
+            if line.strip():
+                yield line.strip(), True
+
+
+def replay(name, cache, trace):
+    hits = lookups = interactive_hits = interactive_lookups = 0
+    start = time.perf_counter()
+    for key, interactive in trace:
+        hit = cache.get(key) is not None
+        if not hit:
+            cache.put(key, key)
+        lookups += 1
+        hits += hit
+        if interactive:
+            interactive_lookups += 1
+            interactive_hits += hit
+    elapsed = time.perf_counter() - start
+    print("{:<14} hit ratio {:>6.2%}   interactive hit ratio {:>6.2%}   {:>6.2f}us per lookup".format(
+        name, hits / lookups, interactive_hits / max(interactive_lookups, 1), elapsed / lookups * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cache admission policy trace-replay benchmark')
+    parser.add_argument('--maxsize', type=int, default=2048)
+    parser.add_argument('--lookups', type=int, default=500000)
+    parser.add_argument('--hot-keys', type=int, default=10000, help='distinct keys of interactive traffic')
+    parser.add_argument('--scan-ratio', type=float, default=0.5, help='fraction of lookups made by scans')
+    parser.add_argument('--scan-length', type=int, default=5000, help='one-off keys per scan')
+    parser.add_argument('--trace', help='file with one looked up key per line')
+    args = parser.parse_args()
+
+    def trace():
+        if args.trace:
+            return file_trace(args.trace)
+        return synthetic_trace(args.lookups, args.hot_keys, args.scan_ratio, args.scan_length)
+
+    ttl = 10 ** 9
+    replay('TTLCache (LRU)', InMemoryCache(maxsize=args.maxsize, ttl=ttl), trace())
+    replay('TinyLfuCache', TinyLfuCache(maxsize=args.maxsize, ttl=ttl), trace())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+    Copyright 2019 Ipregistry (https://ipregistry.co).
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       https://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# Compare get/put throughput of InMemoryCache, guarded by one global lock as
+# required to share it safely between threads, with ConcurrentInMemoryCache.
+#
+# Usage: python benchmarks/cache_contention.py [--threads 32] [--operations 20000]
+
+import argparse
+import random
+import threading
+import time
+
+from ipregistry import ConcurrentInMemoryCache, InMemoryCache
+
+
+class GloballyLockedCache:
+    def __init__(self, cache):
+        self._cache = cache
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._cache.get(key)
+
+    def put(self, key, data):
+        with self._lock:
+            self._cache.put(key, data)
+
+
+def run(cache, threads, operations, keys, hit_ratio):
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(seed):
+        rng = random.Random(seed)
+        barrier.wait()
+        for _ in range(operations):
+            key = rng.randrange(keys)
+            if rng.random() < hit_ratio:
+                cache.get(key)
+            else:
+                cache.put(key, key)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='In-memory cache contention benchmark')
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--operations', type=int, default=20000, help='operations per thread')
+    parser.add_argument('--keys', type=int, default=10000)
+    parser.add_argument('--maxsize', type=int, default=4096)
+    parser.add_argument('--segments', type=int, default=16)
+    parser.add_argument('--read-ratio', type=float, default=0.9)
+    args = parser.parse_args()
+
+    candidates = [
+        ('InMemoryCache + global lock', GloballyLockedCache(InMemoryCache(args.maxsize))),
+        ('ConcurrentInMemoryCache', ConcurrentInMemoryCache(args.maxsize, segments=args.segments)),
+    ]
+
+    total = args.threads * args.operations
+    for name, cache in candidates:
+        elapsed = run(cache, args.threads, args.operations, args.keys, args.read_ratio)
+        print("{:<30} {:>8.3f}s {:>12,.0f} ops/s".format(name, elapsed, total / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+    Copyright 2019 Ipregistry (https://ipregistry.co).
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       https://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# Measure cache key construction for 1024-item batches of IPv4 and IPv6
+# addresses. The former string keys concatenated the sorted options to every
+# item; canonical keys pack the address and append a suffix interned once per
+# option set. The average key size is reported as well.
+#
+# Usage: python benchmarks/cache_keys.py [--batches 200]
+
+import argparse
+import random
+import sys
+import time
+
+from ipregistry.core import _build_cache_keys
+
+
+def build_string_keys(items, options):
+    """Former cache key construction, kept as the baseline."""
+    keys = []
+    for item in items:
+        result = item
+        for option_key, value in sorted(options.items()):
+            if isinstance(value, bool):
+                value = 'true' if value is True else 'false'
+            result += ';' + option_key + '=' + str(value)
+        keys.append(result)
+    return keys
+
+
+def build_batch(size, ipv6_ratio):
+    rng = random.Random(42)
+    batch = []
+    for _ in range(size):
+        if rng.random() < ipv6_ratio:
+            batch.append('2a01:{:x}:{:x}::{:x}'.format(rng.getrandbits(16), rng.getrandbits(16), rng.getrandbits(16)))
+        else:
+            batch.append('.'.join(str(rng.randrange(1, 255)) for _ in range(4)))
+    return batch
+
+
+def measure(name, build, batch, options, batches):
+    start = time.perf_counter()
+    for _ in range(batches):
+        keys = build(batch, options)
+    elapsed = (time.perf_counter() - start) / batches
+    size = sum(sys.getsizeof(key) for key in keys) / len(keys)
+    print("{:<12} {:>10.1f}us per batch   {:>6.0f}ns per key   {:>6.1f} bytes per key".format(
+        name, elapsed * 1e6, elapsed / len(batch) * 1e9, size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cache key construction benchmark')
+    parser.add_argument('--batches', type=int, default=200)
+    parser.add_argument('--size', type=int, default=1024, help='items per batch')
+    parser.add_argument('--ipv6-ratio', type=float, default=0.3)
+    args = parser.parse_args()
+
+    batch = build_batch(args.size, args.ipv6_ratio)
+    for options in ({}, {'hostname': True, 'fields': 'location,connection,security'}):
+        print('options: {}'.format(options or 'none'))
+        measure('string', build_string_keys, batch, options, args.batches)
+        measure('canonical', lambda items, opts: _build_cache_keys('ip', items, opts), batch, options, args.batches)
+
+
+if __name__ == '__main__':
+    main()
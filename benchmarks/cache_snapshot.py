@@ -0,0 +1,87 @@
+"""
+    Copyright 2019 Ipregistry (https://ipregistry.co).
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       https://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# Export a snapshot of a cache filled with IpInfo entries and load it into
+# fresh caches, as a new process starting warm would, reporting the snapshot
+# size and the export and load times. Compact caches load entries without
+# decoding them, object caches parse each entry and need several GiB of memory
+# to hold a million of them.
+#
+# Usage: python benchmarks/cache_snapshot.py [--entries 1000000] [--storage compact objects]
+
+import argparse
+import ipaddress
+import os
+import tempfile
+import time
+
+from ipregistry import InMemoryCache, IpInfo
+from ipregistry.core import _build_cache_key
+
+
+def build_entry(index):
+    ip = '8.{}.{}.{}'.format(index >> 16 & 255, index >> 8 & 255, index & 255)
+    return IpInfo.model_validate({
+        'ip': ip,
+        'type': 'IPv4',
+        'company': {'domain': 'google.com', 'name': 'Google LLC', 'type': 'business'},
+        'connection': {'asn': 15169, 'domain': 'google.com', 'organization': 'Google LLC',
+                       'route': '8.8.8.0/24', 'type': 'hosting'},
+        'location': {
+            'continent': {'code': 'NA', 'name': 'North America'},
+            'country': {'code': 'US', 'name': 'United States'},
+            'region': {'code': 'US-CA', 'name': 'California'},
+            'city': 'Mountain View', 'postal': '94043',
+            'latitude': 37.386 + index % 100 / 1000, 'longitude': -122.0838, 'in_eu': False},
+        'security': {'is_cloud_provider': True, 'is_vpn': False, 'is_threat': False},
+        'time_zone': {'id': 'America/Los_Angeles', 'abbreviation': 'PDT', 'offset': -25200},
+    })
+
+
+def measure(name, source, target, path):
+    start = time.perf_counter()
+    exported = source.export_snapshot(path)
+    export_time = time.perf_counter() - start
+    start = time.perf_counter()
+    loaded = target.load_snapshot(path)
+    load_time = time.perf_counter() - start
+    print("{:<10} {:>8} entries   {:>8.2f} MiB   export {:>6.2f}s   load {:>6.2f}s ({:>6.2f}us per entry)".format(
+        name, loaded, os.path.getsize(path) / 2 ** 20, export_time, load_time, load_time / max(exported, 1) * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cache snapshot export and load benchmark')
+    parser.add_argument('--entries', type=int, default=1000000)
+    parser.add_argument('--distinct', type=int, default=1000, help='distinct entries, reused across keys')
+    parser.add_argument('--storage', nargs='+', choices=('compact', 'objects'), default=['compact'],
+                        help='storage of the caches loading the snapshot')
+    args = parser.parse_args()
+
+    entries = [build_entry(index) for index in range(args.distinct)]
+    compact = InMemoryCache(maxsize=args.entries, ttl=3600, compact=True)
+    for index in range(args.entries):
+        ip = str(ipaddress.IPv4Address(0x0A000000 + index))
+        compact.put(_build_cache_key('ip', ip, {}), entries[index % args.distinct].model_copy(update={'ip': ip}))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'snapshot.bin')
+        for storage in args.storage:
+            target = InMemoryCache(maxsize=args.entries, ttl=3600, compact=storage == 'compact')
+            measure(storage, compact, target, path)
+
+
+if __name__ == '__main__':
+    main()
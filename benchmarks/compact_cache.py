@@ -0,0 +1,102 @@
+"""
+    Copyright 2019 Ipregistry (https://ipregistry.co).
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       https://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# Compare the memory used by an InMemoryCache holding full IpInfo entries as
+# objects, as compact serialized bytes and as compressed bytes, along with
+# the latency of cache hits, which decode compact entries.
+#
+# Usage: python benchmarks/compact_cache.py [--entries 20000]
+
+import argparse
+import gc
+import time
+import tracemalloc
+
+from ipregistry import InMemoryCache, IpInfo
+
+
+def build_entry(index):
+    ip = '8.{}.{}.{}'.format(index >> 16 & 255, index >> 8 & 255, index & 255)
+    return IpInfo.model_validate({
+        'ip': ip,
+        'type': 'IPv4',
+        'hostname': 'host-{}.example.net'.format(index),
+        'carrier': {'name': None, 'mcc': None, 'mnc': None},
+        'company': {'domain': 'google.com', 'name': 'Google LLC', 'type': 'business'},
+        'connection': {'asn': 15169, 'domain': 'google.com', 'organization': 'Google LLC',
+                       'route': '8.8.8.0/24', 'type': 'hosting'},
+        'currency': {'code': 'USD', 'name': 'US Dollar', 'name_native': 'US Dollar', 'plural': 'US dollars',
+                     'plural_native': 'US dollars', 'symbol': '$', 'symbol_native': '$',
+                     'format': {'negative': {'prefix': '-$', 'suffix': ''},
+                                'positive': {'prefix': '$', 'suffix': ''}}},
+        'location': {
+            'continent': {'code': 'NA', 'name': 'North America'},
+            'country': {'area': 9629091, 'borders': ['CA', 'MX'], 'calling_code': '1', 'capital': 'Washington D.C.',
+                        'code': 'US', 'name': 'United States', 'population': 327167434,
+                        'population_density': 33.98, 'tld': '.us',
+                        'flag': {'emoji': '🇺🇸', 'emoji_unicode': 'U+1F1FA U+1F1F8',
+                                 'emojitwo': 'https://cdn.ipregistry.co/flags/emojitwo/us.svg',
+                                 'noto': 'https://cdn.ipregistry.co/flags/noto/us.png',
+                                 'twemoji': 'https://cdn.ipregistry.co/flags/twemoji/us.svg',
+                                 'wikimedia': 'https://cdn.ipregistry.co/flags/wikimedia/us.svg'},
+                        'languages': [{'code': 'en', 'name': 'English', 'native': 'English'},
+                                      {'code': 'es', 'name': 'Spanish', 'native': 'Español'}]},
+            'region': {'code': 'US-CA', 'name': 'California'},
+            'city': 'Mountain View', 'postal': '94043',
+            'latitude': 37.386 + index % 100 / 1000, 'longitude': -122.0838,
+            'language': {'code': 'en', 'name': 'English', 'native': 'English'},
+            'in_eu': False},
+        'security': {'is_abuser': False, 'is_attacker': False, 'is_bogon': False, 'is_cloud_provider': True,
+                     'is_proxy': False, 'is_relay': False, 'is_tor': False, 'is_tor_exit': False,
+                     'is_vpn': False, 'is_anonymous': False, 'is_threat': False},
+        'time_zone': {'id': 'America/Los_Angeles', 'abbreviation': 'PDT', 'current_time': '2026-07-09T10:00:00-07:00',
+                      'name': 'Pacific Daylight Time', 'offset': -25200, 'in_daylight_saving': True},
+    })
+
+
+def measure(name, cache, keys, lookups):
+    # Entries are built while tracing, so that the memory still in use once
+    # they are cached is what the cache retains.
+    gc.collect()
+    tracemalloc.start()
+    for index, key in enumerate(keys):
+        cache.put(key, build_entry(index))
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for i in range(lookups):
+        cache.get(keys[i % len(keys)])
+    elapsed = (time.perf_counter() - start) / lookups
+    print("{:<10} {:>8.2f} MiB   {:>7.0f} bytes per entry   {:>7.2f}us per hit".format(
+        name, used / 2 ** 20, used / len(keys), elapsed * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compact cache storage benchmark')
+    parser.add_argument('--entries', type=int, default=20000)
+    parser.add_argument('--lookups', type=int, default=20000)
+    args = parser.parse_args()
+
+    keys = [str(i).encode('ascii') for i in range(args.entries)]
+    measure('objects', InMemoryCache(maxsize=args.entries), keys, args.lookups)
+    measure('compact', InMemoryCache(maxsize=args.entries, compact=True), keys, args.lookups)
+    measure('compressed', InMemoryCache(maxsize=args.entries, compact=True, compress=True), keys, args.lookups)
+
+
+if __name__ == '__main__':
+    main()
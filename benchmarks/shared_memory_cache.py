@@ -0,0 +1,124 @@
+"""
+    Copyright 2019 Ipregistry (https://ipregistry.co).
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       https://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# Compare hit latency and memory usage of a per-process InMemoryCache with a
+# SharedMemoryCache when the same entries are cached by several forked workers.
+# Memory is reported as RSS and, on Linux, as PSS, which splits shared pages
+# between the processes mapping them.
+#
+# Usage: python benchmarks/shared_memory_cache.py [--workers 16] [--entries 20000]
+
+import argparse
+import os
+import tempfile
+import time
+
+from ipregistry import InMemoryCache, IpInfo, SharedMemoryCache
+
+
+def build_entry(i):
+    return IpInfo(**{
+        'ip': '10.{}.{}.{}'.format(i >> 16 & 255, i >> 8 & 255, i & 255),
+        'type': 'IPv4',
+        'company': {'domain': 'example.com', 'name': 'Example', 'type': 'business'},
+        'connection': {'asn': 64496, 'domain': 'example.net', 'organization': 'Example', 'route': '10.0.0.0/8',
+                       'type': 'isp'},
+        'location': {'city': 'Paris', 'country': {'code': 'FR', 'name': 'France', 'capital': 'Paris',
+                                                  'languages': [{'code': 'fr', 'name': 'French'}]},
+                     'latitude': 48.85, 'longitude': 2.35, 'in_eu': True},
+        'security': {'is_abuser': False, 'is_proxy': False, 'is_tor': False, 'is_vpn': False},
+        'time_zone': {'id': 'Europe/Paris', 'abbreviation': 'CET', 'offset': 3600},
+    })
+
+
+def memory_usage():
+    """Return the (RSS, PSS) of the current process in kB; PSS is None when unavailable."""
+    values = {}
+    for name in ('/proc/self/smaps_rollup', '/proc/self/status'):
+        try:
+            with open(name) as file:
+                for line in file:
+                    key, _, rest = line.partition(':')
+                    if key in ('Rss', 'Pss', 'VmRSS'):
+                        values.setdefault(key, int(rest.split()[0]))
+        except OSError:
+            pass
+    if 'Rss' not in values and 'VmRSS' not in values:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, None
+    return values.get('Rss', values.get('VmRSS')), values.get('Pss')
+
+
+def worker(mode, path, entries, lookups, pipe):
+    keys = [str(i) for i in range(entries)]
+    if mode == 'memory':
+        cache = InMemoryCache(maxsize=entries, ttl=3600)
+        for i, key in enumerate(keys):
+            cache.put(key, build_entry(i))
+    else:
+        cache = SharedMemoryCache(path, ttl=3600, slots=entries * 2)
+
+    start = time.perf_counter()
+    for i in range(lookups):
+        cache.get(keys[i % entries])
+    elapsed = time.perf_counter() - start
+
+    rss, pss = memory_usage()
+    os.write(pipe, '{} {} {}\n'.format(elapsed / lookups, rss, pss or 0).encode('ascii'))
+    os._exit(0)
+
+
+def run(mode, path, workers, entries, lookups):
+    read_fd, write_fd = os.pipe()
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            worker(mode, path, entries, lookups, write_fd)
+        pids.append(pid)
+    os.close(write_fd)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    with os.fdopen(read_fd) as file:
+        results = [tuple(float(value) for value in line.split()) for line in file]
+
+    latency = sum(result[0] for result in results) / len(results)
+    rss = sum(result[1] for result in results)
+    pss = sum(result[2] for result in results)
+    print("{:<20} hit latency {:>8.2f}us   total RSS {:>10,.0f} kB   total PSS {:>10,.0f} kB".format(
+        mode, latency * 1e6, rss, pss))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Shared memory cache benchmark')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--entries', type=int, default=20000)
+    parser.add_argument('--lookups', type=int, default=50000, help='cache hits measured per worker')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir='/dev/shm' if os.path.isdir('/dev/shm') else None) as directory:
+        path = os.path.join(directory, 'ipregistry.cache')
+        shared = SharedMemoryCache(path, ttl=3600, slots=args.entries * 2)
+        shared.put_many({str(i): build_entry(i) for i in range(args.entries)})
+        shared.close()
+
+        run('memory', path, args.workers, args.entries, args.lookups)
+        run('shared', path, args.workers, args.entries, args.lookups)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,10 @@ from .async_client import AsyncDefaultRequestHandler as AsyncDefaultRequestHandl
 from .async_client import AsyncIpregistryClient as AsyncIpregistryClient
 from .cache import *
 from .core import *
+from .dispatcher import AsyncBatchDispatcher as AsyncBatchDispatcher
+from .dispatcher import BatchDispatcher as BatchDispatcher
 from .json import *
+from .limits import *
 from .model import *
 from .request import *
 from .util import *
@@ -15,16 +15,21 @@
 """
 import asyncio
 import json
+import time
+from collections import deque
 
 from .cache import IpregistryCache, NoCache
-from .core import (MAX_BATCH_SIZE, IpregistryConfig, _build_cache_key, _is_number,
-                   _merge_batch_responses)
+from .core import (DEFAULT_NEGATIVE_CACHE_CODES, MAX_BATCH_SIZE, IpregistryConfig, _as_lookup_error,
+                   _batch_tuner_key, _build_cache_key, _build_cache_keys, _CachedOptions, _fixed_batching,
+                   _InFlightRequests, _is_number, _iter_chunks, _local_lookup_error, _merge_batch_responses,
+                   _NegativeCache, _project, _put_quietly, _request_kind, _with_current_time)
 from .json import AutonomousSystem, IpInfo
-from .model import (ApiResponse, ApiResponseCredits, ApiResponseThrottling,
-                    ClientError, IpregistryLookupError, RequesterAutonomousSystem,
+from .limits import AdaptiveBatchTuner, AsyncConcurrencyLimiter, AsyncRateLimiter
+from .model import (ApiError, ApiResponse, ApiResponseBatching, ApiResponseCredits, ApiResponseThrottling,
+                    ClientError, ClientStatistics, IpregistryLookupError, RequesterAutonomousSystem,
                     RequesterIpInfo, RequesterUserAgent, UserAgent)
 from .request import (DefaultRequestHandler, IpregistryRequestHandler, _backoff_interval,
-                      _build_headers, _is_retryable_status, _prefix_batch_fields,
+                      _build_headers, _format_asn, _is_retryable_status, _prefix_batch_fields,
                       _raise_api_error, _retry_delay)
 
 try:
@@ -40,7 +45,7 @@ class AsyncDefaultRequestHandler(IpregistryRequestHandler):
     pip install ipregistry[async]
     """
 
-    def __init__(self, config, client=None):
+    def __init__(self, config, client=None, concurrency_limiter=None, rate_limiter=None):
         if httpx is None:
             raise ImportError(
                 "The asynchronous client requires the httpx package. "
@@ -50,6 +55,11 @@ class AsyncDefaultRequestHandler(IpregistryRequestHandler):
         self._owns_client = client is None
         self._client = httpx.AsyncClient(timeout=self.__build_timeout(config.timeout)) \
             if client is None else client
+        self.concurrency_limiter = concurrency_limiter if concurrency_limiter is not None \
+            else AsyncConcurrencyLimiter(getattr(config, 'max_concurrent_requests', None))
+        if rate_limiter is None and getattr(config, 'adaptive_rate_limit', False):
+            rate_limiter = AsyncRateLimiter()
+        self.rate_limiter = rate_limiter
 
     async def aclose(self):
         if self._owns_client:
@@ -59,7 +69,7 @@ class AsyncDefaultRequestHandler(IpregistryRequestHandler):
         response = await self._request_with_retry(
             'POST',
             self._build_base_url('', _prefix_batch_fields(options)),
-            data=json.dumps(["AS" + str(asn) for asn in asns])
+            data=json.dumps([_format_asn(asn) for asn in asns])
         )
         try:
             results = response.json().get('results', [])
@@ -150,19 +160,25 @@ class AsyncDefaultRequestHandler(IpregistryRequestHandler):
 
         while True:
             attempt += 1
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire()
             try:
-                response = await self._client.request(
-                    method,
-                    url,
-                    content=data,
-                    headers=_build_headers(self._config)
-                )
+                async with self.concurrency_limiter:
+                    response = await self._client.request(
+                        method,
+                        url,
+                        content=data,
+                        headers=_build_headers(self._config)
+                    )
             except httpx.HTTPError as e:
                 if attempt < max_attempts:
                     await asyncio.sleep(_backoff_interval(self._config, attempt))
                     continue
                 raise ClientError(e)
 
+            if self.rate_limiter is not None:
+                self.rate_limiter.update(DefaultRequestHandler.build_throttling(response))
+
             if response.status_code >= 400:
                 if attempt < max_attempts and _is_retryable_status(self._config, response.status_code):
                     await asyncio.sleep(_retry_delay(self._config, response, attempt))
@@ -186,10 +202,19 @@ class AsyncIpregistryClient:
     def __init__(self, key_or_config, **kwargs):
         self._config = key_or_config if isinstance(key_or_config, IpregistryConfig) else IpregistryConfig(key_or_config)
         self._cache = kwargs["cache"] if "cache" in kwargs else NoCache()
+        self._negative_cache = _NegativeCache(
+            kwargs.get("negative_cache"), kwargs.get("negative_cache_codes", DEFAULT_NEGATIVE_CACHE_CODES))
         self._requestHandler = kwargs["requestHandler"] if "requestHandler" in kwargs \
             else AsyncDefaultRequestHandler(self._config, client=kwargs.get("client"))
         self._max_batch_size = min(int(kwargs.get("max_batch_size", MAX_BATCH_SIZE)), MAX_BATCH_SIZE)
         self._batch_concurrency = max(int(kwargs.get("batch_concurrency", 4)), 1)
+        self._adaptive_batching = bool(kwargs.get("adaptive_batching", False))
+        self._batch_tuners = {}
+        self._local_ip_validation = bool(kwargs.get("local_ip_validation", False))
+        self._cached_options = _CachedOptions()
+        self._statistics = ClientStatistics()
+        self._in_flight = _InFlightRequests(lambda: asyncio.get_running_loop().create_future())
+        self._background_tasks = set()
 
         if self._max_batch_size < 1:
             raise ValueError("max_batch_size must be at least 1")
@@ -198,7 +223,33 @@ class AsyncIpregistryClient:
         if not isinstance(self._requestHandler, IpregistryRequestHandler):
             raise ValueError("Given request handler instance is not of type IpregistryRequestHandler")
 
+    @property
+    def statistics(self):
+        """Counters of cache hits, misses and lookups served without an API request."""
+        return self._statistics
+
+    @property
+    def concurrency_limiter(self):
+        """The limiter bounding API requests in flight, exposing its occupancy and wait
+        times, or None if the request handler does not provide one."""
+        return getattr(self._requestHandler, 'concurrency_limiter', None)
+
+    @property
+    def rate_limiter(self):
+        """The adaptive limiter pacing API requests from rate limit headers, exposing its
+        current rate and delays, or None if adaptive rate limiting is disabled."""
+        return getattr(self._requestHandler, 'rate_limiter', None)
+
+    @property
+    def batch_tuners(self):
+        """The AdaptiveBatchTuner instances of adaptive batching, keyed by request
+        kind and options."""
+        return dict(self._batch_tuners)
+
     async def aclose(self):
+        # Let background refreshes complete before closing the HTTP client they use.
+        while self._background_tasks:
+            await asyncio.gather(*self._background_tasks, return_exceptions=True)
         await self._requestHandler.aclose()
 
     async def __aenter__(self):
@@ -216,67 +267,312 @@ class AsyncIpregistryClient:
     async def batch_parse_user_agents(self, user_agents, **options):
         return await self.batch_request(user_agents, self._requestHandler.batch_parse_user_agents, **options)
 
-    async def batch_request(self, items, request_handler_func, **options):
-        sparse_cache = [None] * len(items)
-        cache_misses = []
+    def iter_lookup_asns(self, asns, **options):
+        return self.iter_request(asns, self._requestHandler.batch_lookup_asns, **options)
+
+    def iter_lookup_ips(self, ips, **options):
+        return self.iter_request(ips, self._requestHandler.batch_lookup_ips, **options)
+
+    def iter_parse_user_agents(self, user_agents, **options):
+        return self.iter_request(user_agents, self._requestHandler.batch_parse_user_agents, **options)
+
+    async def iter_request(self, items, request_handler_func, **options):
+        """Look up items read lazily from an iterable or asynchronous iterable
+        and yield their entries in input order.
 
+        Items are consumed in chunks of max_batch_size and at most
+        batch_concurrency chunks are in flight at a time, so memory usage does
+        not depend on the number of items."""
+        tasks = deque()
+        try:
+            async for chunk in self.__aiter_chunks(items):
+                tasks.append(asyncio.ensure_future(self.batch_request(chunk, request_handler_func, **options)))
+                if len(tasks) >= self._batch_concurrency:
+                    for entry in (await tasks.popleft()).data:
+                        yield entry
+            while tasks:
+                for entry in (await tasks.popleft()).data:
+                    yield entry
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def __aiter_chunks(self, items):
+        if not hasattr(items, '__aiter__'):
+            for chunk in _iter_chunks(items, self._max_batch_size):
+                yield chunk
+            return
+
+        chunk = []
+        async for item in items:
+            chunk.append(item)
+            if len(chunk) >= self._max_batch_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    async def batch_request(self, items, request_handler_func, **options):
+        kind = _request_kind(self._requestHandler, request_handler_func)
+        cache_keys = _build_cache_keys(kind, items, options)
+        result, short_circuited = self.__get_cached(items, cache_keys, kind)
+        self.__refresh_batch_hits(items, cache_keys, result, request_handler_func, options)
+        projected = self.__fill_projected_hits(kind, items, result, options)
+        self.__fill_negative_hits(cache_keys, result)
+        if kind == 'ip':
+            result = [_with_current_time(value) for value in result]
+
+        # Each distinct cache miss is requested once: repeated items reuse the
+        # result of their first occurrence and items already requested by a
+        # concurrent lookup wait for its outcome.
+        flights = {}
+        requested = []
+        duplicates = []
+        waiting = []
         for i in range(len(items)):
-            item = items[i]
-            cache_key = _build_cache_key(item, options)
-            cache_value = self._cache.get(cache_key)
-            if cache_value is None:
-                cache_misses.append(item)
-            else:
-                sparse_cache[i] = cache_value
-
-        result = [None] * len(items)
-        if len(cache_misses) > 0:
-            response = await self.__batch_request_chunked(cache_misses, request_handler_func, options)
+            if result[i] is None:
+                cache_key = cache_keys[i]
+                if cache_key not in flights:
+                    flights[cache_key] = self._in_flight.join(cache_key)
+                    (requested if flights[cache_key][1] else waiting).append(i)
+                else:
+                    (duplicates if flights[cache_key][1] else waiting).append(i)
+
+        if len(requested) > 0:
+            response, fresh_results = await self.__detached(self.__request_fresh(
+                kind, [items[i] for i in requested], [cache_keys[i] for i in requested], flights,
+                request_handler_func, options))
         else:
             response = ApiResponse(
                 ApiResponseCredits(),
                 [],
                 ApiResponseThrottling()
             )
+            fresh_results = {}
+
+        for i in requested:
+            result[i] = fresh_results[cache_keys[i]]
+
+        for i in duplicates:
+            result[i] = fresh_results[cache_keys[i]]
 
-        fresh_item_info = response.data
-        if len(fresh_item_info) != len(cache_misses):
-            raise ClientError(
-                "Batch response contained {} results for {} requested items.".format(
-                    len(fresh_item_info), len(cache_misses)))
-        j = 0
-        k = 0
-
-        for cached_item_info in sparse_cache:
-            if cached_item_info is None:
-                if not isinstance(fresh_item_info[k], IpregistryLookupError):
-                    self._cache.put(_build_cache_key(items[j], options), fresh_item_info[k])
-                result[j] = fresh_item_info[k]
-                k += 1
-            else:
-                result[j] = cached_item_info
-            j += 1
+        cache_misses = len(requested) + len(duplicates) + len(waiting)
+        self._statistics.record(
+            cache_hits=len(items) - cache_misses - short_circuited, cache_misses=cache_misses,
+            coalesced=len(waiting), deduplicated=len(duplicates), projected=projected,
+            short_circuited=short_circuited,
+            credits_consumed=response.credits.consumed if requested else None)
+
+        for i in waiting:
+            try:
+                result[i] = await asyncio.shield(flights[cache_keys[i]][0])
+            except ApiError as e:
+                result[i] = _as_lookup_error(e)
 
         response.data = result
 
         return response
 
+    async def __request_fresh(self, kind, items, cache_keys, flights, request_handler_func, options):
+        """Request the batch items led by a lookup, store their results and
+        resolve the flights of the lookup with them."""
+        try:
+            response = await self.__batch_request_chunked(items, request_handler_func, options)
+            if len(response.data) != len(items):
+                raise ClientError(
+                    "Batch response contained {} results for {} requested items.".format(
+                        len(response.data), len(items)))
+
+            fresh_results = dict(zip(cache_keys, response.data))
+            fresh_entries = {}
+            fresh_errors = {}
+            for cache_key, item_info in fresh_results.items():
+                if isinstance(item_info, IpregistryLookupError):
+                    fresh_errors[cache_key] = item_info
+                else:
+                    fresh_entries[cache_key] = item_info
+            if fresh_entries and _put_quietly(self._cache, fresh_entries):
+                self._cached_options.add(kind, options)
+            _put_quietly(self._negative_cache, fresh_errors)
+        except BaseException as e:
+            self.__resolve_flights(flights, exception=e)
+            raise
+
+        self.__resolve_flights(flights, results=fresh_results)
+        return response, fresh_results
+
+    def __detached(self, coroutine):
+        """Run the request of a lookup leading in-flight keys in its own task
+        and return it shielded. Cancelling the lookup, for instance when it
+        times out, then stops waiting for the request without cancelling it
+        for the concurrent lookups coalesced with it."""
+        task = asyncio.ensure_future(coroutine)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return asyncio.shield(task)
+
+    def __get_cached(self, items, cache_keys, kind):
+        """Return the cached values of a batch, with None for misses, and the
+        number of IPs answered locally, which are pulled out before the cache
+        is read and never requested."""
+        if not self._local_ip_validation or kind != 'ip':
+            return list(self._cache.get_many(cache_keys)), 0
+
+        result = [_local_lookup_error(item) for item in items]
+        positions = [i for i in range(len(items)) if result[i] is None]
+        for i, value in zip(positions, self._cache.get_many([cache_keys[i] for i in positions])):
+            result[i] = value
+        return result, len(items) - len(positions)
+
+    def __fill_projected_hits(self, kind, items, result, options):
+        """Fill the cache misses of a batch with the projection of entries
+        cached with options covering the given ones, such as all fields or a
+        resolved hostname, and return their number."""
+        misses = [i for i in range(len(result)) if result[i] is None]
+        projected = 0
+        for cached_options in self._cached_options.covering(kind, options):
+            if not misses:
+                break
+            keys = _build_cache_keys(kind, [items[i] for i in misses], cached_options)
+            remaining = []
+            for i, value in zip(misses, self._cache.get_many(keys)):
+                if value is not None:
+                    result[i] = _project(value, cached_options, options)
+                if result[i] is None:
+                    remaining.append(i)
+            projected += len(misses) - len(remaining)
+            misses = remaining
+        return projected
+
+    def __fill_negative_hits(self, cache_keys, result):
+        """Fill the cache misses of a batch with the negatively cached errors of their keys."""
+        misses = [i for i in range(len(result)) if result[i] is None]
+        for i, error in zip(misses, self._negative_cache.get_many([cache_keys[i] for i in misses])):
+            result[i] = error
+
+    def __refresh_batch_hits(self, items, cache_keys, result, request_handler_func, options):
+        """Refresh the stale entries among the cache hits of a batch with a
+        background batch request."""
+        hits = {cache_keys[i]: items[i] for i in range(len(items)) if result[i] is not None}
+        if not hits:
+            return
+        stale = self._cache.keys_to_refresh(list(hits))
+        if not stale:
+            return
+
+        async def send(keys):
+            response = await self.__batch_request_chunked([hits[key] for key in keys], request_handler_func, options)
+            if len(response.data) != len(keys):
+                raise ClientError("Batch response contained {} results for {} requested items.".format(
+                    len(response.data), len(keys)))
+            results = dict(zip(keys, response.data))
+            _put_quietly(self._cache, {key: value for key, value in results.items()
+                                       if not isinstance(value, IpregistryLookupError)})
+            self._statistics.record(credits_consumed=response.credits.consumed)
+            return results
+
+        self.__refresh_in_background(stale, send)
+
+    def __refresh_in_background(self, cache_keys, send):
+        """Refresh cached entries in a background task while their stale values
+        keep being served. Keys already being requested are skipped, so each
+        entry gets a single refresh; send(keys) requests the others and returns
+        their new values keyed by cache key."""
+        keys = [key for key in cache_keys if self._in_flight.join(key)[1]]
+        if not keys:
+            return
+
+        async def refresh():
+            try:
+                results = await send(keys)
+            except BaseException as e:
+                for key in keys:
+                    self._in_flight.resolve(key, exception=e)
+                if not isinstance(e, Exception):
+                    raise
+                return
+            for key in keys:
+                self._in_flight.resolve(key, results[key])
+
+        self._statistics.record(refreshes=len(keys))
+        task = asyncio.ensure_future(refresh())
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    def __resolve_flights(self, flights, results=None, exception=None):
+        for cache_key, (_, leader) in flights.items():
+            if leader:
+                self._in_flight.resolve(
+                    cache_key, None if results is None else results[cache_key], exception)
+
     async def __batch_request_chunked(self, items, request_handler_func, options):
         """Split a batch into chunks of at most max_batch_size items and issue
         them concurrently, preserving input order in the merged response."""
+        if self._adaptive_batching:
+            return await self.__batch_request_adaptive(items, request_handler_func, options)
+
         if len(items) <= self._max_batch_size:
-            return await request_handler_func(items, options)
+            response = await request_handler_func(items, options)
+        else:
+            chunks = [items[i:i + self._max_batch_size] for i in range(0, len(items), self._max_batch_size)]
+            semaphore = asyncio.Semaphore(self._batch_concurrency)
 
-        chunks = [items[i:i + self._max_batch_size] for i in range(0, len(items), self._max_batch_size)]
-        semaphore = asyncio.Semaphore(self._batch_concurrency)
+            async def run_chunk(chunk):
+                async with semaphore:
+                    return await request_handler_func(chunk, options)
 
-        async def run_chunk(chunk):
-            async with semaphore:
-                return await request_handler_func(chunk, options)
+            response = _merge_batch_responses(await asyncio.gather(*[run_chunk(chunk) for chunk in chunks]))
+        response.batching = _fixed_batching(items, self._max_batch_size, self._batch_concurrency)
+        return response
 
-        responses = await asyncio.gather(*[run_chunk(chunk) for chunk in chunks])
+    async def __batch_request_adaptive(self, items, request_handler_func, options):
+        """Issue a batch in chunks whose size and concurrency are read from the
+        AdaptiveBatchTuner of its request kind before each chunk, feeding it
+        back the latency and outcome of every chunk."""
+        tuner = self._batch_tuners.setdefault(
+            _batch_tuner_key(request_handler_func, options),
+            AdaptiveBatchTuner(self._max_batch_size, self._batch_concurrency))
 
-        return _merge_batch_responses(responses)
+        async def run_chunk(chunk):
+            start = time.monotonic()
+            try:
+                response = await request_handler_func(chunk, options)
+            except Exception as e:
+                tuner.record(time.monotonic() - start, e)
+                raise
+            tuner.record(time.monotonic() - start)
+            return response
+
+        responses = {}
+        pending = {}
+        offset = 0
+        largest = 0
+        peak = 1
+        try:
+            while offset < len(items) or pending:
+                while offset < len(items):
+                    chunk_size, concurrency = tuner.settings()
+                    if pending and len(pending) >= concurrency:
+                        break
+                    chunk = items[offset:offset + chunk_size]
+                    largest = max(largest, len(chunk))
+                    pending[asyncio.ensure_future(run_chunk(chunk))] = offset
+                    peak = max(peak, len(pending))
+                    offset += len(chunk)
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    # Retrieve every exception, not only the one raised below.
+                    task.exception()
+                for task in done:
+                    responses[pending.pop(task)] = task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+        response = responses[0] if len(responses) == 1 \
+            else _merge_batch_responses([responses[key] for key in sorted(responses)])
+        response.batching = ApiResponseBatching(largest, peak, len(responses))
+        return response
 
     async def lookup_asn(self, asn, **options):
         return await self.__lookup_asn(asn, options)
@@ -296,6 +592,16 @@ class AsyncIpregistryClient:
     async def origin_parse_user_agent(self, **options):
         return await self._requestHandler.origin_parse_user_agent(options)
 
+    def __refresh_lookup(self, cache_key, key, options, lookup_func, response_type):
+        async def send(keys):
+            response = await lookup_func(key, options)
+            self._statistics.record(credits_consumed=response.credits.consumed)
+            if isinstance(response.data, response_type):
+                _put_quietly(self._cache, {cache_key: response.data})
+            return {cache_key: response.data}
+
+        self.__refresh_in_background([cache_key], send)
+
     async def parse_user_agent(self, user_agent, **options):
         response = await self.batch_parse_user_agents([user_agent], **options)
         response.data = response.data[0]
@@ -305,23 +611,65 @@ class AsyncIpregistryClient:
         return await self.__lookup(
             'AS' + str(asn) if _is_number(asn) else 'AS',
             options, self._requestHandler.lookup_asn,
-            AutonomousSystem)
+            AutonomousSystem, 'asn')
 
     async def __lookup_ip(self, ip, options):
-        return await self.__lookup(ip, options, self._requestHandler.lookup_ip, IpInfo)
-
-    async def __lookup(self, key, options, lookup_func, response_type):
-        cache_key = _build_cache_key(key, options)
+        if self._local_ip_validation:
+            error = _local_lookup_error(ip)
+            if error is not None:
+                self._statistics.record(short_circuited=1)
+                raise ApiError(error.code, error.message, error.resolution)
+        return await self.__lookup(ip, options, self._requestHandler.lookup_ip, IpInfo, 'ip')
+
+    async def __lookup(self, key, options, lookup_func, response_type, kind):
+        cache_key = _build_cache_key(kind, key, options)
         cache_value = self._cache.get(cache_key)
 
-        if cache_value is None:
-            response = await lookup_func(key, options)
-            if isinstance(response.data, response_type):
-                self._cache.put(cache_key, response.data)
-            return response
+        if cache_value is not None:
+            self._statistics.record(cache_hits=1)
+            if self._cache.keys_to_refresh([cache_key]):
+                self.__refresh_lookup(cache_key, key, options, lookup_func, response_type)
+            return ApiResponse(
+                ApiResponseCredits(),
+                _with_current_time(cache_value),
+                ApiResponseThrottling()
+            )
 
-        return ApiResponse(
-            ApiResponseCredits(),
-            cache_value,
-            ApiResponseThrottling()
-        )
+        projected = [None]
+        if self.__fill_projected_hits(kind, [key], projected, options):
+            self._statistics.record(cache_hits=1, projected=1)
+            return ApiResponse(ApiResponseCredits(), _with_current_time(projected[0]), ApiResponseThrottling())
+
+        error = self._negative_cache.get(cache_key)
+        if error is not None:
+            self._statistics.record(cache_hits=1)
+            raise ApiError(error['code'], error['message'], error['resolution'])
+
+        future, leader = self._in_flight.join(cache_key)
+        if not leader:
+            self._statistics.record(cache_misses=1, coalesced=1)
+            data = await asyncio.shield(future)
+            if isinstance(data, IpregistryLookupError):
+                raise data
+            return ApiResponse(ApiResponseCredits(), data, ApiResponseThrottling())
+
+        return await self.__detached(self.__request_lookup(cache_key, key, options, lookup_func, response_type, kind))
+
+    async def __request_lookup(self, cache_key, key, options, lookup_func, response_type, kind):
+        """Request a single lookup led by the caller, store its result and
+        resolve its flight with it."""
+        try:
+            try:
+                response = await lookup_func(key, options)
+            except ApiError as e:
+                _put_quietly(self._negative_cache, {cache_key: e})
+                raise
+            self._statistics.record(cache_misses=1, credits_consumed=response.credits.consumed)
+            if isinstance(response.data, response_type) and _put_quietly(self._cache, {cache_key: response.data}):
+                self._cached_options.add(kind, options)
+        except BaseException as e:
+            self._in_flight.resolve(cache_key, exception=e)
+            raise
+
+        self._in_flight.resolve(cache_key, response.data)
+        return response
@@ -14,8 +14,261 @@
     limitations under the License.
 """
 
+import contextlib
+import functools
+import hashlib
+import ipaddress
+import json
+import mmap
+import os
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
 from abc import ABC, abstractmethod
-from cachetools import TTLCache
+from collections import OrderedDict
+from enum import Enum
+from cachetools import TLRUCache
+from pydantic import BaseModel
+
+from .json import AutonomousSystem, IpInfo, Security, UserAgent
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+# Model types that cache backends storing serialized entries know how to rebuild.
+_SERIALIZABLE_MODELS = {model.__name__: model for model in (AutonomousSystem, IpInfo, UserAgent)}
+
+
+@functools.lru_cache(maxsize=None)
+def _schema_version():
+    """Return a fingerprint of the cached models' JSON schema.
+
+    Serialized entries are tagged with it so that entries written by a
+    library version with different models are ignored instead of being
+    decoded into the wrong shape."""
+    schemas = [model.model_json_schema() for _, model in sorted(_SERIALIZABLE_MODELS.items())]
+    return hashlib.sha256(json.dumps(schemas, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def _serialize(data):
+    """Encode a cached value as its type name, a NUL separator and compact JSON.
+
+    Models keep only the fields that differ from their defaults and are parsed
+    back with pydantic's native JSON validation; other values must be JSON
+    serializable and are stored with an empty type name."""
+    if isinstance(data, BaseModel) and type(data).__name__ in _SERIALIZABLE_MODELS:
+        name = type(data).__name__.encode('ascii')
+        return name + b'\x00' + data.model_dump_json(exclude_defaults=True).encode('utf-8')
+    return b'\x00' + json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+def _deserialize(value):
+    type_name, _, payload = bytes(value).partition(b'\x00')
+    if not type_name:
+        return json.loads(payload)
+    return _SERIALIZABLE_MODELS[type_name.decode('ascii')].model_validate_json(payload)
+
+
+@functools.lru_cache(maxsize=None)
+def _compression_dictionary():
+    """Return a zlib preset dictionary made of the type and JSON field names
+    of the cached models, which account for most of a small serialized entry
+    and would otherwise compress poorly one entry at a time."""
+    names = set(_SERIALIZABLE_MODELS)
+    schemas = [model.model_json_schema() for model in _SERIALIZABLE_MODELS.values()]
+    for schema in schemas + [definition for schema in schemas for definition in schema.get('$defs', {}).values()]:
+        names.update('"{}":'.format(name) for name in schema.get('properties', {}))
+    return ''.join(sorted(names)).encode('utf-8')
+
+
+def _compress(value):
+    compressor = zlib.compressobj(zlib.Z_BEST_COMPRESSION, zdict=_compression_dictionary())
+    return compressor.compress(value) + compressor.flush()
+
+
+def _decompress(value):
+    decompressor = zlib.decompressobj(zdict=_compression_dictionary())
+    return decompressor.decompress(value) + decompressor.flush()
+
+
+def _footprint(value):
+    """Estimate the memory taken by a value and the objects it references.
+
+    Containers and models are counted once. Singletons, enum members and the
+    field names of models, which are shared by every entry, are not counted."""
+    getsizeof = sys.getsizeof
+    seen = set()
+    size = 0
+    stack = [value]
+    while stack:
+        item = stack.pop()
+        cls = type(item)
+        if cls is str or cls is int or cls is float:
+            size += getsizeof(item)
+        elif item is None or cls is bool or isinstance(item, Enum) or id(item) in seen:
+            continue
+        elif cls is dict:
+            seen.add(id(item))
+            size += getsizeof(item)
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif cls is list or cls is tuple or cls is set or cls is frozenset:
+            seen.add(id(item))
+            size += getsizeof(item)
+            stack.extend(item)
+        elif isinstance(item, BaseModel):
+            seen.add(id(item))
+            size += getsizeof(item) + getsizeof(item.__dict__) + getsizeof(item.__pydantic_fields_set__)
+            stack.extend(item.__dict__.values())
+        else:
+            size += getsizeof(item)
+    return size
+
+
+def _encode_key(key):
+    """Encode a cache key as bytes, tagged with its type so that it can be decoded back."""
+    return b'\x01' + key if isinstance(key, bytes) else b'\x00' + str(key).encode('utf-8')
+
+
+def _decode_key(encoded):
+    return bytes(encoded[1:]) if encoded[:1] == b'\x01' else bytes(encoded[1:]).decode('utf-8')
+
+
+_SNAPSHOT_MAGIC = b'IPRSNAP1'
+# magic, schema version, export timestamp
+_SNAPSHOT_HEADER = struct.Struct('<8s16sd')
+# key length, value length, remaining TTL
+_SNAPSHOT_RECORD = struct.Struct('<HIf')
+_SNAPSHOT_CHUNK_SIZE = 1 << 20
+
+
+def _write_snapshot(path, records):
+    """Stream (key, serialized data, remaining TTL) records to a snapshot file
+    and return their number.
+
+    After a header, records are written as a single zlib stream, which
+    compresses the data repeated across entries far better than entries
+    compressed one by one. The file is written next to path and renamed over
+    it, so that readers never see a partial snapshot."""
+    path = str(path)
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    compressor = zlib.compressobj(1)
+    count = 0
+    try:
+        with open(temporary, 'wb') as file:
+            file.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, _schema_version().encode('ascii'), time.time()))
+            parts = []
+            size = 0
+            for key, payload, ttl in records:
+                encoded = _encode_key(key)
+                if ttl <= 0 or len(encoded) > 0xFFFF:
+                    continue
+                parts.append(_SNAPSHOT_RECORD.pack(len(encoded), len(payload), ttl))
+                parts.append(encoded)
+                parts.append(payload)
+                count += 1
+                size += len(encoded) + len(payload)
+                if size >= _SNAPSHOT_CHUNK_SIZE:
+                    file.write(compressor.compress(b''.join(parts)))
+                    parts = []
+                    size = 0
+            file.write(compressor.compress(b''.join(parts)) + compressor.flush())
+        os.replace(temporary, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temporary)
+        raise
+    return count
+
+
+def _read_snapshot(path):
+    """Yield batches of the (key, serialized data, remaining TTL) records of
+    a snapshot file, their TTLs reduced by the time elapsed since it was
+    exported. Snapshots of other schema versions of the cached models yield
+    nothing."""
+    with open(str(path), 'rb') as file:
+        header = file.read(_SNAPSHOT_HEADER.size)
+        if len(header) != _SNAPSHOT_HEADER.size or header[:8] != _SNAPSHOT_MAGIC:
+            raise ValueError("{} is not a cache snapshot".format(path))
+        _, schema, exported_at = _SNAPSHOT_HEADER.unpack(header)
+        if schema != _schema_version().encode('ascii'):
+            return
+        elapsed = max(0.0, time.time() - exported_at)
+        decompressor = zlib.decompressobj()
+        record_size = _SNAPSHOT_RECORD.size
+        unpack_from = _SNAPSHOT_RECORD.unpack_from
+        pending = b''
+        while True:
+            chunk = file.read(_SNAPSHOT_CHUNK_SIZE)
+            pending += decompressor.decompress(chunk) if chunk else decompressor.flush()
+            batch = []
+            offset = 0
+            while len(pending) - offset >= record_size:
+                key_length, value_length, ttl = unpack_from(pending, offset)
+                start = offset + record_size
+                end = start + key_length + value_length
+                if end > len(pending):
+                    break
+                if ttl > elapsed:
+                    batch.append((_decode_key(pending[start:start + key_length]),
+                                  pending[start + key_length:end], ttl - elapsed))
+                offset = end
+            pending = pending[offset:]
+            if batch:
+                yield batch
+            if not chunk:
+                break
+        if pending or not decompressor.eof:
+            raise ValueError("{} is a truncated cache snapshot".format(path))
+
+
+class TtlPolicy:
+    """Choose the TTL of each cached entry from its type and the fields it holds.
+
+    by_type maps model types, or their names, to the TTL of their entries, and
+    by_field maps top-level field names, such as 'security' or 'location', to
+    the TTL of the data they hold. An entry whose populated fields include
+    some of by_field expires after the shortest of their TTLs, so that an
+    IpInfo looked up with fields='location' can be kept for days while one
+    including security expires quickly. Other entries expire after the TTL of
+    their type, or default. Cache backends accept a TtlPolicy as their ttl.
+    """
+
+    def __init__(self, default=600, by_type=None, by_field=None):
+        self.default = default
+        self.by_type = {getattr(model, '__name__', model): ttl for model, ttl in (by_type or {}).items()}
+        self.by_field = dict(by_field or {})
+        if any(ttl < 0 for ttl in [default, *self.by_type.values(), *self.by_field.values()]):
+            raise ValueError("TTLs must be positive")
+
+    def ttl(self, data):
+        """Return the number of seconds data should be cached for."""
+        if isinstance(data, BaseModel):
+            ttls = [ttl for name, ttl in self.by_field.items() if getattr(data, name, None) is not None]
+            if ttls:
+                return min(ttls)
+        for model in type(data).__mro__:
+            if model.__name__ in self.by_type:
+                return self.by_type[model.__name__]
+        return self.default
+
+    def __str__(self):
+        return f"{self.__class__.__name__}(default={self.default}, by_type={self.by_type}, by_field={self.by_field})"
+
+
+def _entry_ttl(ttl, data):
+    return ttl.ttl(data) if isinstance(ttl, TtlPolicy) else ttl
 
 
 class IpregistryCache(ABC):
@@ -35,19 +288,143 @@ class IpregistryCache(ABC):
     def invalidate_all(self):
         pass
 
+    def get_many(self, keys):
+        """Return the cached values for the given keys, in order, with None for
+        missing entries. Backends able to pipeline or vectorize lookups should
+        override the default implementation, which calls get once per key."""
+        return [self.get(key) for key in keys]
+
+    def put_many(self, entries):
+        """Store every (key, data) pair of the given mapping."""
+        for key, data in entries.items():
+            self.put(key, data)
+
+    def invalidate_many(self, keys):
+        for key in keys:
+            self.invalidate(key)
+
+    def keys_to_refresh(self, keys):
+        """Return the keys, among the given ones found in the cache, whose
+        entries are stale or about to expire and should be refreshed in the
+        background while still being served. Backends without such a mode
+        keep the default, which never asks for a refresh."""
+        return []
+
+    def export_snapshot(self, path):
+        """Write the live entries of the cache and their remaining TTLs to a
+        compressed snapshot file and return the number of entries written.
+        Backends unable to list their entries raise NotImplementedError."""
+        return _write_snapshot(path, self._snapshot_records())
+
+    def load_snapshot(self, path):
+        """Insert the entries of a snapshot file that did not expire since it
+        was exported, batch by batch, and return their number. Snapshots
+        written for other versions of the cached models are ignored."""
+        count = 0
+        for records in _read_snapshot(path):
+            self._load_records(records)
+            count += len(records)
+        return count
+
+    def _snapshot_records(self):
+        """Yield a (key, serialized data, remaining TTL) record per live entry."""
+        raise NotImplementedError("{} does not support snapshots".format(type(self).__name__))
+
+    def _load_records(self, records):
+        """Store (key, serialized data, remaining TTL) records. The default
+        decodes them and stores them with put_many, under the cache's TTL."""
+        self.put_many({key: _deserialize(payload) for key, payload, _ in records})
+
 
 class InMemoryCache(IpregistryCache):
-    def __init__(self, maxsize=2048, ttl=600):
-        self._cache = TTLCache(maxsize, ttl)
+    """In-memory cache whose entries expire ttl seconds after being stored.
+
+    Entries may be kept stale_ttl more seconds past their TTL: they are still
+    served, but reported by keys_to_refresh so that clients refresh them with
+    a single background request instead of making callers wait. With
+    refresh_ahead, a fraction of the TTL, entries hit during that last part
+    of their lifetime are refreshed the same way before they expire. With
+    ttl_jitter, a fraction of the TTL, each entry's TTL is randomly shortened
+    or lengthened by up to that fraction, so that entries written by the same
+    batch do not all expire at once.
+
+    With compact, entries are stored as serialized bytes, optionally
+    compressed with compress, and only decoded when hit: a cached IpInfo then
+    takes a fraction of the memory of its object graph.
+
+    With max_bytes, entries are evicted once their sizes add up to more than
+    max_bytes, instead of once there are more than maxsize, and bytes_used
+    reports their current total. The size of compact entries is their
+    serialized size; the size of other entries is estimated from their
+    object graph when they are stored.
+
+    ttl may be a TtlPolicy choosing the TTL of each entry.
+    """
+
+    def __init__(self, maxsize=2048, ttl=600, stale_ttl=0, refresh_ahead=0.0, ttl_jitter=0.0,
+                 compact=False, compress=False, max_bytes=None):
+        if stale_ttl < 0:
+            raise ValueError("stale_ttl must be positive")
+        if not 0 <= refresh_ahead < 1 or not 0 <= ttl_jitter < 1:
+            raise ValueError("refresh_ahead and ttl_jitter must be fractions of the TTL between 0 and 1")
+        if compress and not compact:
+            raise ValueError("compress requires compact storage")
+        if max_bytes is not None and max_bytes < 1:
+            raise ValueError("max_bytes must be at least 1")
+        self._ttl = ttl
+        self._stale_ttl = stale_ttl
+        self._refresh_ahead = refresh_ahead
+        self._ttl_jitter = ttl_jitter
+        self._compact = compact
+        self._compress = compress
+        self._refreshable = stale_ttl > 0 or refresh_ahead > 0
+        self._max_bytes = max_bytes
+        getsizeof = None if max_bytes is None else self.__sizeof
+        # Entries are (data, refresh_at, expires_at) tuples.
+        self._cache = TLRUCache(max_bytes or maxsize, lambda key, value, now: value[2], getsizeof=getsizeof)
+
+    @property
+    def bytes_used(self):
+        """Total size of the cached entries, or None without max_bytes."""
+        return None if self._max_bytes is None else self._cache.currsize
 
     def get(self, key):
         try:
-            return self._cache[key]
+            value = self._cache[key][0]
         except KeyError:
             return None
+        if self._compact:
+            value = _deserialize(_decompress(value) if self._compress else value)
+        return value
 
     def put(self, key, data):
-        self._cache[key] = data
+        ttl = _entry_ttl(self._ttl, data)
+        if self._compact:
+            data = _serialize(data)
+            if self._compress:
+                data = _compress(data)
+        self.__store(key, data, ttl)
+
+    def __store(self, key, data, ttl):
+        if self._ttl_jitter > 0:
+            ttl *= 1 + random.uniform(-self._ttl_jitter, self._ttl_jitter)
+        now = self._cache.timer()
+        try:
+            self._cache[key] = (data, now + ttl * (1 - self._refresh_ahead), now + ttl + self._stale_ttl)
+        except ValueError:
+            # Entries larger than max_bytes are not cached.
+            self._cache.pop(key, None)
+
+    def keys_to_refresh(self, keys):
+        if not self._refreshable:
+            return []
+        now = self._cache.timer()
+        result = []
+        for key in keys:
+            value = self._cache.get(key)
+            if value is not None and now >= value[1]:
+                result.append(key)
+        return result
 
     def invalidate(self, key):
         del self._cache[key]
@@ -55,6 +432,1071 @@ class InMemoryCache(IpregistryCache):
     def invalidate_all(self):
         self._cache.clear()
 
+    def _snapshot_records(self):
+        now = self._cache.timer()
+        for key in list(self._cache):
+            value = self._cache.get(key)
+            ttl = None if value is None else value[2] - self._stale_ttl - now
+            if ttl is None or ttl <= 0:
+                continue
+            if not self._compact:
+                yield key, _serialize(value[0]), ttl
+            else:
+                yield key, _decompress(value[0]) if self._compress else value[0], ttl
+
+    def _load_records(self, records):
+        for key, payload, ttl in records:
+            if not self._compact:
+                self.__store(key, _deserialize(payload), ttl)
+            else:
+                # Compact entries are stored without being decoded.
+                self.__store(key, _compress(payload) if self._compress else bytes(payload), ttl)
+
+    def __sizeof(self, value):
+        return len(value[0]) if self._compact else _footprint(value[0])
+
+
+class ConcurrentInMemoryCache(IpregistryCache):
+    """Thread-safe in-memory cache for clients shared across threads.
+
+    Keys are sharded across independently locked segments, each one an
+    InMemoryCache holding an equal share of maxsize, so that concurrent
+    callers only contend when their keys hash to the same segment. The
+    stale_ttl, refresh_ahead, ttl_jitter, compact, compress and max_bytes
+    options are those of InMemoryCache, max_bytes being shared equally too.
+    """
+
+    def __init__(self, maxsize=2048, ttl=600, segments=16, stale_ttl=0, refresh_ahead=0.0, ttl_jitter=0.0,
+                 compact=False, compress=False, max_bytes=None):
+        if segments < 1:
+            raise ValueError("segments must be at least 1")
+        segment_maxsize = max(1, -(-maxsize // segments))
+        segment_max_bytes = None if max_bytes is None else max(1, -(-max_bytes // segments))
+        self._segments = [InMemoryCache(segment_maxsize, ttl, stale_ttl, refresh_ahead, ttl_jitter,
+                                        compact, compress, segment_max_bytes)
+                          for _ in range(segments)]
+        self._locks = [threading.Lock() for _ in range(segments)]
+
+    @property
+    def bytes_used(self):
+        """Total size of the cached entries across segments, or None without max_bytes."""
+        sizes = []
+        for segment, lock in zip(self._segments, self._locks):
+            with lock:
+                sizes.append(segment.bytes_used)
+        return None if sizes[0] is None else sum(sizes)
+
+    def get(self, key):
+        index = self.__segment_index(key)
+        with self._locks[index]:
+            return self._segments[index].get(key)
+
+    def put(self, key, data):
+        index = self.__segment_index(key)
+        with self._locks[index]:
+            self._segments[index].put(key, data)
+
+    def invalidate(self, key):
+        index = self.__segment_index(key)
+        with self._locks[index]:
+            self._segments[index].invalidate(key)
+
+    def invalidate_all(self):
+        for segment, lock in zip(self._segments, self._locks):
+            with lock:
+                segment.invalidate_all()
+
+    def get_many(self, keys):
+        result = [None] * len(keys)
+        for index, positions in self.__group_by_segment(keys).items():
+            segment = self._segments[index]
+            with self._locks[index]:
+                for position in positions:
+                    result[position] = segment.get(keys[position])
+        return result
+
+    def put_many(self, entries):
+        keys = list(entries)
+        for index, positions in self.__group_by_segment(keys).items():
+            segment = self._segments[index]
+            with self._locks[index]:
+                for position in positions:
+                    segment.put(keys[position], entries[keys[position]])
+
+    def invalidate_many(self, keys):
+        keys = list(keys)
+        for index, positions in self.__group_by_segment(keys).items():
+            segment = self._segments[index]
+            with self._locks[index]:
+                for position in positions:
+                    segment.invalidate(keys[position])
+
+    def keys_to_refresh(self, keys):
+        keys = list(keys)
+        result = []
+        for index, positions in self.__group_by_segment(keys).items():
+            with self._locks[index]:
+                result.extend(self._segments[index].keys_to_refresh([keys[position] for position in positions]))
+        return result
+
+    def _snapshot_records(self):
+        for segment, lock in zip(self._segments, self._locks):
+            with lock:
+                records = list(segment._snapshot_records())
+            yield from records
+
+    def _load_records(self, records):
+        records = list(records)
+        for index, positions in self.__group_by_segment([record[0] for record in records]).items():
+            with self._locks[index]:
+                self._segments[index]._load_records([records[position] for position in positions])
+
+    def __group_by_segment(self, keys):
+        """Map each segment index to the positions of the given keys it holds,
+        so that every segment lock is taken at most once per bulk call."""
+        groups = {}
+        for position, key in enumerate(keys):
+            groups.setdefault(self.__segment_index(key), []).append(position)
+        return groups
+
+    def __segment_index(self, key):
+        return hash(key) % len(self._segments)
+
+
+class _FrequencySketch:
+    """Count-min sketch estimating how often keys were accessed recently.
+
+    Counters saturate at 15 and are all halved once the number of recorded
+    accesses reaches ten times the sketch width, so that estimates reflect
+    recent popularity rather than all-time totals."""
+
+    _DEPTH = 4
+    _MAX_COUNT = 15
+    _HALVE = bytes(count >> 1 for count in range(256))
+
+    def __init__(self, capacity, width_factor=8):
+        width = 16
+        while width < capacity * width_factor:
+            width <<= 1
+        self._mask = width - 1
+        self._rows = [bytearray(width) for _ in range(self._DEPTH)]
+        self._sample_size = 10 * capacity
+        self._additions = 0
+
+    def __indexes(self, key):
+        # Double hashing derives the index of each row from two hashes.
+        first = hash(key) & 0xFFFFFFFFFFFFFFFF
+        second = (first * 0x9E3779B97F4A7C15 >> 32) | 1
+        return [(first + i * second) & self._mask for i in range(self._DEPTH)]
+
+    def frequency(self, key):
+        return min(row[index] for row, index in zip(self._rows, self.__indexes(key)))
+
+    def increment(self, key):
+        incremented = False
+        for row, index in zip(self._rows, self.__indexes(key)):
+            if row[index] < self._MAX_COUNT:
+                row[index] += 1
+                incremented = True
+        if incremented:
+            self._additions += 1
+            if self._additions >= self._sample_size:
+                self._rows = [row.translate(self._HALVE) for row in self._rows]
+                self._additions //= 2
+
+    def clear(self):
+        for row in self._rows:
+            row[:] = bytes(len(row))
+        self._additions = 0
+
+
+class TinyLfuCache(IpregistryCache):
+    """In-memory cache with a W-TinyLFU admission policy, resisting scans.
+
+    New entries go to a small LRU window holding a window fraction of
+    maxsize. Entries evicted from the window only enter the main region, a
+    segmented LRU, if their keys were accessed more often than the main
+    region's eviction victim, as estimated by a frequency sketch of recent
+    accesses. Large batches of one-off lookups thus stay in the window and
+    cannot evict the frequently requested entries. Entries expire ttl
+    seconds after being stored, ttl being a number or a TtlPolicy. This cache
+    is not thread-safe.
+    """
+
+    def __init__(self, maxsize=2048, ttl=600, window=0.01):
+        if maxsize < 2:
+            raise ValueError("maxsize must be at least 2")
+        if not 0 < window < 1:
+            raise ValueError("window must be a fraction of maxsize between 0 and 1")
+        self._ttl = ttl
+        self._window_size = max(1, int(maxsize * window))
+        main_size = maxsize - self._window_size
+        self._protected_size = max(1, int(main_size * 0.8))
+        self._main_size = main_size
+        # Each region maps keys to (data, expires_at) tuples, least recently used first.
+        self._window = OrderedDict()
+        self._probation = OrderedDict()
+        self._protected = OrderedDict()
+        self._sketch = _FrequencySketch(maxsize)
+        self.admitted = 0
+        self.rejected = 0
+
+    def get(self, key):
+        self._sketch.increment(key)
+        for region in (self._window, self._protected, self._probation):
+            value = region.get(key)
+            if value is not None:
+                break
+        else:
+            return None
+        if time.monotonic() >= value[1]:
+            del region[key]
+            return None
+        if region is self._probation:
+            del self._probation[key]
+            self._protected[key] = value
+            if len(self._protected) > self._protected_size:
+                demoted, demoted_value = self._protected.popitem(last=False)
+                self._probation[demoted] = demoted_value
+        else:
+            region.move_to_end(key)
+        return value[0]
+
+    def put(self, key, data):
+        self.__store(key, data, _entry_ttl(self._ttl, data))
+
+    def __store(self, key, data, ttl):
+        value = (data, time.monotonic() + ttl)
+        for region in (self._window, self._protected, self._probation):
+            if key in region:
+                region[key] = value
+                region.move_to_end(key)
+                return
+        self._window[key] = value
+        if len(self._window) > self._window_size:
+            self.__admit(*self._window.popitem(last=False))
+
+    def __admit(self, candidate, value):
+        """Move an entry evicted from the window to the main region, if it is
+        more popular than the entry the main region would evict for it."""
+        if len(self._probation) + len(self._protected) < self._main_size:
+            self._probation[candidate] = value
+            return
+        victims = self._probation if self._probation else self._protected
+        victim = next(iter(victims))
+        if self._sketch.frequency(candidate) > self._sketch.frequency(victim):
+            del victims[victim]
+            self._probation[candidate] = value
+            self.admitted += 1
+        else:
+            self.rejected += 1
+
+    def invalidate(self, key):
+        for region in (self._window, self._protected, self._probation):
+            region.pop(key, None)
+
+    def invalidate_all(self):
+        self._window.clear()
+        self._probation.clear()
+        self._protected.clear()
+        self._sketch.clear()
+
+    def _snapshot_records(self):
+        now = time.monotonic()
+        for region in (self._probation, self._protected, self._window):
+            for key, (data, expires_at) in list(region.items()):
+                if expires_at > now:
+                    yield key, _serialize(data), expires_at - now
+
+    def _load_records(self, records):
+        for key, payload, ttl in records:
+            self.__store(key, _deserialize(payload), ttl)
+
+
+class SqliteCache(IpregistryCache):
+    """Persistent cache stored in a SQLite database file.
+
+    Entries survive process restarts and the database can be shared by
+    several processes on the same host: it runs in WAL mode so readers never
+    block on a writer. Writes are buffered in memory and committed in a single
+    transaction once write_batch_size entries are pending, on put_many, or on
+    flush() and close(). Entries written with a different schema version of
+    the cached models are treated as misses. A process forked from one using
+    the cache opens its own connections and leaves the buffered writes of its
+    parent to it.
+    """
+
+    # Maximum number of keys bound to a single SELECT or DELETE statement.
+    _MAX_VARIABLES = 500
+
+    def __init__(self, path, ttl=600, maxsize=None, write_batch_size=32, timeout=5):
+        if sqlite3 is None:
+            raise ImportError("SqliteCache requires the sqlite3 module, which is missing from this Python build.")
+        if write_batch_size < 1:
+            raise ValueError("write_batch_size must be at least 1")
+        self._path = str(path)
+        self._ttl = ttl
+        self._maxsize = maxsize
+        self._write_batch_size = write_batch_size
+        self._timeout = timeout
+        self._schema = _schema_version()
+        self._local = threading.local()
+        self._connections = []
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._inherited_connections = []
+
+        with self.__connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL, schema TEXT NOT NULL"
+                ") WITHOUT ROWID")
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires)")
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def put(self, key, data):
+        self.__check_process()
+        with self._lock:
+            self._pending[key] = (_serialize(data), time.time() + _entry_ttl(self._ttl, data))
+            should_flush = len(self._pending) >= self._write_batch_size
+        if should_flush:
+            self.flush()
+
+    def invalidate(self, key):
+        self.invalidate_many([key])
+
+    def invalidate_all(self):
+        self.__check_process()
+        with self._lock:
+            self._pending.clear()
+        with self.__connection() as connection:
+            connection.execute("DELETE FROM entries")
+
+    def get_many(self, keys):
+        self.__check_process()
+        now = time.time()
+        result = [None] * len(keys)
+        found = {}
+
+        with self._lock:
+            pending = [self._pending.get(key) for key in keys]
+
+        missing = list({key for key, entry in zip(keys, pending) if entry is None})
+        connection = self.__connection()
+        for i in range(0, len(missing), self._MAX_VARIABLES):
+            chunk = missing[i:i + self._MAX_VARIABLES]
+            rows = connection.execute(
+                "SELECT key, value, expires FROM entries WHERE schema = ? AND key IN ({})".format(
+                    ','.join('?' * len(chunk))),
+                [self._schema] + chunk)
+            for key, value, expires in rows:
+                found[key] = (value, expires)
+
+        for i, key in enumerate(keys):
+            entry = pending[i] if pending[i] is not None else found.get(key)
+            if entry is not None and entry[1] > now:
+                result[i] = _deserialize(entry[0])
+
+        return result
+
+    def put_many(self, entries):
+        self.__check_process()
+        now = time.time()
+        serialized = {key: (_serialize(data), now + _entry_ttl(self._ttl, data)) for key, data in entries.items()}
+        with self._lock:
+            self._pending.update(serialized)
+        self.flush()
+
+    def invalidate_many(self, keys):
+        self.__check_process()
+        keys = list(keys)
+        with self._lock:
+            for key in keys:
+                self._pending.pop(key, None)
+        with self.__connection() as connection:
+            for i in range(0, len(keys), self._MAX_VARIABLES):
+                chunk = keys[i:i + self._MAX_VARIABLES]
+                connection.execute(
+                    "DELETE FROM entries WHERE key IN ({})".format(','.join('?' * len(chunk))), chunk)
+
+    def _snapshot_records(self):
+        self.flush()
+        now = time.time()
+        rows = self.__connection().execute(
+            "SELECT key, value, expires FROM entries WHERE schema = ? AND expires > ?", (self._schema, now))
+        for key, value, expires in rows:
+            yield key, value, expires - now
+
+    def _load_records(self, records):
+        self.__check_process()
+        now = time.time()
+        with self._lock:
+            self._pending.update((key, (bytes(payload), now + ttl)) for key, payload, ttl in records)
+        self.flush()
+
+    def flush(self):
+        """Commit buffered writes in a single transaction and purge expired entries."""
+        self.__check_process()
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+        if not pending:
+            return
+
+        with self.__connection() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO entries (key, value, expires, schema) VALUES (?, ?, ?, ?)",
+                [(key, value, expires, self._schema) for key, (value, expires) in pending.items()])
+            connection.execute("DELETE FROM entries WHERE expires <= ?", (time.time(),))
+            if self._maxsize is not None:
+                connection.execute(
+                    "DELETE FROM entries WHERE key IN "
+                    "(SELECT key FROM entries ORDER BY expires LIMIT max(0, (SELECT count(*) FROM entries) - ?))",
+                    (self._maxsize,))
+
+    def close(self):
+        """Flush buffered writes and close the database connections."""
+        self.flush()
+        with self._lock:
+            connections = self._connections
+            self._connections = []
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
+
+    def __check_process(self):
+        """Drop the state inherited from a parent process after a fork.
+
+        SQLite connections must not be used across a fork: inherited ones are
+        kept referenced, so that they are never used nor closed by the garbage
+        collector, and new ones are opened on demand. Buffered writes are
+        committed by the parent, and the lock may have been held by one of
+        its other threads."""
+        if self._pid == os.getpid():
+            return
+        self._lock = threading.Lock()
+        self._inherited_connections.extend(self._connections)
+        self._connections = []
+        self._local = threading.local()
+        self._pending = {}
+        self._pid = os.getpid()
+
+    def __connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=self._timeout, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+
+class SharedMemoryCache(IpregistryCache):
+    """Cache shared by all processes of a host through a memory-mapped file.
+
+    The file holds a fixed-size open-addressing hash table of slots bytes
+    each, so pre-forked workers read a single copy of every entry without a
+    network hop. Place it on a tmpfs such as /dev/shm to keep it in memory
+    only. Lookups take a shared file lock and writes an exclusive one; when a
+    probe window is full, the entry closest to expiration is evicted. Entries
+    whose serialized form does not fit in a slot are not cached. All
+    processes sharing a file must use the same slots and slot_size: a
+    ValueError is raised when the file has another layout, as resizing it
+    would crash the processes mapping it. A file written by a library version
+    with different models is reset instead.
+
+    Requires a POSIX platform providing the fcntl module.
+    """
+
+    _MAGIC = b'IPRSHM01'
+    # magic, slot count, slot size, schema version
+    _HEADER = struct.Struct('<8sII16s')
+    _HEADER_SIZE = 64
+    # key hash, expiration timestamp, key length, value length
+    _SLOT_HEADER = struct.Struct('<QdHI')
+    _PROBE_WINDOW = 8
+
+    def __init__(self, path, ttl=600, slots=65536, slot_size=2048):
+        if fcntl is None:
+            raise ImportError("SharedMemoryCache requires the fcntl module, which is only available on POSIX.")
+        if slots < 1:
+            raise ValueError("slots must be at least 1")
+        if slot_size <= self._SLOT_HEADER.size:
+            raise ValueError("slot_size must be greater than {}".format(self._SLOT_HEADER.size))
+        self._path = str(path)
+        self._ttl = ttl
+        self._slots = slots
+        self._slot_size = slot_size
+        self._size = self._HEADER_SIZE + slots * slot_size
+        self._header = self._HEADER.pack(self._MAGIC, slots, slot_size, _schema_version().encode('ascii'))
+        self._lock = threading.RLock()
+        self._pid = None
+        self._file = None
+        self._map = None
+        self.__attach()
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def put(self, key, data):
+        self.put_many({key: data})
+
+    def invalidate(self, key):
+        self.invalidate_many([key])
+
+    def invalidate_all(self):
+        with self.__locked(fcntl.LOCK_EX) as buffer:
+            buffer[self._HEADER_SIZE:self._size] = bytes(self._size - self._HEADER_SIZE)
+
+    def get_many(self, keys):
+        now = time.time()
+        encoded = [_encode_key(key) for key in keys]
+        values = []
+        with self.__locked(fcntl.LOCK_SH) as buffer:
+            for key in encoded:
+                slot = self.__find(buffer, key, now)
+                values.append(None if slot is None else self.__read_value(buffer, slot, len(key)))
+        return [None if value is None else _deserialize(value) for value in values]
+
+    def put_many(self, entries):
+        now = time.time()
+        self.__write([(_encode_key(key), _serialize(data), now + _entry_ttl(self._ttl, data))
+                      for key, data in entries.items()], now)
+
+    def _snapshot_records(self):
+        now = time.time()
+        records = []
+        with self.__locked(fcntl.LOCK_SH) as buffer:
+            for slot in range(self._slots):
+                offset = self._HEADER_SIZE + slot * self._slot_size
+                slot_hash, expires, key_length, value_length = self._SLOT_HEADER.unpack_from(buffer, offset)
+                if slot_hash != 0 and expires > now:
+                    start = offset + self._SLOT_HEADER.size
+                    records.append((_decode_key(buffer[start:start + key_length]),
+                                    bytes(buffer[start + key_length:start + key_length + value_length]),
+                                    expires - now))
+        return iter(records)
+
+    def _load_records(self, records):
+        now = time.time()
+        self.__write([(_encode_key(key), bytes(payload), now + ttl) for key, payload, ttl in records], now)
+
+    def __write(self, records, now):
+        """Write (encoded key, serialized value, expiration) records, skipping
+        those that do not fit in a slot."""
+        records = [record for record in records
+                   if self._SLOT_HEADER.size + len(record[0]) + len(record[1]) <= self._slot_size]
+        with self.__locked(fcntl.LOCK_EX) as buffer:
+            for key, value, expires in records:
+                key_hash = self.__hash(key)
+                offset = self.__select_slot(buffer, key, key_hash, now)
+                self._SLOT_HEADER.pack_into(buffer, offset, key_hash, expires, len(key), len(value))
+                start = offset + self._SLOT_HEADER.size
+                buffer[start:start + len(key) + len(value)] = key + value
+
+    def invalidate_many(self, keys):
+        encoded = [_encode_key(key) for key in keys]
+        with self.__locked(fcntl.LOCK_EX) as buffer:
+            for key in encoded:
+                offset = self.__find(buffer, key, None)
+                if offset is not None:
+                    self._SLOT_HEADER.pack_into(buffer, offset, 0, 0.0, 0, 0)
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._file.close()
+                self._map = None
+                self._file = None
+                self._pid = None
+
+    def __attach(self):
+        """Map the backing file, initializing it when it is new or holds
+        entries of another schema version. Called again after a fork, since
+        children sharing the parent's file description would also share its
+        file locks."""
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+        file = os.fdopen(fd, 'r+b')
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                size = os.fstat(fd).st_size
+                file.seek(0)
+                header = file.read(self._HEADER.size)
+                if size != 0 and size != self._size:
+                    raise ValueError("{} holds a shared memory cache of {} bytes, not {}: use the same slots and "
+                                     "slot_size in all processes.".format(self._path, size, self._size))
+                if len(header) == self._HEADER.size:
+                    magic, slots, slot_size, _ = self._HEADER.unpack(header)
+                    if magic == self._MAGIC and (slots, slot_size) != (self._slots, self._slot_size):
+                        raise ValueError("{} holds a shared memory cache of {} slots of {} bytes: use the same "
+                                         "slots and slot_size in all processes.".format(self._path, slots, slot_size))
+                if header != self._header:
+                    # The size is unchanged, so processes mapping the file
+                    # only see its entries cleared.
+                    file.truncate(0)
+                    file.truncate(self._size)
+                    file.seek(0)
+                    file.write(self._header)
+                    file.flush()
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+            self._map = mmap.mmap(file.fileno(), self._size)
+        except BaseException:
+            file.close()
+            raise
+        self._file = file
+        self._pid = os.getpid()
+
+    @contextlib.contextmanager
+    def __locked(self, operation):
+        with self._lock:
+            if self._pid != os.getpid():
+                if self._map is not None:
+                    self._map.close()
+                    self._file.close()
+                self.__attach()
+            fcntl.flock(self._file, operation)
+            try:
+                yield self._map
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def __find(self, buffer, key, now):
+        """Return the offset of the slot holding key, or None when the key is
+        missing or, if now is given, expired."""
+        key_hash = self.__hash(key)
+        for offset in self.__probe(key_hash):
+            slot_hash, expires, key_length, _ = self._SLOT_HEADER.unpack_from(buffer, offset)
+            if slot_hash == key_hash and key_length == len(key):
+                start = offset + self._SLOT_HEADER.size
+                if buffer[start:start + key_length] == key:
+                    return offset if now is None or expires > now else None
+        return None
+
+    def __select_slot(self, buffer, key, key_hash, now):
+        """Return the slot to write key to: its current slot, else the first
+        free or expired one, else the one closest to expiration."""
+        candidate = None
+        candidate_expires = None
+        for offset in self.__probe(key_hash):
+            slot_hash, expires, key_length, _ = self._SLOT_HEADER.unpack_from(buffer, offset)
+            if slot_hash == key_hash and key_length == len(key):
+                start = offset + self._SLOT_HEADER.size
+                if buffer[start:start + key_length] == key:
+                    return offset
+            if expires <= now:
+                expires = 0.0
+            if candidate is None or expires < candidate_expires:
+                candidate = offset
+                candidate_expires = expires
+        return candidate
+
+    def __probe(self, key_hash):
+        index = key_hash % self._slots
+        for i in range(min(self._PROBE_WINDOW, self._slots)):
+            yield self._HEADER_SIZE + ((index + i) % self._slots) * self._slot_size
+
+    def __read_value(self, buffer, offset, key_length):
+        _, _, _, value_length = self._SLOT_HEADER.unpack_from(buffer, offset)
+        start = offset + self._SLOT_HEADER.size + key_length
+        return bytes(buffer[start:start + value_length])
+
+    @staticmethod
+    def __hash(key):
+        # Python's hash() is randomized per process, so it cannot be shared.
+        # Zero marks an empty slot.
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little') or 1
+
+
+# IpInfo fields describing a whole announced prefix, shared by PrefixCache by default.
+DEFAULT_PREFIX_SHARED_FIELDS = ('carrier', 'company', 'connection', 'currency', 'location', 'time_zone')
+
+# Security flags describing a network rather than the host using an address.
+_NETWORK_SECURITY_FLAGS = ('is_bogon', 'is_cloud_provider', 'is_relay')
+
+
+class PrefixCache(IpregistryCache):
+    """Cache wrapper answering IP lookups missed by the wrapped cache from a
+    cached IpInfo of another address in the same announced prefix.
+
+    Cached IpInfo entries are indexed by their connection.route, separately
+    for each set of lookup options, as long as the route is at least
+    min_ipv4_prefixlen or min_ipv6_prefixlen bits long. A missed address is
+    matched against the longest indexed route containing it and answered with
+    the shared_fields of that entry, its ip re-stamped. Other fields, such as
+    hostname, are left empty. security_policy chooses what is shared of
+    security: 'exclude' nothing, 'network' only the flags describing the
+    network (is_bogon, is_cloud_provider and is_relay) and 'include'
+    everything. The index holds up to max_prefixes routes and entries evicted
+    from the wrapped cache are no longer used. Keys are those built by the
+    clients, which start with the packed address of IP lookups.
+    """
+
+    _SECURITY_POLICIES = ('exclude', 'include', 'network')
+
+    def __init__(self, cache, shared_fields=DEFAULT_PREFIX_SHARED_FIELDS, security_policy='exclude',
+                 min_ipv4_prefixlen=16, min_ipv6_prefixlen=32, max_prefixes=65536):
+        if not isinstance(cache, IpregistryCache):
+            raise ValueError("Given cache instance is not of type IpregistryCache")
+        unknown = set(shared_fields) - (set(IpInfo.model_fields) - {'hostname', 'ip', 'security'})
+        if unknown:
+            raise ValueError("Fields cannot be shared across a prefix: {}".format(', '.join(sorted(unknown))))
+        if security_policy not in self._SECURITY_POLICIES:
+            raise ValueError("security_policy must be one of {}".format(', '.join(self._SECURITY_POLICIES)))
+        if max_prefixes < 1:
+            raise ValueError("max_prefixes must be at least 1")
+        self._cache = cache
+        self._shared_fields = tuple(shared_fields)
+        self._security_policy = security_policy
+        self._min_prefixlens = {b'4': min_ipv4_prefixlen, b'6': min_ipv6_prefixlen}
+        self._max_prefixes = max_prefixes
+        # Maps (tag, suffix, prefixlen, network) to the key of the indexed entry,
+        # and the other way around.
+        self._routes = OrderedDict()
+        self._indexed = {}
+        # Maps (tag, suffix) to the indexed prefix lengths, longest first.
+        self._prefixlens = {}
+        self._lock = threading.Lock()
+        self.prefix_hits = 0
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        keys = list(keys)
+        result = list(self._cache.get_many(keys))
+        misses = [i for i in range(len(keys)) if result[i] is None and self.__parse(keys[i]) is not None]
+        if not misses:
+            return result
+        sources = {}
+        with self._lock:
+            for i in misses:
+                source_key = self.__match(*self.__parse(keys[i]))
+                if source_key is not None:
+                    sources.setdefault(source_key, []).append(i)
+        if not sources:
+            return result
+        source_keys = list(sources)
+        hits = 0
+        for source_key, source in zip(source_keys, self._cache.get_many(source_keys)):
+            if not isinstance(source, IpInfo):
+                self.__unindex(source_key)
+                continue
+            for i in sources[source_key]:
+                result[i] = self.__share(source, keys[i])
+                hits += 1
+        with self._lock:
+            self.prefix_hits += hits
+        return result
+
+    def put(self, key, data):
+        self.put_many({key: data})
+
+    def put_many(self, entries):
+        self._cache.put_many(entries)
+        with self._lock:
+            for key, data in entries.items():
+                if isinstance(data, IpInfo) and data.connection is not None and data.connection.route:
+                    self.__index(key, data.connection.route)
+
+    def invalidate(self, key):
+        self.invalidate_many([key])
+
+    def invalidate_many(self, keys):
+        keys = list(keys)
+        self._cache.invalidate_many(keys)
+        for key in keys:
+            self.__unindex(key)
+
+    def invalidate_all(self):
+        self._cache.invalidate_all()
+        with self._lock:
+            self._routes.clear()
+            self._indexed.clear()
+            self._prefixlens.clear()
+
+    def keys_to_refresh(self, keys):
+        return self._cache.keys_to_refresh(keys)
+
+    def _snapshot_records(self):
+        return self._cache._snapshot_records()
+
+    def _load_records(self, records):
+        self._cache._load_records(records)
+        with self._lock:
+            for key, payload, _ in records:
+                if self.__parse(key) is None:
+                    continue
+                data = _deserialize(payload)
+                if isinstance(data, IpInfo) and data.connection is not None and data.connection.route:
+                    self.__index(key, data.connection.route)
+
+    @staticmethod
+    def __parse(key):
+        """Return the family tag, address as an integer and options suffix
+        of an IP lookup key, or None for other keys."""
+        if not isinstance(key, bytes) or not key:
+            return None
+        tag = key[:1]
+        length = 4 if tag == b'4' else 16 if tag == b'6' else 0
+        if length == 0 or len(key) < 1 + length or (len(key) > 1 + length and key[1 + length] != 0):
+            return None
+        return tag, int.from_bytes(key[1:1 + length], 'big'), key[1 + length:]
+
+    def __index(self, key, route):
+        parsed = self.__parse(key)
+        if parsed is None:
+            return
+        tag, address, suffix = parsed
+        try:
+            network = ipaddress.ip_network(route, strict=False)
+        except ValueError:
+            return
+        bits = 32 if tag == b'4' else 128
+        if network.max_prefixlen != bits or network.prefixlen < self._min_prefixlens[tag]:
+            return
+        shift = bits - network.prefixlen
+        if address >> shift != int(network.network_address) >> shift:
+            return
+        route_key = (tag, suffix, network.prefixlen, address >> shift)
+        self.__remove(key)
+        self.__remove(self._routes.get(route_key))
+        self._routes[route_key] = key
+        self._indexed[key] = route_key
+        prefixlens = self._prefixlens.setdefault((tag, suffix), [])
+        if network.prefixlen not in prefixlens:
+            prefixlens.append(network.prefixlen)
+            prefixlens.sort(reverse=True)
+        while len(self._routes) > self._max_prefixes:
+            self.__remove(next(iter(self._routes.values())))
+
+    def __unindex(self, key):
+        with self._lock:
+            self.__remove(key)
+
+    def __remove(self, key):
+        route_key = self._indexed.pop(key, None)
+        if route_key is not None:
+            del self._routes[route_key]
+
+    def __match(self, tag, address, suffix):
+        """Return the key of the entry indexed under the longest route containing an address."""
+        bits = 32 if tag == b'4' else 128
+        for prefixlen in self._prefixlens.get((tag, suffix), ()):
+            key = self._routes.get((tag, suffix, prefixlen, address >> (bits - prefixlen)))
+            if key is not None:
+                return key
+        return None
+
+    def __share(self, source, key):
+        packed = key[1:5] if key[:1] == b'4' else key[1:17]
+        family = socket.AF_INET if len(packed) == 4 else socket.AF_INET6
+        shared = {name: getattr(source, name) for name in self._shared_fields}
+        if self._security_policy == 'include':
+            shared['security'] = source.security
+        elif self._security_policy == 'network' and source.security is not None:
+            shared['security'] = Security(**{flag: getattr(source.security, flag) for flag in _NETWORK_SECURITY_FLAGS})
+        return type(source)(ip=socket.inet_ntop(family, packed), type=source.type, **shared)
+
+
+class CacheTierStatistics:
+    """Counters of the lookups served by one tier of a TieredCache.
+
+    hits and misses count keys found or not in the tier, which is only read
+    for the keys missed by the tiers before it. total_latency is the time
+    spent reading the tier, over reads calls.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.reads = 0
+        self.total_latency = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    @property
+    def average_latency(self) -> float:
+        """Average number of seconds a read of the tier took."""
+        return self.total_latency / self.reads if self.reads > 0 else 0.0
+
+    def record(self, hits, misses, latency):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            self.reads += 1
+            self.total_latency += latency
+
+    def __str__(self):
+        fields = ', '.join(f"{key}={value}" for key, value in self.__dict__.items() if not key.startswith('_'))
+        return (f"{self.__class__.__name__}({fields}, hit_rate={self.hit_rate:.3f}, "
+                f"average_latency={self.average_latency:.6f})")
+
+
+class TieredCache(IpregistryCache):
+    """Cache composed of tiers, from the fastest and smallest to the slowest
+    and largest, for instance an InMemoryCache in front of a SqliteCache.
+
+    Lookups read the tiers in order, each one only for the keys the previous
+    tiers missed, and entries found in a tier are promoted into the tiers
+    before it. Bulk operations are applied to each tier with one bulk call.
+    Writes go through every tier, or with write_behind only to the first
+    tier right away: the other tiers receive them in batches of
+    write_batch_size entries, or on flush() and close(). Per-tier counters
+    are exposed as statistics.
+    """
+
+    def __init__(self, tiers, write_behind=False, write_batch_size=64):
+        tiers = list(tiers)
+        if not tiers:
+            raise ValueError("at least one tier is required")
+        if not all(isinstance(tier, IpregistryCache) for tier in tiers):
+            raise ValueError("Given tier instance is not of type IpregistryCache")
+        if write_batch_size < 1:
+            raise ValueError("write_batch_size must be at least 1")
+        self._tiers = tiers
+        self._write_behind = write_behind
+        self._write_batch_size = write_batch_size
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._statistics = [CacheTierStatistics() for _ in tiers]
+
+    @property
+    def tiers(self):
+        return list(self._tiers)
+
+    @property
+    def statistics(self):
+        """CacheTierStatistics of each tier, in order."""
+        return list(self._statistics)
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        keys = list(keys)
+        result = [None] * len(keys)
+        misses = list(range(len(keys)))
+        for index, (tier, statistics) in enumerate(zip(self._tiers, self._statistics)):
+            if index == 1 and self._write_behind:
+                misses = self.__get_pending(keys, misses, result)
+            if not misses:
+                break
+            start = time.perf_counter()
+            values = tier.get_many([keys[position] for position in misses])
+            latency = time.perf_counter() - start
+            remaining = []
+            promoted = {}
+            for position, value in zip(misses, values):
+                if value is None:
+                    remaining.append(position)
+                else:
+                    result[position] = value
+                    promoted[keys[position]] = value
+            statistics.record(len(promoted), len(remaining), latency)
+            if promoted:
+                for upper in self._tiers[:index]:
+                    upper.put_many(promoted)
+            misses = remaining
+        return result
+
+    def __get_pending(self, keys, misses, result):
+        """Fill the misses of the first tier with entries not written behind yet."""
+        with self._lock:
+            if not self._pending:
+                return misses
+            remaining = []
+            for position in misses:
+                value = self._pending.get(keys[position])
+                if value is None:
+                    remaining.append(position)
+                else:
+                    result[position] = value
+            return remaining
+
+    def put(self, key, data):
+        self.put_many({key: data})
+
+    def put_many(self, entries):
+        if not self._write_behind:
+            for tier in self._tiers:
+                tier.put_many(entries)
+            return
+        self._tiers[0].put_many(entries)
+        with self._lock:
+            self._pending.update(entries)
+            should_flush = len(self._pending) >= self._write_batch_size
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        """Write the entries buffered by write_behind to the tiers after the first."""
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+        if pending:
+            for tier in self._tiers[1:]:
+                tier.put_many(pending)
+
+    def close(self):
+        """Flush buffered entries, then close the tiers that can be closed."""
+        self.flush()
+        for tier in self._tiers:
+            close = getattr(tier, 'close', None)
+            if callable(close):
+                close()
+
+    def invalidate(self, key):
+        self.invalidate_many([key])
+
+    def invalidate_many(self, keys):
+        keys = list(keys)
+        with self._lock:
+            for key in keys:
+                self._pending.pop(key, None)
+        for tier in self._tiers:
+            try:
+                tier.invalidate_many(keys)
+            except KeyError:
+                # Some backends reject keys they do not hold, which any tier may miss.
+                for key in keys:
+                    with contextlib.suppress(KeyError):
+                        tier.invalidate(key)
+
+    def invalidate_all(self):
+        with self._lock:
+            self._pending.clear()
+        for tier in self._tiers:
+            tier.invalidate_all()
+
+    def keys_to_refresh(self, keys):
+        # Entries are served from the first tier, where hits are promoted.
+        return self._tiers[0].keys_to_refresh(keys)
+
+    def _snapshot_records(self):
+        # Every write reaches the last tier, the largest one, once flushed.
+        self.flush()
+        return self._tiers[-1]._snapshot_records()
+
+    def _load_records(self, records):
+        for tier in self._tiers:
+            tier._load_records(records)
+
 
 class NoCache(IpregistryCache):
     def __init__(self, maxsize=2048, ttl=86400):
@@ -71,3 +1513,15 @@ class NoCache(IpregistryCache):
 
     def invalidate_all(self):
         pass
+
+    def get_many(self, keys):
+        return [None] * len(keys)
+
+    def put_many(self, entries):
+        pass
+
+    def _snapshot_records(self):
+        return iter(())
+
+    def _load_records(self, records):
+        pass
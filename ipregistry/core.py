@@ -13,28 +13,258 @@
     See the License for the specific language governing permissions and
     limitations under the License.
 """
-from concurrent.futures import ThreadPoolExecutor
+import datetime
+import functools
+import itertools
+import socket
+import threading
+import time
+import zoneinfo
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, CancelledError, Executor, Future, ThreadPoolExecutor, wait
+
+from pydantic import BaseModel
 
 from .cache import IpregistryCache, NoCache
 from .json import AutonomousSystem, IpInfo
-from .model import (ApiResponse, ApiResponseCredits, ApiResponseThrottling, ClientError,
-                    IpregistryLookupError)
+from .limits import AdaptiveBatchTuner
+from .model import (ApiError, ApiResponse, ApiResponseBatching, ApiResponseCredits, ApiResponseThrottling,
+                    ClientError, ClientStatistics, ErrorCode, IpregistryLookupError)
 from .request import DefaultRequestHandler, IpregistryRequestHandler
+from .util import IpAddresses
 
 MAX_BATCH_SIZE = 1024
 
+# Lookup errors that depend only on the looked up item, negatively cached by default.
+DEFAULT_NEGATIVE_CACHE_CODES = frozenset({
+    ErrorCode.INVALID_ASN,
+    ErrorCode.INVALID_IP_ADDRESS,
+    ErrorCode.RESERVED_ASN,
+    ErrorCode.RESERVED_IP_ADDRESS,
+    ErrorCode.UNKNOWN_ASN,
+})
+
+# Errors that are transient or depend on the account rather than the item.
+_UNCACHEABLE_ERROR_CODES = frozenset({
+    ErrorCode.DISABLED_API_KEY,
+    ErrorCode.FORBIDDEN_IP,
+    ErrorCode.FORBIDDEN_IP_ORIGIN,
+    ErrorCode.FORBIDDEN_ORIGIN,
+    ErrorCode.INSUFFICIENT_CREDITS,
+    ErrorCode.INTERNAL,
+    ErrorCode.INVALID_API_KEY,
+    ErrorCode.MISSING_API_KEY,
+    ErrorCode.TOO_MANY_REQUESTS,
+})
+
 
-def _build_cache_key(key, options):
-    result = key
+# Interned canonical forms of the option sets seen so far, bounded in case
+# option values vary freely.
+_OPTIONS_SIGNATURES = {}
+_MAX_OPTIONS_SIGNATURES = 1024
 
-    for option_key, value in sorted(options.items()):
+
+def _options_signature(options):
+    """Return the canonical text and cache key suffix of an option set.
+
+    Options are sorted, booleans are written as true or false and the values
+    of fields are deduplicated and sorted, so that equivalent option sets
+    share the same precomputed suffix."""
+    if not options:
+        return '', b''
+    try:
+        # Value types are part of the key: True and 1 are equal, but are sent
+        # as hostname=true and hostname=1.
+        signature = tuple(sorted((name, type(value), value) for name, value in options.items()))
+        return _OPTIONS_SIGNATURES[signature]
+    except KeyError:
+        pass
+    except TypeError:
+        # Unhashable or unorderable option values cannot be interned.
+        signature = None
+
+    parts = []
+    for name, value in sorted(options.items(), key=lambda option: option[0]):
         if isinstance(value, bool):
             value = 'true' if value is True else 'false'
-        result += ';' + option_key + '=' + str(value)
-
+        elif name == 'fields':
+            value = ','.join(sorted(_parse_fields(value)))
+        parts.append(name + '=' + str(value))
+    text = ';'.join(parts)
+    result = text, b'\x00' + text.encode('utf-8')
+    if signature is not None and len(_OPTIONS_SIGNATURES) < _MAX_OPTIONS_SIGNATURES:
+        _OPTIONS_SIGNATURES[signature] = result
     return result
 
 
+def _parse_fields(value):
+    """Return the set of field paths selected by a fields option."""
+    return {field.strip() for field in str(value).split(',') if field.strip()}
+
+
+def _is_enabled(value):
+    return value is True or str(value).lower() == 'true'
+
+
+def _covers(cached_options, options):
+    """Tell whether an entry cached with cached_options holds everything a
+    lookup with options returns: every other option is the same, the cached
+    fields select a superset of the requested ones, or all of them, and the
+    hostname is resolved if requested."""
+    if _is_enabled(options.get('hostname')) and not _is_enabled(cached_options.get('hostname')):
+        return False
+    others = {name: value for name, value in options.items() if name not in ('fields', 'hostname')}
+    cached_others = {name: value for name, value in cached_options.items() if name not in ('fields', 'hostname')}
+    if _options_signature(others)[0] != _options_signature(cached_others)[0]:
+        return False
+    if 'fields' not in cached_options:
+        return True
+    if 'fields' not in options:
+        return False
+    cached_fields = _parse_fields(cached_options['fields'])
+    return all(any(field == cached or field.startswith(cached + '.') for cached in cached_fields)
+               for field in _parse_fields(options['fields']))
+
+
+def _select_fields(data, tree):
+    """Keep the fields of a dumped model selected by a tree of field names,
+    where None selects a whole field; lists are projected item by item."""
+    if isinstance(data, list):
+        return [_select_fields(item, tree) for item in data]
+    if not isinstance(data, dict):
+        return data
+    selected = {}
+    for name, subtree in tree.items():
+        if name in data:
+            selected[name] = data[name] if subtree is None else _select_fields(data[name], subtree)
+    return selected
+
+
+def _project(value, cached_options, options):
+    """Project an entry cached with covering options onto what a lookup with
+    options returns, or return None if it is not a model."""
+    if not isinstance(value, BaseModel):
+        return None
+    data = value.model_dump()
+    if 'fields' in options:
+        tree = {}
+        for field in sorted(_parse_fields(options['fields'])):
+            node = tree
+            names = field.split('.')
+            for name in names[:-1]:
+                if node.get(name, {}) is None:
+                    break
+                node = node.setdefault(name, {})
+            else:
+                node[names[-1]] = None
+        data = _select_fields(data, tree)
+    if not _is_enabled(options.get('hostname')) and _is_enabled(cached_options.get('hostname')):
+        data.pop('hostname', None)
+    return type(value).model_validate(data)
+
+
+class _CachedOptions:
+    """Bounded record of the option sets entries were cached with, by kind,
+    used to find the cached entries covering a lookup with other options."""
+
+    def __init__(self, limit=64):
+        self._options = {}
+        self._covering = {}
+        self._limit = limit
+
+    def add(self, kind, options):
+        key = (kind, _options_signature(options)[0])
+        if key not in self._options and len(self._options) < self._limit:
+            self._options[key] = dict(options)
+            self._covering = {}
+
+    def covering(self, kind, options):
+        """Return the recorded option sets, other than options, covering options."""
+        key = (kind, _options_signature(options)[0])
+        covering = self._covering.get(key)
+        if covering is None:
+            covering = [cached for (cached_kind, text), cached in list(self._options.items())
+                        if cached_kind == kind and text != key[1] and _covers(cached, options)]
+            self._covering[key] = covering
+        return covering
+
+
+def _ip_key(ip, suffix):
+    """Key an IP by its packed address, so that every notation of an address
+    maps to the same compact key; unparseable values are keyed by their text."""
+    try:
+        if ':' in ip:
+            return b'6' + socket.inet_pton(socket.AF_INET6, ip) + suffix
+        return b'4' + socket.inet_pton(socket.AF_INET, ip) + suffix
+    except (OSError, TypeError, ValueError):
+        return b'i' + str(ip).encode('utf-8') + suffix
+
+
+def _asn_key(asn, suffix):
+    """Key an ASN by its number, so that 15169, '15169' and 'AS15169' match."""
+    text = str(asn).strip().upper()
+    if text.startswith('AS'):
+        text = text[2:]
+    if text.isdigit():
+        return b'a' + str(int(text)).encode('ascii') + suffix
+    return b'k' + str(asn).encode('utf-8') + suffix
+
+
+def _user_agent_key(user_agent, suffix):
+    return b'u' + str(user_agent).encode('utf-8') + suffix
+
+
+def _item_key(item, suffix):
+    return b'k' + str(item).encode('utf-8') + suffix
+
+
+# Cache key builders by kind of looked up item.
+_KEY_BUILDERS = {'ip': _ip_key, 'asn': _asn_key, 'user_agent': _user_agent_key}
+
+
+def _build_cache_key(kind, key, options):
+    """Return the canonical, compact cache key of an item of the given kind."""
+    return _KEY_BUILDERS.get(kind, _item_key)(key, _options_signature(options)[1])
+
+
+def _build_cache_keys(kind, items, options):
+    """Return the cache keys of a batch of items sharing the same options."""
+    suffix = _options_signature(options)[1]
+    if kind == 'ip':
+        return _build_ip_keys(items, suffix)
+    build = _KEY_BUILDERS.get(kind, _item_key)
+    return [build(item, suffix) for item in items]
+
+
+def _build_ip_keys(ips, suffix):
+    # Inlined version of _ip_key for whole batches, which mostly hold valid IPs.
+    inet_pton = socket.inet_pton
+    af_inet = socket.AF_INET
+    af_inet6 = socket.AF_INET6
+    keys = []
+    append = keys.append
+    for ip in ips:
+        try:
+            if ':' in ip:
+                append(b'6' + inet_pton(af_inet6, ip) + suffix)
+            else:
+                append(b'4' + inet_pton(af_inet, ip) + suffix)
+        except (OSError, TypeError, ValueError):
+            append(_ip_key(ip, suffix))
+    return keys
+
+
+def _request_kind(request_handler, request_handler_func):
+    """Return the kind of items a batch request handler function looks up."""
+    if request_handler_func == request_handler.batch_lookup_ips:
+        return 'ip'
+    if request_handler_func == request_handler.batch_lookup_asns:
+        return 'asn'
+    if request_handler_func == request_handler.batch_parse_user_agents:
+        return 'user_agent'
+    return None
+
+
 def _is_number(value):
     try:
         int(str(value))
@@ -43,6 +273,185 @@ def _is_number(value):
         return False
 
 
+def _iter_chunks(items, size):
+    """Lazily split any iterable into lists of at most size items."""
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _with_current_time(value, now=None):
+    """Return a cached IpInfo with the clock of its time zone brought up to
+    date: current_time, offset, in_daylight_saving and abbreviation are
+    computed from time_zone.id with zoneinfo, or only current_time from
+    time_zone.offset if the zone is unknown. Other values are returned as is
+    and the cached value is never modified."""
+    time_zone = getattr(value, 'time_zone', None)
+    if not isinstance(value, IpInfo) or time_zone is None or time_zone.current_time is None:
+        return value
+    now = now if now is not None else datetime.datetime.now(datetime.timezone.utc)
+    update = {}
+    try:
+        local = now.astimezone(_zone_info(time_zone.id))
+        update['offset'] = int(local.utcoffset().total_seconds())
+        update['in_daylight_saving'] = bool(local.dst())
+        update['abbreviation'] = local.tzname()
+    except (zoneinfo.ZoneInfoNotFoundError, TypeError, ValueError):
+        if time_zone.offset is None:
+            return value
+        local = now.astimezone(datetime.timezone(datetime.timedelta(seconds=time_zone.offset)))
+    update['current_time'] = local.replace(microsecond=0).isoformat()
+    return value.model_copy(update={'time_zone': time_zone.model_copy(update=update)})
+
+
+@functools.lru_cache(maxsize=256)
+def _zone_info(zone_id):
+    return zoneinfo.ZoneInfo(zone_id)
+
+
+def _as_lookup_error(error):
+    """Convert an ApiError raised by a single lookup into the per-entry error
+    type returned by batch lookups."""
+    if isinstance(error, IpregistryLookupError):
+        return error
+    return IpregistryLookupError({'code': error.code, 'message': error.message, 'resolution': error.resolution})
+
+
+_LOCAL_ERROR_MESSAGES = {
+    ErrorCode.INVALID_IP_ADDRESS: ("You entered an invalid IP address.",
+                                   "Check the IP address you entered and try again."),
+    ErrorCode.RESERVED_IP_ADDRESS: ("You entered a reserved IP address.",
+                                    "Reserved IP addresses have no public data, look up a public IP address."),
+}
+
+
+def _local_lookup_error(ip):
+    """Return the IpregistryLookupError the API would answer for a malformed or
+    reserved IP address, or None if the address must be looked up. The empty
+    string stands for the origin IP and is always looked up."""
+    if ip == '':
+        return None
+    code = IpAddresses.classify(ip)
+    if code is None:
+        return None
+    message, resolution = _LOCAL_ERROR_MESSAGES[code]
+    return IpregistryLookupError({'code': code.value, 'message': message, 'resolution': resolution})
+
+
+class _NegativeCache:
+    """Cache of deterministic lookup errors, stored as their JSON payload in a
+    dedicated cache backend so that they get their own TTL and size limit.
+
+    Only errors whose code is among the configured ones are stored; transient
+    and account-level errors are rejected from the configuration."""
+
+    def __init__(self, cache=None, codes=DEFAULT_NEGATIVE_CACHE_CODES):
+        if cache is not None and not isinstance(cache, IpregistryCache):
+            raise ValueError("Given negative cache instance is not of type IpregistryCache")
+        self._cache = cache
+        self._codes = frozenset(ErrorCode(code) for code in codes)
+        uncacheable = self._codes & _UNCACHEABLE_ERROR_CODES
+        if uncacheable:
+            raise ValueError("Error codes cannot be negatively cached: {}".format(
+                ', '.join(sorted(code.value for code in uncacheable))))
+
+    def get(self, key):
+        """Return the cached error payload for key, or None."""
+        return None if self._cache is None else self._cache.get(key)
+
+    def get_many(self, keys):
+        """Return the cached IpregistryLookupError for each key, or None."""
+        if self._cache is None or not keys:
+            return [None] * len(keys)
+        return [None if value is None else IpregistryLookupError(value) for value in self._cache.get_many(keys)]
+
+    def put(self, key, error):
+        self.put_many({key: error})
+
+    def put_many(self, errors):
+        """Store the cacheable ApiError instances of the given mapping from cache key."""
+        if self._cache is None:
+            return
+        entries = {key: {'code': error.code, 'message': error.message, 'resolution': error.resolution}
+                   for key, error in errors.items() if error.error_code in self._codes}
+        if entries:
+            self._cache.put_many(entries)
+
+
+def _put_quietly(cache, entries):
+    """Store entries with put_many and return whether it succeeded.
+
+    Cache writes are best-effort: a backend failing to store a result, such
+    as a locked SQLite database, must not fail the lookup that fetched it."""
+    if not entries:
+        return True
+    try:
+        cache.put_many(entries)
+    except Exception:
+        return False
+    return True
+
+
+class _InFlightRequests:
+    """Table of outstanding API requests keyed by cache key.
+
+    The first caller joining a key becomes its leader and must resolve it
+    once its request completes; callers joining the same key meanwhile get
+    the leader's future and wait on it instead of issuing a duplicate
+    request. The future factory lets the asyncio client use asyncio futures.
+    """
+
+    def __init__(self, future_factory=Future):
+        self._future_factory = future_factory
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        """Return the future for key and whether the caller leads its request."""
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None:
+                return future, False
+            future = self._future_factory()
+            self._futures[key] = future
+            return future, True
+
+    def resolve(self, key, result=None, exception=None):
+        with self._lock:
+            future = self._futures.pop(key)
+        if future.done():
+            return
+        if exception is None:
+            future.set_result(result)
+        else:
+            future.set_exception(exception)
+            # Mark the exception as retrieved: nobody may be waiting for it.
+            future.exception()
+
+
+class _PendingBatch:
+    """Batch whose cached values have been read and whose misses remain to be
+    requested: requested holds the positions of the misses the batch leads the
+    request of, duplicates their repeated occurrences and waiting those already
+    requested by a concurrent lookup."""
+
+    def __init__(self, kind, items, cache_keys, result, short_circuited, projected):
+        self.kind = kind
+        self.items = items
+        self.cache_keys = cache_keys
+        self.result = result
+        self.short_circuited = short_circuited
+        self.projected = projected
+        self.flights = {}
+        self.requested = []
+        self.duplicates = []
+        self.waiting = []
+        self.future = None
+
+
 def _merge_batch_responses(responses):
     """Merge chunked batch responses, preserving chunk order and combining
     credits and throttling metadata."""
@@ -67,23 +476,87 @@ def _merge_batch_responses(responses):
     )
 
 
+def _batch_tuner_key(request_handler_func, options):
+    """Key batch tuners by request kind and options, as the right chunk size
+    depends on the payload, e.g. a full IpInfo versus a fields subset."""
+    name = getattr(request_handler_func, '__name__', repr(request_handler_func))
+    signature = _options_signature(options)[0]
+    return name + ';' + signature if signature else name
+
+
+def _fixed_batching(items, max_batch_size, batch_concurrency):
+    chunks = -(-len(items) // max_batch_size)
+    return ApiResponseBatching(min(len(items), max_batch_size), min(batch_concurrency, chunks), chunks)
+
+
 class IpregistryClient:
     def __init__(self, key_or_config, **kwargs):
         self._config = key_or_config if isinstance(key_or_config, IpregistryConfig) else IpregistryConfig(key_or_config)
         self._cache = kwargs["cache"] if "cache" in kwargs else NoCache()
+        self._negative_cache = _NegativeCache(
+            kwargs.get("negative_cache"), kwargs.get("negative_cache_codes", DEFAULT_NEGATIVE_CACHE_CODES))
         self._requestHandler = kwargs["requestHandler"] if "requestHandler" in kwargs \
             else DefaultRequestHandler(self._config, session=kwargs.get("session"))
         self._max_batch_size = min(int(kwargs.get("max_batch_size", MAX_BATCH_SIZE)), MAX_BATCH_SIZE)
         self._batch_concurrency = max(int(kwargs.get("batch_concurrency", 4)), 1)
+        self._max_workers = int(kwargs.get("max_workers", 16))
+        self._executor = kwargs.get("executor")
+        self._owns_executor = self._executor is None
+        self._executor_lock = threading.Lock()
+        self._closed = False
+        self._worker_state = threading.local()
+        self._adaptive_batching = bool(kwargs.get("adaptive_batching", False))
+        self._batch_tuners = {}
+        self._local_ip_validation = bool(kwargs.get("local_ip_validation", False))
+        self._cached_options = _CachedOptions()
+        self._statistics = ClientStatistics()
+        self._in_flight = _InFlightRequests()
+        self._refreshed = {}
+        self._refreshed_lock = threading.Lock()
 
         if self._max_batch_size < 1:
             raise ValueError("max_batch_size must be at least 1")
+        if self._max_workers < 1:
+            raise ValueError("max_workers must be at least 1")
+        if self._executor is not None and not isinstance(self._executor, Executor):
+            raise ValueError("Given executor instance is not of type concurrent.futures.Executor")
         if not isinstance(self._cache, IpregistryCache):
             raise ValueError("Given cache instance is not of type IpregistryCache")
         if not isinstance(self._requestHandler, IpregistryRequestHandler):
             raise ValueError("Given request handler instance is not of type IpregistryRequestHandler")
 
+    @property
+    def statistics(self):
+        """Counters of cache hits, misses and lookups served without an API request."""
+        return self._statistics
+
+    @property
+    def concurrency_limiter(self):
+        """The limiter bounding API requests in flight, exposing its occupancy and wait
+        times, or None if the request handler does not provide one."""
+        return getattr(self._requestHandler, 'concurrency_limiter', None)
+
+    @property
+    def rate_limiter(self):
+        """The adaptive limiter pacing API requests from rate limit headers, exposing its
+        current rate and delays, or None if adaptive rate limiting is disabled."""
+        return getattr(self._requestHandler, 'rate_limiter', None)
+
+    @property
+    def batch_tuners(self):
+        """The AdaptiveBatchTuner instances of adaptive batching, keyed by request
+        kind and options."""
+        return dict(self._batch_tuners)
+
     def close(self):
+        with self._executor_lock:
+            self._closed = True
+            executor = self._executor if self._owns_executor else None
+            if self._owns_executor:
+                self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        self.__store_refreshed()
         self._requestHandler.close()
 
     def __enter__(self):
@@ -101,66 +574,372 @@ class IpregistryClient:
     def batch_parse_user_agents(self, user_agents, **options):
         return self.batch_request(user_agents, self._requestHandler.batch_parse_user_agents, **options)
 
+    def iter_lookup_asns(self, asns, **options):
+        return self.iter_request(asns, self._requestHandler.batch_lookup_asns, **options)
+
+    def iter_lookup_ips(self, ips, **options):
+        return self.iter_request(ips, self._requestHandler.batch_lookup_ips, **options)
+
+    def iter_parse_user_agents(self, user_agents, **options):
+        return self.iter_request(user_agents, self._requestHandler.batch_parse_user_agents, **options)
+
+    def iter_request(self, items, request_handler_func, **options):
+        """Look up items read lazily from any iterable and yield their entries in input order.
+
+        Items are consumed in chunks of max_batch_size and at most
+        batch_concurrency chunks are in flight at a time, so memory usage does
+        not depend on the number of items. Entries of a chunk are yielded as
+        soon as it completes and all the chunks before it have been yielded.
+
+        The cache is read and written on the consuming thread, as caches such
+        as InMemoryCache are not thread-safe: only the requests for the cache
+        misses of the chunks run on the executor."""
+        inline = self._batch_concurrency == 1 or getattr(self._worker_state, 'active', False)
+        pending = deque()
+        try:
+            for chunk in _iter_chunks(items, self._max_batch_size):
+                batch = self.__start_batch(chunk, request_handler_func, options)
+                pending.append(batch)
+                if batch.requested and not inline:
+                    batch.future = self.__get_executor().submit(
+                        self.__run_in_worker, lambda batch: self.__send_batch(batch, request_handler_func, options),
+                        batch)
+                if len(pending) >= self._batch_concurrency:
+                    yield from self.__complete_batch(pending.popleft(), request_handler_func, options).data
+            while pending:
+                yield from self.__complete_batch(pending.popleft(), request_handler_func, options).data
+        finally:
+            # Chunks left when the iteration stops are abandoned: lookups
+            # waiting on their requests are cancelled.
+            for batch in pending:
+                if batch.future is not None:
+                    batch.future.cancel()
+                self.__resolve_flights(batch.flights, exception=CancelledError())
+
+    def __map_bounded(self, func, iterable):
+        """Apply func to the values of iterable on the client's executor with
+        at most batch_concurrency calls in flight, yielding results in input order.
+
+        Calls made from a worker of the executor run sequentially instead, so
+        nested batches cannot exhaust the pool and deadlock waiting on it."""
+        if self._batch_concurrency == 1 or getattr(self._worker_state, 'active', False):
+            for value in iterable:
+                yield func(value)
+            return
+
+        executor = self.__get_executor()
+        futures = deque()
+        try:
+            for value in iterable:
+                futures.append(executor.submit(self.__run_in_worker, func, value))
+                if len(futures) >= self._batch_concurrency:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def __run_in_worker(self, func, value):
+        self._worker_state.active = True
+        try:
+            return func(value)
+        finally:
+            self._worker_state.active = False
+
+    def __get_executor(self):
+        """Return the executor shared by all batch calls, creating it on first use.
+
+        Its max_workers threads cap the number of chunk requests in flight
+        across all concurrent callers. Once the client is closed, a ClientError
+        is raised rather than creating an executor nothing would shut down."""
+        with self._executor_lock:
+            if self._closed:
+                raise ClientError("The client is closed.")
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix='ipregistry')
+            return self._executor
+
     def batch_request(self, items, request_handler_func, **options):
-        sparse_cache = [None] * len(items)
-        cache_misses = []
+        batch = self.__start_batch(items, request_handler_func, options)
+        return self.__complete_batch(batch, request_handler_func, options)
+
+    def __start_batch(self, items, request_handler_func, options):
+        """Fill a batch with its cached values and join the requests of its misses."""
+        self.__store_refreshed()
+        kind = _request_kind(self._requestHandler, request_handler_func)
+        cache_keys = _build_cache_keys(kind, items, options)
+        result, short_circuited = self.__get_cached(items, cache_keys, kind)
+        self.__refresh_batch_hits(items, cache_keys, result, request_handler_func, options)
+        projected = self.__fill_projected_hits(kind, items, result, options)
+        self.__fill_negative_hits(cache_keys, result)
+        if kind == 'ip':
+            result = [_with_current_time(value) for value in result]
+        batch = _PendingBatch(kind, items, cache_keys, result, short_circuited, projected)
 
+        # Each distinct cache miss is requested once: repeated items reuse the
+        # result of their first occurrence and items already requested by a
+        # concurrent lookup wait for its outcome.
+        flights = batch.flights
         for i in range(len(items)):
-            item = items[i]
-            cache_key = self.__build_cache_key(item, options)
-            cache_value = self._cache.get(cache_key)
-            if cache_value is None:
-                cache_misses.append(item)
-            else:
-                sparse_cache[i] = cache_value
+            if result[i] is None:
+                cache_key = cache_keys[i]
+                if cache_key not in flights:
+                    flights[cache_key] = self._in_flight.join(cache_key)
+                    (batch.requested if flights[cache_key][1] else batch.waiting).append(i)
+                else:
+                    (batch.duplicates if flights[cache_key][1] else batch.waiting).append(i)
+        return batch
 
-        result = [None] * len(items)
-        if len(cache_misses) > 0:
-            response = self.__batch_request_chunked(cache_misses, request_handler_func, options)
-        else:
-            response = ApiResponse(
-                ApiResponseCredits(),
-                [],
-                ApiResponseThrottling()
-            )
+    def __send_batch(self, batch, request_handler_func, options):
+        """Request the misses a batch leads, without touching the cache."""
+        if len(batch.requested) > 0:
+            return self.__batch_request_chunked(
+                [batch.items[i] for i in batch.requested], request_handler_func, options)
+        return ApiResponse(
+            ApiResponseCredits(),
+            [],
+            ApiResponseThrottling()
+        )
 
-        fresh_item_info = response.data
-        if len(fresh_item_info) != len(cache_misses):
-            raise ClientError(
-                "Batch response contained {} results for {} requested items.".format(
-                    len(fresh_item_info), len(cache_misses)))
-        j = 0
-        k = 0
-
-        for cached_item_info in sparse_cache:
-            if cached_item_info is None:
-                if not isinstance(fresh_item_info[k], IpregistryLookupError):
-                    self._cache.put(self.__build_cache_key(items[j], options), fresh_item_info[k])
-                result[j] = fresh_item_info[k]
-                k += 1
+    def __complete_batch(self, batch, request_handler_func, options):
+        """Wait for the requests of a batch, sending them first unless they
+        were submitted to the executor, store their results and return the
+        batch response."""
+        items, cache_keys, result = batch.items, batch.cache_keys, batch.result
+        requested, duplicates, waiting, flights = batch.requested, batch.duplicates, batch.waiting, batch.flights
+        try:
+            if batch.future is not None:
+                response = batch.future.result()
             else:
-                result[j] = cached_item_info
-            j += 1
+                response = self.__send_batch(batch, request_handler_func, options)
+
+            fresh_item_info = response.data
+            if len(fresh_item_info) != len(requested):
+                raise ClientError(
+                    "Batch response contained {} results for {} requested items.".format(
+                        len(fresh_item_info), len(requested)))
+
+            fresh_results = {cache_keys[i]: item_info for i, item_info in zip(requested, fresh_item_info)}
+            self.__store_fresh_results(batch.kind, fresh_results, options)
+        except BaseException as e:
+            self.__resolve_flights(flights, exception=e)
+            raise
+
+        self.__resolve_flights(flights, results=fresh_results)
+        for i in requested:
+            result[i] = fresh_results[cache_keys[i]]
+
+        for i in duplicates:
+            result[i] = fresh_results[cache_keys[i]]
+
+        cache_misses = len(requested) + len(duplicates) + len(waiting)
+        self._statistics.record(
+            cache_hits=len(items) - cache_misses - batch.short_circuited, cache_misses=cache_misses,
+            coalesced=len(waiting), deduplicated=len(duplicates), projected=batch.projected,
+            short_circuited=batch.short_circuited,
+            credits_consumed=response.credits.consumed if requested else None)
+
+        for i in waiting:
+            try:
+                result[i] = flights[cache_keys[i]][0].result()
+            except ApiError as e:
+                result[i] = _as_lookup_error(e)
 
         response.data = result
 
         return response
 
+    def __store_fresh_results(self, kind, fresh_results, options):
+        """Store the entries of a batch response in the cache and its errors in the negative cache."""
+        fresh_entries = {}
+        fresh_errors = {}
+        for cache_key, item_info in fresh_results.items():
+            if isinstance(item_info, IpregistryLookupError):
+                fresh_errors[cache_key] = item_info
+            else:
+                fresh_entries[cache_key] = item_info
+        if fresh_entries and _put_quietly(self._cache, fresh_entries):
+            self._cached_options.add(kind, options)
+        _put_quietly(self._negative_cache, fresh_errors)
+
+    def __get_cached(self, items, cache_keys, kind):
+        """Return the cached values of a batch, with None for misses, and the
+        number of IPs answered locally, which are pulled out before the cache
+        is read and never requested."""
+        if not self._local_ip_validation or kind != 'ip':
+            return list(self._cache.get_many(cache_keys)), 0
+
+        result = [_local_lookup_error(item) for item in items]
+        positions = [i for i in range(len(items)) if result[i] is None]
+        for i, value in zip(positions, self._cache.get_many([cache_keys[i] for i in positions])):
+            result[i] = value
+        return result, len(items) - len(positions)
+
+    def __fill_projected_hits(self, kind, items, result, options):
+        """Fill the cache misses of a batch with the projection of entries
+        cached with options covering the given ones, such as all fields or a
+        resolved hostname, and return their number."""
+        misses = [i for i in range(len(result)) if result[i] is None]
+        projected = 0
+        for cached_options in self._cached_options.covering(kind, options):
+            if not misses:
+                break
+            keys = _build_cache_keys(kind, [items[i] for i in misses], cached_options)
+            remaining = []
+            for i, value in zip(misses, self._cache.get_many(keys)):
+                if value is not None:
+                    result[i] = _project(value, cached_options, options)
+                if result[i] is None:
+                    remaining.append(i)
+            projected += len(misses) - len(remaining)
+            misses = remaining
+        return projected
+
+    def __fill_negative_hits(self, cache_keys, result):
+        """Fill the cache misses of a batch with the negatively cached errors of their keys."""
+        misses = [i for i in range(len(result)) if result[i] is None]
+        for i, error in zip(misses, self._negative_cache.get_many([cache_keys[i] for i in misses])):
+            result[i] = error
+
+    def __refresh_batch_hits(self, items, cache_keys, result, request_handler_func, options):
+        """Refresh the stale entries among the cache hits of a batch with a
+        background batch request."""
+        hits = {cache_keys[i]: items[i] for i in range(len(items)) if result[i] is not None}
+        if not hits:
+            return
+        stale = self._cache.keys_to_refresh(list(hits))
+        if not stale:
+            return
+
+        def send(keys):
+            response = self.__batch_request_chunked([hits[key] for key in keys], request_handler_func, options)
+            if len(response.data) != len(keys):
+                raise ClientError("Batch response contained {} results for {} requested items.".format(
+                    len(response.data), len(keys)))
+            results = dict(zip(keys, response.data))
+            self.__hand_back_refreshed({key: value for key, value in results.items()
+                                        if not isinstance(value, IpregistryLookupError)})
+            self._statistics.record(credits_consumed=response.credits.consumed)
+            return results
+
+        self.__refresh_in_background(stale, send)
+
+    def __refresh_in_background(self, cache_keys, send):
+        """Refresh cached entries on the executor while their stale values keep
+        being served. Keys already being requested are skipped, so each entry
+        gets a single refresh; send(keys) requests the others and returns their
+        new values keyed by cache key.
+
+        As the cache may not be thread-safe, send hands the new entries back
+        with __hand_back_refreshed rather than storing them: the next lookup
+        stores them on its caller's thread."""
+        keys = [key for key in cache_keys if self._in_flight.join(key)[1]]
+        if not keys:
+            return
+
+        def refresh(keys):
+            try:
+                results = send(keys)
+            except BaseException as e:
+                for key in keys:
+                    self._in_flight.resolve(key, exception=e)
+                return
+            for key in keys:
+                self._in_flight.resolve(key, results[key])
+
+        self._statistics.record(refreshes=len(keys))
+        try:
+            self.__get_executor().submit(self.__run_in_worker, refresh, keys)
+        except (ClientError, RuntimeError) as e:
+            # The client was closed, or the executor it was given shut down.
+            for key in keys:
+                self._in_flight.resolve(key, exception=e)
+
+    def __hand_back_refreshed(self, entries):
+        with self._refreshed_lock:
+            self._refreshed.update(entries)
+
+    def __store_refreshed(self):
+        """Store the entries refreshed in the background since the last lookup."""
+        if not self._refreshed:
+            return
+        with self._refreshed_lock:
+            entries, self._refreshed = self._refreshed, {}
+        _put_quietly(self._cache, entries)
+
+    def __resolve_flights(self, flights, results=None, exception=None):
+        for cache_key, (_, leader) in flights.items():
+            if leader:
+                self._in_flight.resolve(
+                    cache_key, None if results is None else results[cache_key], exception)
+
     def __batch_request_chunked(self, items, request_handler_func, options):
         """Split a batch into chunks of at most max_batch_size items and issue
         them concurrently, preserving input order in the merged response."""
+        if self._adaptive_batching:
+            return self.__batch_request_adaptive(items, request_handler_func, options)
+
         if len(items) <= self._max_batch_size:
-            return request_handler_func(items, options)
+            response = request_handler_func(items, options)
+        else:
+            chunks = [items[i:i + self._max_batch_size] for i in range(0, len(items), self._max_batch_size)]
+            response = _merge_batch_responses(
+                list(self.__map_bounded(lambda chunk: request_handler_func(chunk, options), chunks)))
+        response.batching = _fixed_batching(items, self._max_batch_size, self._batch_concurrency)
+        return response
 
-        chunks = [items[i:i + self._max_batch_size] for i in range(0, len(items), self._max_batch_size)]
+    def __batch_request_adaptive(self, items, request_handler_func, options):
+        """Issue a batch in chunks whose size and concurrency are read from the
+        AdaptiveBatchTuner of its request kind before each chunk, feeding it
+        back the latency and outcome of every chunk."""
+        tuner = self._batch_tuners.setdefault(
+            _batch_tuner_key(request_handler_func, options),
+            AdaptiveBatchTuner(self._max_batch_size, self._batch_concurrency))
 
-        if self._batch_concurrency > 1:
-            with ThreadPoolExecutor(max_workers=self._batch_concurrency) as executor:
-                responses = list(executor.map(lambda chunk: request_handler_func(chunk, options), chunks))
-        else:
-            responses = [request_handler_func(chunk, options) for chunk in chunks]
+        def run_chunk(chunk):
+            start = time.monotonic()
+            try:
+                response = request_handler_func(chunk, options)
+            except Exception as e:
+                tuner.record(time.monotonic() - start, e)
+                raise
+            tuner.record(time.monotonic() - start)
+            return response
 
-        return _merge_batch_responses(responses)
+        # Nested batches run their chunks inline, like __map_bounded does.
+        nested = getattr(self._worker_state, 'active', False)
+        responses = {}
+        pending = {}
+        offset = 0
+        largest = 0
+        peak = 1
+        try:
+            while offset < len(items) or pending:
+                while offset < len(items):
+                    chunk_size, concurrency = tuner.settings()
+                    if pending and len(pending) >= concurrency:
+                        break
+                    chunk = items[offset:offset + chunk_size]
+                    largest = max(largest, len(chunk))
+                    if nested or (offset == 0 and len(chunk) == len(items)):
+                        responses[offset] = run_chunk(chunk)
+                    else:
+                        pending[self.__get_executor().submit(self.__run_in_worker, run_chunk, chunk)] = offset
+                        peak = max(peak, len(pending))
+                    offset += len(chunk)
+                if pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        responses[pending.pop(future)] = future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+        response = responses[0] if len(responses) == 1 \
+            else _merge_batch_responses([responses[key] for key in sorted(responses)])
+        response.batching = ApiResponseBatching(largest, peak, len(responses))
+        return response
 
     def lookup_asn(self, asn, **options):
         return self.__lookup_asn(asn, options)
@@ -184,26 +963,80 @@ class IpregistryClient:
         return self.__lookup(
             'AS' + str(asn) if IpregistryClient.__is_number(asn) else 'AS',
             options, self._requestHandler.lookup_asn,
-            AutonomousSystem)
+            AutonomousSystem, 'asn')
 
     def __lookup_ip(self, ip, options):
-        return self.__lookup(ip, options, self._requestHandler.lookup_ip, IpInfo)
+        if self._local_ip_validation:
+            error = _local_lookup_error(ip)
+            if error is not None:
+                self._statistics.record(short_circuited=1)
+                raise ApiError(error.code, error.message, error.resolution)
+        return self.__lookup(ip, options, self._requestHandler.lookup_ip, IpInfo, 'ip')
 
-    def __lookup(self, key, options, lookup_func, response_type):
-        cache_key = self.__build_cache_key(key, options)
+    def __lookup(self, key, options, lookup_func, response_type, kind):
+        self.__store_refreshed()
+        cache_key = self.__build_cache_key(kind, key, options)
         cache_value = self._cache.get(cache_key)
 
-        if cache_value is None:
+        if cache_value is not None:
+            self._statistics.record(cache_hits=1)
+            if self._cache.keys_to_refresh([cache_key]):
+                self.__refresh_lookup(cache_key, key, options, lookup_func, response_type)
+            return ApiResponse(
+                ApiResponseCredits(),
+                _with_current_time(cache_value),
+                ApiResponseThrottling()
+            )
+
+        projected = [None]
+        if self.__fill_projected_hits(kind, [key], projected, options):
+            self._statistics.record(cache_hits=1, projected=1)
+            return ApiResponse(ApiResponseCredits(), _with_current_time(projected[0]), ApiResponseThrottling())
+
+        error = self._negative_cache.get(cache_key)
+        if error is not None:
+            self._statistics.record(cache_hits=1)
+            raise ApiError(error['code'], error['message'], error['resolution'])
+
+        future, leader = self._in_flight.join(cache_key)
+        if not leader:
+            self._statistics.record(cache_misses=1, coalesced=1)
+            data = future.result()
+            if isinstance(data, IpregistryLookupError):
+                raise data
+            return ApiResponse(ApiResponseCredits(), data, ApiResponseThrottling())
+
+        try:
+            # A previous request for the same key may have completed since the cache miss.
+            cache_value = self._cache.get(cache_key)
+            if cache_value is None:
+                try:
+                    response = lookup_func(key, options)
+                except ApiError as e:
+                    _put_quietly(self._negative_cache, {cache_key: e})
+                    raise
+                self._statistics.record(cache_misses=1, credits_consumed=response.credits.consumed)
+                if isinstance(response.data, response_type) and _put_quietly(self._cache, {cache_key: response.data}):
+                    self._cached_options.add(kind, options)
+            else:
+                self._statistics.record(cache_hits=1)
+                response = ApiResponse(ApiResponseCredits(), _with_current_time(cache_value), ApiResponseThrottling())
+        except BaseException as e:
+            self._in_flight.resolve(cache_key, exception=e)
+            raise
+
+        self._in_flight.resolve(cache_key, response.data)
+        return response
+
+    def __refresh_lookup(self, cache_key, key, options, lookup_func, response_type):
+        def send(keys):
             response = lookup_func(key, options)
+            self._statistics.record(credits_consumed=response.credits.consumed)
             if isinstance(response.data, response_type):
-                self._cache.put(cache_key, response.data)
-            return response
+                self.__hand_back_refreshed({cache_key: response.data})
+            return {cache_key: response.data}
 
-        return ApiResponse(
-            ApiResponseCredits(),
-            cache_value,
-            ApiResponseThrottling()
-        )
+        self.__refresh_in_background([cache_key], send)
 
     def parse_user_agent(self, user_agent, **options):
         response = self.batch_parse_user_agents([user_agent], **options)
@@ -211,8 +1044,8 @@ class IpregistryClient:
         return response
 
     @staticmethod
-    def __build_cache_key(key, options):
-        return _build_cache_key(key, options)
+    def __build_cache_key(kind, key, options):
+        return _build_cache_key(kind, key, options)
 
     @staticmethod
     def __is_api_error(data):
@@ -227,7 +1060,7 @@ class IpregistryConfig:
     def __init__(self, key, base_url="https://api.ipregistry.co", timeout=15,
                  retry_max_attempts=3, retry_interval=1,
                  retry_on_server_error=True, retry_on_too_many_requests=False,
-                 user_agent=None):
+                 user_agent=None, max_concurrent_requests=None, adaptive_rate_limit=False):
         """
         Initialize the IpregistryConfig instance.
 
@@ -248,6 +1081,12 @@ class IpregistryConfig:
                         honoring the Retry-After response header. Defaults to False.
         user_agent (str): A custom value for the User-Agent header sent with each request.
                         Defaults to a library-specific value.
+        max_concurrent_requests (int): The maximum number of API requests in flight at once
+                        across all the request paths of a client, including batch chunks.
+                        Defaults to None, which does not limit them.
+        adaptive_rate_limit (bool): Whether to pace requests client-side from the x-rate-limit-*
+                        headers of responses, spreading the remaining requests until the limit
+                        resets instead of bursting into 429 errors. Defaults to False.
         """
         self.api_key = key
         self.base_url = base_url
@@ -257,6 +1096,8 @@ class IpregistryConfig:
         self.retry_on_server_error = retry_on_server_error
         self.retry_on_too_many_requests = retry_on_too_many_requests
         self.user_agent = user_agent
+        self.max_concurrent_requests = max_concurrent_requests
+        self.adaptive_rate_limit = adaptive_rate_limit
 
     def with_eu_base_url(self):
         self.base_url = 'https://eu.api.ipregistry.co'
@@ -267,9 +1108,11 @@ class IpregistryConfig:
         Return a string representation of the IpregistryConfig instance.
 
         Returns:
-        str: A string containing the API key, base URL, timeout and retry settings.
+        str: A string containing the API key, base URL, timeout, retry and concurrency settings.
         """
         return ("api_key={}, base_url={}, timeout={}, retry_max_attempts={}, retry_interval={}, "
-                "retry_on_server_error={}, retry_on_too_many_requests={}").format(
+                "retry_on_server_error={}, retry_on_too_many_requests={}, max_concurrent_requests={}, "
+                "adaptive_rate_limit={}").format(
             self.api_key, self.base_url, self.timeout, self.retry_max_attempts,
-            self.retry_interval, self.retry_on_server_error, self.retry_on_too_many_requests)
+            self.retry_interval, self.retry_on_server_error, self.retry_on_too_many_requests,
+            self.max_concurrent_requests, self.adaptive_rate_limit)
@@ -0,0 +1,332 @@
+"""
+    Copyright 2019 Ipregistry (https://ipregistry.co).
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       https://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .core import MAX_BATCH_SIZE
+from .model import ApiResponse, ApiResponseCredits, ClientError, IpregistryLookupError
+
+
+def _options_key(options):
+    """Return the key grouping lookups sent with the same options, raising a
+    ValueError for option values that cannot be compared."""
+    # Value types are part of the key: True and 1 are equal, but are sent as
+    # different query values.
+    key = tuple(sorted((name, type(value), value) for name, value in options.items()))
+    try:
+        hash(key)
+    except TypeError:
+        raise ValueError("Lookup options must have hashable values: {!r}".format(options)) from None
+    return key
+
+
+def _group_by_options(pending):
+    """Group pending (ip, options, future, queued_at, options_key) lookups
+    sharing the same options, preserving arrival order within each group."""
+    groups = {}
+    for ip, options, future, _, key in pending:
+        groups.setdefault(key, (options, []))[1].append((ip, future))
+    return groups.values()
+
+
+def _entry_response(response, entry):
+    # Credits are charged for the whole batch and cannot be attributed to a
+    # single entry, so only the remaining credits are reported.
+    return ApiResponse(ApiResponseCredits(None, response.credits.remaining), entry, response.throttling)
+
+
+def _fail(future, exception):
+    """Resolve an asyncio future with an exception, cancelling it for a CancelledError."""
+    if future.done():
+        return
+    if isinstance(exception, asyncio.CancelledError):
+        future.cancel()
+    else:
+        future.set_exception(exception)
+
+
+def _check_settings(max_delay, max_items, max_queue_size, max_concurrent_batches):
+    if max_delay < 0:
+        raise ValueError("max_delay must be positive")
+    if not 1 <= max_items <= MAX_BATCH_SIZE:
+        raise ValueError("max_items must be between 1 and {}".format(MAX_BATCH_SIZE))
+    if max_queue_size < 1:
+        raise ValueError("max_queue_size must be at least 1")
+    if max_concurrent_batches < 1:
+        raise ValueError("max_concurrent_batches must be at least 1")
+
+
+class BatchDispatcher:
+    """Turn individual IP lookups into batch requests, in the style of DataLoader.
+
+    Lookups submitted within max_delay seconds of the first pending one, up
+    to max_items, are sent as a single batch_lookup_ips call on the given
+    IpregistryClient. A background thread collects the batches and sends
+    them from a pool of max_concurrent_batches threads, so that lookups keep
+    being collected while previous batches are in flight. Each caller
+    receives an ApiResponse holding its own entry, or the
+    IpregistryLookupError of its entry is raised. When max_queue_size
+    lookups are already pending, new ones are rejected with a ClientError
+    instead of queueing without bound.
+    """
+
+    def __init__(self, client, max_delay=0.005, max_items=MAX_BATCH_SIZE, max_queue_size=10000,
+                 max_concurrent_batches=4):
+        _check_settings(max_delay, max_items, max_queue_size, max_concurrent_batches)
+        self._client = client
+        self._max_delay = max_delay
+        self._max_items = max_items
+        self._max_queue_size = max_queue_size
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = None
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_batches,
+                                            thread_name_prefix='ipregistry-dispatcher')
+        # Bounds the batches in flight: lookups arriving meanwhile are
+        # collected into the next batch instead of queueing in the pool.
+        self._slots = threading.BoundedSemaphore(max_concurrent_batches)
+
+    def close(self):
+        """Dispatch pending lookups, wait for batches in flight and stop the background threads."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def lookup_ip(self, ip, **options):
+        """Look up an IP through the next batch and wait for its result."""
+        return self.submit(ip, **options).result()
+
+    def submit(self, ip, **options):
+        """Queue an IP lookup and return a concurrent.futures.Future of its ApiResponse."""
+        if not isinstance(ip, str):
+            raise ValueError("Invalid value for 'ip' parameter: {!r}".format(ip))
+
+        key = _options_key(options)
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise ClientError("The batch dispatcher is closed.")
+            if len(self._queue) >= self._max_queue_size:
+                raise ClientError("The batch dispatcher queue is full ({} pending lookups).".format(
+                    len(self._queue)))
+            self._queue.append((ip, options, future, time.monotonic(), key))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.__run, name='ipregistry-dispatcher', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return future
+
+    def __run(self):
+        # Futures of the lookups taken from the queue and not yet dispatched.
+        collected = set()
+        try:
+            self.__collect(collected)
+        except BaseException as e:
+            # Fail the lookups rather than leaving them unresolved; the next
+            # lookup starts a new thread.
+            with self._condition:
+                collected.update(lookup[2] for lookup in self._queue)
+                self._queue.clear()
+                self._thread = None
+            for future in collected:
+                if not future.done():
+                    future.set_exception(e)
+
+    def __collect(self, collected):
+        while True:
+            with self._condition:
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                deadline = self._queue[0][3] + self._max_delay
+                while len(self._queue) < self._max_items and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                pending = [self._queue.popleft() for _ in range(min(self._max_items, len(self._queue)))]
+                collected.update(lookup[2] for lookup in pending)
+
+            # Lookups cancelled by their caller are not sent.
+            pending = [lookup for lookup in pending if lookup[2].set_running_or_notify_cancel()]
+            for options, lookups in _group_by_options(pending):
+                self._slots.acquire()
+                self._executor.submit(self.__dispatch, options, lookups)
+                collected.difference_update(future for _, future in lookups)
+            collected.clear()
+
+    def __dispatch(self, options, lookups):
+        try:
+            response = self._client.batch_lookup_ips([ip for ip, _ in lookups], **options)
+        except BaseException as e:
+            for _, future in lookups:
+                future.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+
+        for (_, future), entry in zip(lookups, response.data):
+            if isinstance(entry, IpregistryLookupError):
+                future.set_exception(entry)
+            else:
+                future.set_result(_entry_response(response, entry))
+
+
+class AsyncBatchDispatcher:
+    """Asynchronous counterpart of BatchDispatcher for AsyncIpregistryClient.
+
+    Pending lookups are collected by a task running on the event loop of
+    the first caller, restarted by the next lookup if it ever stops, and
+    each batch is sent from its own task, up to max_concurrent_batches at a
+    time.
+    """
+
+    def __init__(self, client, max_delay=0.005, max_items=MAX_BATCH_SIZE, max_queue_size=10000,
+                 max_concurrent_batches=4):
+        _check_settings(max_delay, max_items, max_queue_size, max_concurrent_batches)
+        self._client = client
+        self._max_delay = max_delay
+        self._max_items = max_items
+        self._max_queue_size = max_queue_size
+        self._max_concurrent_batches = max_concurrent_batches
+        self._queue = deque()
+        self._wakeup = None
+        self._slots = None
+        self._closed = False
+        self._task = None
+        self._batches = set()
+
+    async def aclose(self):
+        """Dispatch pending lookups, wait for batches in flight and stop the dispatching task."""
+        self._closed = True
+        if self._task is not None and not self._task.done():
+            self._wakeup.set()
+            await self._task
+        while self._batches:
+            await asyncio.gather(*self._batches, return_exceptions=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+    async def lookup_ip(self, ip, **options):
+        """Look up an IP through the next batch and wait for its result."""
+        return await self.submit(ip, **options)
+
+    def submit(self, ip, **options):
+        """Queue an IP lookup and return an asyncio future of its ApiResponse.
+
+        Must be called from a running event loop."""
+        if not isinstance(ip, str):
+            raise ValueError("Invalid value for 'ip' parameter: {!r}".format(ip))
+        if self._closed:
+            raise ClientError("The batch dispatcher is closed.")
+        if len(self._queue) >= self._max_queue_size:
+            raise ClientError("The batch dispatcher queue is full ({} pending lookups).".format(len(self._queue)))
+
+        key = _options_key(options)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.append((ip, options, future, loop.time(), key))
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._slots = asyncio.Semaphore(self._max_concurrent_batches)
+            self._task = loop.create_task(self.__run())
+        self._wakeup.set()
+        return future
+
+    async def __run(self):
+        # Futures of the lookups taken from the queue and not yet dispatched.
+        collected = set()
+        try:
+            await self.__collect(collected)
+        except BaseException as e:
+            # Fail the lookups rather than leaving them unresolved; the next
+            # lookup starts a new task.
+            collected.update(lookup[2] for lookup in self._queue)
+            self._queue.clear()
+            for future in collected:
+                _fail(future, e)
+            if not isinstance(e, Exception):
+                raise
+
+    async def __collect(self, collected):
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self._queue and not self._closed:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            if not self._queue:
+                return
+            deadline = self._queue[0][3] + self._max_delay
+            while len(self._queue) < self._max_items and not self._closed:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            pending = [self._queue.popleft() for _ in range(min(self._max_items, len(self._queue)))]
+            collected.update(lookup[2] for lookup in pending)
+
+            # Lookups cancelled by their caller are not sent.
+            pending = [lookup for lookup in pending if not lookup[2].done()]
+            for options, lookups in _group_by_options(pending):
+                await self._slots.acquire()
+                batch = loop.create_task(self.__dispatch(options, lookups))
+                self._batches.add(batch)
+                batch.add_done_callback(self._batches.discard)
+                collected.difference_update(future for _, future in lookups)
+            collected.clear()
+
+    async def __dispatch(self, options, lookups):
+        try:
+            response = await self._client.batch_lookup_ips([ip for ip, _ in lookups], **options)
+        except BaseException as e:
+            for _, future in lookups:
+                _fail(future, e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        finally:
+            self._slots.release()
+
+        for (_, future), entry in zip(lookups, response.data):
+            if future.done():
+                continue
+            if isinstance(entry, IpregistryLookupError):
+                future.set_exception(entry)
+            else:
+                future.set_result(_entry_response(response, entry))
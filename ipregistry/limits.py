@@ -0,0 +1,289 @@
+"""
+    Copyright 2019 Ipregistry (https://ipregistry.co).
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       https://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+
+from .model import ApiError, ErrorCode
+
+
+class _ConcurrencyLimiterBase:
+    def __init__(self, limit=None):
+        if limit is not None and limit < 1:
+            raise ValueError("limit must be at least 1")
+        self.limit = limit
+        self.in_use = 0
+        self.waiting = 0
+        self.peak_in_use = 0
+        self.acquisitions = 0
+        self.total_wait_time = 0.0
+
+    @property
+    def average_wait_time(self) -> float:
+        """Average number of seconds a request waited for a free slot."""
+        return self.total_wait_time / self.acquisitions if self.acquisitions > 0 else 0.0
+
+    def _is_full(self):
+        return self.limit is not None and self.in_use >= self.limit
+
+    def _acquired(self, wait_time, handed_over=False):
+        if not handed_over:
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+        self.acquisitions += 1
+        self.total_wait_time += wait_time
+
+    def __str__(self):
+        fields = ', '.join(f"{key}={value}" for key, value in self.__dict__.items() if not key.startswith('_'))
+        return f"{self.__class__.__name__}({fields})"
+
+
+class ConcurrencyLimiter(_ConcurrencyLimiterBase):
+    """Bound the number of API requests in flight across every request path
+    of a request handler: single lookups, origin lookups and batch chunks.
+
+    A limit of None does not bound requests but still tracks occupancy, so the
+    counters can be used to size the limit.
+    """
+
+    def __init__(self, limit=None):
+        super().__init__(limit)
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        start = time.monotonic()
+        with self._condition:
+            if self._is_full():
+                self.waiting += 1
+                try:
+                    while self._is_full():
+                        self._condition.wait()
+                finally:
+                    self.waiting -= 1
+            self._acquired(time.monotonic() - start)
+
+    def release(self):
+        with self._condition:
+            self.in_use -= 1
+            self._condition.notify()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class AsyncConcurrencyLimiter(_ConcurrencyLimiterBase):
+    """Asynchronous counterpart of ConcurrencyLimiter.
+
+    Released slots are handed over to waiting tasks in FIFO order, and
+    release does not need to be awaited so that it cannot be interrupted by
+    cancellation.
+    """
+
+    def __init__(self, limit=None):
+        super().__init__(limit)
+        self._waiters = deque()
+
+    async def acquire(self):
+        if not self._is_full() and not self._waiters:
+            self._acquired(0.0)
+            return
+
+        start = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        self.waiting += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over right before the cancellation.
+                self.release()
+            raise
+        finally:
+            self.waiting -= 1
+            if future in self._waiters:
+                self._waiters.remove(future)
+        self._acquired(time.monotonic() - start, handed_over=True)
+
+    def release(self):
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_use -= 1
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class _TokenBucket:
+    """Token bucket whose rate is recalibrated from the rate limit headers of
+    API responses.
+
+    After each response, the remaining requests are spread evenly until the
+    limit resets, with a burst of at most one second worth of tokens. Once
+    no request remains, callers are delayed until the reset. Until a first
+    response with rate limit headers is seen, requests are not paced.
+    """
+
+    def __init__(self):
+        self.rate = None
+        self.tokens = 0.0
+        self.capacity = 1.0
+        self.delayed = 0
+        self.total_delay = 0.0
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def update(self, throttling):
+        """Recalibrate the bucket from the ApiResponseThrottling of a response."""
+        if throttling is None or throttling.remaining is None or throttling.reset is None:
+            return
+        window = max(throttling.reset, 1)
+        with self._lock:
+            self.__refill(time.monotonic())
+            if throttling.remaining > 0:
+                calibrated = self.rate is not None
+                self.rate = throttling.remaining / window
+                self.capacity = max(1.0, min(float(throttling.remaining), self.rate))
+                self.tokens = min(self.tokens, self.capacity) if calibrated else self.capacity
+            else:
+                # Nothing is left until the reset: assume the next window allows
+                # as many requests and owe a whole window worth of tokens. The
+                # debt is set rather than added to, since concurrent requests
+                # often report the same exhausted window.
+                self.rate = max(throttling.limit or 1, 1) / window
+                self.capacity = max(1.0, self.rate)
+                self.tokens = min(self.tokens, -self.rate * window)
+
+    def _reserve(self):
+        """Take a token and return the number of seconds to wait before sending."""
+        with self._lock:
+            if self.rate is None:
+                return 0.0
+            self.__refill(time.monotonic())
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            delay = -self.tokens / self.rate
+            self.delayed += 1
+            self.total_delay += delay
+            return delay
+
+    def __refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def __str__(self):
+        fields = ', '.join(f"{key}={value}" for key, value in self.__dict__.items() if not key.startswith('_'))
+        return f"{self.__class__.__name__}({fields})"
+
+
+class RateLimiter(_TokenBucket):
+    """Pace outgoing API requests from the x-rate-limit-* headers of responses,
+    so bulk jobs run at the highest sustainable rate without being throttled."""
+
+    def acquire(self):
+        delay = self._reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class AsyncRateLimiter(_TokenBucket):
+    """Asynchronous counterpart of RateLimiter."""
+
+    async def acquire(self):
+        delay = self._reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class AdaptiveBatchTuner:
+    """Tune the chunk size and concurrency of chunked batch requests on the
+    fly, in the style of AIMD congestion control.
+
+    Each completed chunk is recorded with its latency and error, if any. A
+    throttled chunk (429) halves the concurrency and a failed or slow chunk,
+    taking more than target_latency seconds, halves the chunk size, down to
+    min_chunk_size. Fast chunks grow the chunk size by min_chunk_size and,
+    once a whole round of concurrency chunks succeeded, the concurrency by
+    one, up to the given maximums the tuner starts from.
+    """
+
+    def __init__(self, max_chunk_size, max_concurrency, min_chunk_size=32, target_latency=2.0):
+        if max_chunk_size < 1 or max_concurrency < 1:
+            raise ValueError("max_chunk_size and max_concurrency must be at least 1")
+        if target_latency <= 0:
+            raise ValueError("target_latency must be positive")
+        self.max_chunk_size = max_chunk_size
+        self.max_concurrency = max_concurrency
+        self.min_chunk_size = max(1, min(min_chunk_size, max_chunk_size))
+        self.target_latency = target_latency
+        self.chunk_size = max_chunk_size
+        self.concurrency = max_concurrency
+        self.chunks = 0
+        self.errors = 0
+        self.throttled = 0
+        self.total_latency = 0.0
+        self._successes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def average_latency(self) -> float:
+        """Average number of seconds a chunk request took."""
+        return self.total_latency / self.chunks if self.chunks > 0 else 0.0
+
+    def settings(self):
+        """Return the (chunk_size, concurrency) to use for the next chunks."""
+        with self._lock:
+            return self.chunk_size, self.concurrency
+
+    def record(self, latency, error=None):
+        """Adjust the settings after a chunk request took latency seconds and
+        failed with error, or succeeded if error is None."""
+        with self._lock:
+            self.chunks += 1
+            self.total_latency += latency
+            if isinstance(error, ApiError) and error.error_code == ErrorCode.TOO_MANY_REQUESTS:
+                self.throttled += 1
+                self.concurrency = max(1, self.concurrency // 2)
+                self._successes = 0
+            elif error is not None or latency > self.target_latency:
+                if error is not None:
+                    self.errors += 1
+                self.chunk_size = max(self.min_chunk_size, self.chunk_size // 2)
+                self._successes = 0
+            else:
+                self.chunk_size = min(self.max_chunk_size, self.chunk_size + self.min_chunk_size)
+                self._successes += 1
+                if self._successes >= self.concurrency:
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                    self._successes = 0
+
+    def __str__(self):
+        fields = ', '.join(f"{key}={value}" for key, value in self.__dict__.items() if not key.startswith('_'))
+        return f"{self.__class__.__name__}({fields})"
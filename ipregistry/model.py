@@ -14,6 +14,7 @@
     limitations under the License.
 """
 
+import threading
 from enum import Enum
 
 from .json import *
@@ -73,17 +74,85 @@ class ApiResponseThrottling:
         return f"{self.__class__.__name__}({fields})"
 
 
+class ApiResponseBatching:
+    """How a batch request was split: the size of its largest chunk, the
+    highest number of chunks in flight at once and the number of chunks."""
+
+    def __init__(self, chunk_size: int, concurrency: int, chunks: int):
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.chunks = chunks
+
+    def __str__(self):
+        fields = ', '.join(f"{key}={value}" for key, value in self.__dict__.items())
+        return f"{self.__class__.__name__}({fields})"
+
+
 class ApiResponse(Generic[T]):
-    def __init__(self, credits: ApiResponseCredits, data: T, throttling: Optional[ApiResponseThrottling] = None):
+    def __init__(self, credits: ApiResponseCredits, data: T, throttling: Optional[ApiResponseThrottling] = None,
+                 batching: Optional[ApiResponseBatching] = None):
         self.credits = credits
         self.data = data
         self.throttling = throttling
+        self.batching = batching
 
     def __str__(self):
         fields = ', '.join(f"{key}={value}" for key, value in self.__dict__.items())
         return f"{self.__class__.__name__}({fields})"
 
 
+class ClientStatistics:
+    """Counters describing how a client served lookups.
+
+    cache_hits and cache_misses count looked up items found or not in the
+    cache. Among misses, coalesced items waited for a concurrent request for
+    the same key and deduplicated items repeated another item of the same
+    batch, so neither was sent to the API. projected counts cache hits
+    answered from an entry cached with more fields or options than requested.
+    refreshes counts entries served from the cache and refreshed by a
+    background request. short_circuited counts malformed or reserved IPs
+    answered locally, without a cache lookup nor an API request.
+    """
+
+    def __init__(self):
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.coalesced = 0
+        self.deduplicated = 0
+        self.projected = 0
+        self.refreshes = 0
+        self.short_circuited = 0
+        self.credits_consumed = 0
+        self._lock = threading.Lock()
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.cache_hits + self.cache_misses
+        return self.cache_hits / lookups if lookups > 0 else 0.0
+
+    @property
+    def sends_saved(self) -> int:
+        """Number of items served without being sent to the API."""
+        return self.cache_hits + self.coalesced + self.deduplicated + self.short_circuited
+
+    def record(self, cache_hits=0, cache_misses=0, coalesced=0, deduplicated=0, projected=0, refreshes=0,
+               short_circuited=0, credits_consumed=None):
+        with self._lock:
+            self.cache_hits += cache_hits
+            self.cache_misses += cache_misses
+            self.coalesced += coalesced
+            self.deduplicated += deduplicated
+            self.projected += projected
+            self.refreshes += refreshes
+            self.short_circuited += short_circuited
+            if credits_consumed is not None:
+                self.credits_consumed += credits_consumed
+
+    def __str__(self):
+        fields = ', '.join(f"{key}={value}" for key, value in self.__dict__.items() if not key.startswith('_'))
+        return f"{self.__class__.__name__}({fields}, hit_rate={self.hit_rate:.3f}, sends_saved={self.sends_saved})"
+
+
 class IpregistryError(Exception):
     pass
 
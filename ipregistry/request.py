@@ -24,6 +24,7 @@ from typing import Union
 
 import requests
 
+from .limits import ConcurrencyLimiter, RateLimiter
 from .model import (ApiError, ApiResponse, ApiResponseCredits, ApiResponseThrottling, AutonomousSystem,
                     ClientError, IpInfo, IpregistryLookupError, RequesterAutonomousSystem,
                     RequesterIpInfo, RequesterUserAgent, UserAgent)
@@ -90,6 +91,15 @@ def _prefix_batch_fields(options):
     return result
 
 
+def _format_asn(asn):
+    """Return the AS-prefixed form of an ASN sent in batch requests, whether
+    it is given as 15169, '15169' or 'AS15169', in line with its cache key."""
+    text = str(asn).strip()
+    if text[:2].upper() == 'AS':
+        text = text[2:]
+    return 'AS' + (str(int(text)) if text.isdigit() else text)
+
+
 def _is_retryable_status(config, status_code):
     if status_code == 429:
         return config.retry_on_too_many_requests
@@ -162,10 +172,15 @@ class IpregistryRequestHandler(ABC):
 
 
 class DefaultRequestHandler(IpregistryRequestHandler):
-    def __init__(self, config, session=None):
+    def __init__(self, config, session=None, concurrency_limiter=None, rate_limiter=None):
         super().__init__(config)
         self._owns_session = session is None
         self._session = requests.Session() if session is None else session
+        self.concurrency_limiter = concurrency_limiter if concurrency_limiter is not None \
+            else ConcurrencyLimiter(getattr(config, 'max_concurrent_requests', None))
+        if rate_limiter is None and getattr(config, 'adaptive_rate_limit', False):
+            rate_limiter = RateLimiter()
+        self.rate_limiter = rate_limiter
 
     def close(self):
         if self._owns_session:
@@ -175,7 +190,7 @@ class DefaultRequestHandler(IpregistryRequestHandler):
         response = self._request_with_retry(
             'POST',
             self._build_base_url('', _prefix_batch_fields(options)),
-            data=json.dumps(["AS" + str(asn) for asn in asns])
+            data=json.dumps([_format_asn(asn) for asn in asns])
         )
         try:
             results = response.json().get('results', [])
@@ -266,20 +281,26 @@ class DefaultRequestHandler(IpregistryRequestHandler):
 
         while True:
             attempt += 1
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
             try:
-                response = self._session.request(
-                    method,
-                    url,
-                    data=data,
-                    headers=self.__headers(),
-                    timeout=self._config.timeout
-                )
+                with self.concurrency_limiter:
+                    response = self._session.request(
+                        method,
+                        url,
+                        data=data,
+                        headers=self.__headers(),
+                        timeout=self._config.timeout
+                    )
             except requests.RequestException as e:
                 if attempt < max_attempts:
                     time.sleep(self.__backoff_interval(attempt))
                     continue
                 raise ClientError(e)
 
+            if self.rate_limiter is not None:
+                self.rate_limiter.update(self.build_throttling(response))
+
             if response.status_code >= 400:
                 if attempt < max_attempts and self.__is_retryable_status(response.status_code):
                     time.sleep(self.__retry_delay(response, attempt))
@@ -298,11 +319,15 @@ class DefaultRequestHandler(IpregistryRequestHandler):
         return _backoff_interval(self._config, attempt)
 
     @staticmethod
-    def build_api_response(response, data):
-        throttling_limit = DefaultRequestHandler.__convert_to_int(response.headers.get('x-rate-limit-limit'))
-        throttling_remaining = DefaultRequestHandler.__convert_to_int(response.headers.get('x-rate-limit-remaining'))
-        throttling_reset = DefaultRequestHandler.__convert_to_int(response.headers.get('x-rate-limit-reset'))
+    def build_throttling(response):
+        return ApiResponseThrottling(
+            DefaultRequestHandler.__convert_to_int(response.headers.get('x-rate-limit-limit')),
+            DefaultRequestHandler.__convert_to_int(response.headers.get('x-rate-limit-remaining')),
+            DefaultRequestHandler.__convert_to_int(response.headers.get('x-rate-limit-reset'))
+        )
 
+    @staticmethod
+    def build_api_response(response, data):
         ipregistry_credits_consumed = DefaultRequestHandler.__convert_to_int(
             response.headers.get('ipregistry-credits-consumed'))
         ipregistry_credits_remaining = DefaultRequestHandler.__convert_to_int(
@@ -314,11 +339,7 @@ class DefaultRequestHandler(IpregistryRequestHandler):
                 ipregistry_credits_remaining,
             ),
             data,
-            ApiResponseThrottling(
-                throttling_limit,
-                throttling_remaining,
-                throttling_reset
-            )
+            DefaultRequestHandler.build_throttling(response)
         )
 
     @staticmethod
@@ -13,6 +13,75 @@
     See the License for the specific language governing permissions and
     limitations under the License.
 """
+import bisect
+import ipaddress
+import socket
+
+from .model import ErrorCode
+
+# Special-purpose networks that the API rejects with RESERVED_IP_ADDRESS.
+_RESERVED_NETWORKS = (
+    '0.0.0.0/8',        # "this" network
+    '10.0.0.0/8',       # private (RFC 1918)
+    '100.64.0.0/10',    # shared address space, CGNAT (RFC 6598)
+    '127.0.0.0/8',      # loopback
+    '169.254.0.0/16',   # link-local
+    '172.16.0.0/12',    # private (RFC 1918)
+    '192.0.0.0/24',     # IETF protocol assignments
+    '192.0.2.0/24',     # documentation (TEST-NET-1)
+    '192.168.0.0/16',   # private (RFC 1918)
+    '198.18.0.0/15',    # benchmarking
+    '198.51.100.0/24',  # documentation (TEST-NET-2)
+    '203.0.113.0/24',   # documentation (TEST-NET-3)
+    '224.0.0.0/4',      # multicast
+    '240.0.0.0/4',      # reserved, including broadcast
+    '::/128',           # unspecified
+    '::1/128',          # loopback
+    '100::/64',         # discard-only
+    '2001:db8::/32',    # documentation
+    '3fff::/20',        # documentation
+    'fc00::/7',         # unique local
+    'fe80::/10',        # link-local
+    'ff00::/8',         # multicast
+)
+
+
+def _build_ranges(version):
+    """Return the sorted (starts, ends) integer bounds of the reserved networks of an IP version."""
+    networks = sorted(ipaddress.ip_network(network) for network in _RESERVED_NETWORKS
+                      if ipaddress.ip_network(network).version == version)
+    return [int(network.network_address) for network in networks], \
+        [int(network.broadcast_address) for network in networks]
+
+
+_RESERVED_RANGES_V4 = _build_ranges(4)
+_RESERVED_RANGES_V6 = _build_ranges(6)
+_IPV4_MAPPED_PREFIX = bytes(10) + b'\xff\xff'
+
+
+class IpAddresses:
+
+    @staticmethod
+    def classify(ip):
+        """Return the ErrorCode the API would answer for an IP address that is
+        malformed or reserved (private, loopback, link-local, CGNAT,
+        documentation, multicast...), or None if it needs to be looked up."""
+        # inet_pton is a strict parser, much faster than the ipaddress module.
+        try:
+            packed = socket.inet_pton(socket.AF_INET, ip)
+        except (OSError, TypeError, ValueError):
+            try:
+                packed = socket.inet_pton(socket.AF_INET6, ip)
+            except (OSError, TypeError, ValueError):
+                return ErrorCode.INVALID_IP_ADDRESS
+            if packed[:12] == _IPV4_MAPPED_PREFIX:
+                packed = packed[12:]
+        starts, ends = _RESERVED_RANGES_V4 if len(packed) == 4 else _RESERVED_RANGES_V6
+        value = int.from_bytes(packed, 'big')
+        index = bisect.bisect_right(starts, value) - 1
+        if index >= 0 and value <= ends[index]:
+            return ErrorCode.RESERVED_IP_ADDRESS
+        return None
 
 
 class UserAgents:
@@ -14,6 +14,7 @@
     limitations under the License.
 """
 
+import asyncio
 import json
 import unittest
 
@@ -22,16 +23,18 @@ try:
 except ImportError:
     httpx = None
 
-from ipregistry import AsyncIpregistryClient
+from ipregistry import AsyncIpregistryClient, IpInfo
 from ipregistry.async_client import AsyncDefaultRequestHandler
 from ipregistry.cache import InMemoryCache
-from ipregistry.core import IpregistryConfig
+from ipregistry.core import IpregistryConfig, _build_cache_key
 from ipregistry.model import ApiError, ClientError
 
 
 def build_client(responder, **kwargs):
     """Build an async client backed by a mock transport."""
-    client_kwargs = {k: kwargs.pop(k) for k in ('cache', 'max_batch_size', 'batch_concurrency') if k in kwargs}
+    client_kwargs = {k: kwargs.pop(k) for k in ('cache', 'max_batch_size', 'batch_concurrency', 'adaptive_batching',
+                                                     'negative_cache', 'local_ip_validation')
+                     if k in kwargs}
     kwargs.setdefault('retry_interval', 0)
     transport = httpx.MockTransport(responder)
     http_client = httpx.AsyncClient(transport=transport)
@@ -121,6 +124,98 @@ class TestAsyncIpregistryClient(unittest.IsolatedAsyncioTestCase):
             await client.lookup_ip('8.8.8.8')
             self.assertEqual(1, len(calls))
 
+    async def test_concurrent_lookups_coalesced(self):
+        """
+        Test that concurrent async lookups of the same IP and overlapping
+        batch items issue a single request per item
+        """
+        calls = []
+
+        async def responder(request):
+            calls.append(request)
+            await asyncio.sleep(0.01)
+            if request.method == 'POST':
+                ips = json.loads(request.content)
+                return httpx.Response(200, json={'results': [{'ip': ip} for ip in ips]})
+            return httpx.Response(200, json={'ip': request.url.path.strip('/')})
+
+        async with build_client(responder) as client:
+            responses = await asyncio.gather(
+                client.lookup_ip('8.8.8.8'),
+                client.lookup_ip('8.8.8.8'),
+                client.batch_lookup_ips(['1.1.1.1', '8.8.8.8']),
+            )
+            self.assertEqual(2, len(calls))
+            self.assertEqual(['1.1.1.1'], json.loads(calls[1].content))
+            self.assertEqual('8.8.8.8', responses[1].data.ip)
+            self.assertEqual(['1.1.1.1', '8.8.8.8'], [info.ip for info in responses[2].data])
+
+    async def test_cancelled_lookup_does_not_cancel_coalesced_callers(self):
+        """
+        Test that a lookup timing out does not cancel concurrent lookups and batches waiting for its request
+        """
+        calls = []
+
+        async def responder(request):
+            calls.append(request)
+            await asyncio.sleep(0.1)
+            if request.method == 'POST':
+                return httpx.Response(200, json={'results': [{'ip': ip} for ip in json.loads(request.content)]})
+            return httpx.Response(200, json={'ip': request.url.path.strip('/')})
+
+        async with build_client(responder, cache=InMemoryCache()) as client:
+            leader = asyncio.ensure_future(asyncio.wait_for(client.lookup_ip('8.8.8.8'), 0.05))
+            await asyncio.sleep(0)
+            waiter = asyncio.ensure_future(client.lookup_ip('8.8.8.8'))
+            batch = asyncio.ensure_future(client.batch_lookup_ips(['8.8.8.8', '1.1.1.1']))
+            with self.assertRaises(asyncio.TimeoutError):
+                await leader
+            self.assertEqual('8.8.8.8', (await waiter).data.ip)
+            self.assertEqual(['8.8.8.8', '1.1.1.1'], [info.ip for info in (await batch).data])
+            self.assertEqual(2, len(calls))
+
+            batch_leader = asyncio.ensure_future(
+                asyncio.wait_for(client.batch_lookup_ips(['9.9.9.9', '4.4.4.4']), 0.05))
+            await asyncio.sleep(0)
+            waiter = asyncio.ensure_future(client.lookup_ip('9.9.9.9'))
+            with self.assertRaises(asyncio.TimeoutError):
+                await batch_leader
+            self.assertEqual('9.9.9.9', (await waiter).data.ip)
+            self.assertEqual(3, len(calls))
+
+    async def test_cache_write_failures_ignored(self):
+        """
+        Test that lookups succeed and release their in-flight keys when the cache fails to store results
+        """
+        class FailingCache(InMemoryCache):
+            def put_many(self, entries):
+                raise OSError('database is locked')
+
+        def responder(request):
+            if request.method == 'POST':
+                return httpx.Response(200, json={'results': [{'ip': ip} for ip in json.loads(request.content)]})
+            return httpx.Response(200, json={'ip': request.url.path.strip('/')})
+
+        async with build_client(responder, cache=FailingCache()) as client:
+            self.assertEqual(['8.8.8.8'], [info.ip for info in (await client.batch_lookup_ips(['8.8.8.8'])).data])
+            self.assertEqual('8.8.8.8', (await client.lookup_ip('8.8.8.8')).data.ip)
+            self.assertEqual(0, len(client._in_flight._futures))
+
+    async def test_batch_asns_sent_once_per_number(self):
+        """
+        Test that ASNs given with and without the AS prefix in one batch are sent once, AS-prefixed
+        """
+        requests = []
+
+        def responder(request):
+            requests.append(json.loads(request.content))
+            return httpx.Response(200, json={'results': [{'asn': int(asn[2:])} for asn in requests[-1]]})
+
+        async with build_client(responder) as client:
+            response = await client.batch_lookup_asns(['AS15169', 15169])
+            self.assertEqual([['AS15169']], requests)
+            self.assertEqual([15169, 15169], [entry.asn for entry in response.data])
+
     async def test_origin_lookup_ip_bypasses_cache(self):
         """
         Test that async origin lookups are never cached
@@ -154,6 +249,88 @@ class TestAsyncIpregistryClient(unittest.IsolatedAsyncioTestCase):
             self.assertEqual(3, len(calls))
             self.assertEqual(ips, [info.ip for info in response.data])
 
+    async def test_batch_lookup_partially_cached(self):
+        """
+        Test that async batch lookups only request cache misses and
+        store fresh results with a single bulk cache write
+        """
+        calls = []
+
+        def responder(request):
+            ips = json.loads(request.content)
+            calls.append(ips)
+            return httpx.Response(200, json={'results': [{'ip': ip} for ip in ips]})
+
+        cache = InMemoryCache()
+        async with build_client(responder, cache=cache) as client:
+            await client.batch_lookup_ips(['1.1.1.1'])
+            response = await client.batch_lookup_ips(['1.1.1.1', '1.1.1.2'])
+            self.assertEqual([['1.1.1.1'], ['1.1.1.2']], calls)
+            self.assertEqual(['1.1.1.1', '1.1.1.2'], [info.ip for info in response.data])
+            self.assertIsNotNone(cache.get(_build_cache_key('ip', '1.1.1.2', {})))
+
+    async def test_iter_lookup_ips_streams_in_order(self):
+        """
+        Test that iter_lookup_ips consumes an async iterable in chunks
+        and yields entries in input order
+        """
+        calls = []
+
+        def responder(request):
+            ips = json.loads(request.content)
+            calls.append(ips)
+            return httpx.Response(200, json={'results': [{'ip': ip} for ip in ips]})
+
+        async def ips():
+            for i in range(7):
+                yield '1.1.1.{}'.format(i)
+
+        async with build_client(responder, max_batch_size=3, batch_concurrency=2) as client:
+            entries = [entry.ip async for entry in client.iter_lookup_ips(ips())]
+            self.assertEqual(['1.1.1.{}'.format(i) for i in range(7)], entries)
+            self.assertEqual([3, 3, 1], [len(chunk) for chunk in calls])
+
+            entries = [entry.ip async for entry in client.iter_lookup_ips(['8.8.8.8', '8.8.4.4'])]
+            self.assertEqual(['8.8.8.8', '8.8.4.4'], entries)
+
+    async def test_batch_lookup_deduplicates_items(self):
+        """
+        Test that repeated async batch items are sent once and fanned out to every position
+        """
+        calls = []
+
+        def responder(request):
+            ips = json.loads(request.content)
+            calls.append(ips)
+            return httpx.Response(200, json={'results': [{'ip': ip} for ip in ips]})
+
+        async with build_client(responder) as client:
+            response = await client.batch_lookup_ips(['1.1.1.1', '8.8.8.8', '1.1.1.1'])
+            self.assertEqual([['1.1.1.1', '8.8.8.8']], calls)
+            self.assertEqual(['1.1.1.1', '8.8.8.8', '1.1.1.1'], [info.ip for info in response.data])
+            self.assertEqual(1, client.statistics.deduplicated)
+
+    async def test_concurrency_limited_across_request_paths(self):
+        """
+        Test that async single lookups and batch chunks share the client concurrency limit
+        """
+        async def responder(request):
+            await asyncio.sleep(0.01)
+            if request.method == 'POST':
+                ips = json.loads(request.content)
+                return httpx.Response(200, json={'results': [{'ip': ip} for ip in ips]})
+            return httpx.Response(200, json={'ip': '8.8.8.8'})
+
+        async with build_client(responder, max_batch_size=1, max_concurrent_requests=2) as client:
+            await asyncio.gather(
+                client.lookup_ip('8.8.8.8'),
+                client.origin_lookup_ip(),
+                client.batch_lookup_ips(['1.1.1.1', '1.1.1.2', '1.1.1.3']))
+            limiter = client.concurrency_limiter
+            self.assertEqual(2, limiter.peak_in_use)
+            self.assertEqual(5, limiter.acquisitions)
+            self.assertEqual(0, limiter.in_use)
+
     async def test_batch_lookup_mixed_results(self):
         """
         Test that per-entry errors surface as LookupError instances
@@ -185,6 +362,133 @@ class TestAsyncIpregistryClient(unittest.IsolatedAsyncioTestCase):
             self.assertIn('results.location', seen_queries[0])
             self.assertNotIn('fields=ip', seen_queries[0])
 
+    async def test_stale_entries_served_while_refreshed_once(self):
+        """
+        Test that stale entries are served right away while a single background task refreshes them
+        """
+        requests = []
+
+        def responder(request):
+            requests.append(request.url.path)
+            return httpx.Response(200, json={'ip': '8.8.8.8'})
+
+        cache = InMemoryCache(ttl=0.05, stale_ttl=10)
+        async with build_client(responder, cache=cache) as client:
+            await client.lookup_ip('8.8.8.8')
+            await asyncio.sleep(0.08)
+            responses = await asyncio.gather(*[client.lookup_ip('8.8.8.8') for _ in range(5)])
+            self.assertEqual(['8.8.8.8'] * 5, [response.data.ip for response in responses])
+        self.assertEqual(2, len(requests))
+        self.assertEqual(1, client.statistics.refreshes)
+        self.assertEqual([], cache.keys_to_refresh(['8.8.8.8']))
+
+    async def test_lookup_errors_negatively_cached(self):
+        """
+        Test that deterministic errors are answered from the negative cache by async lookups
+        """
+        requests = []
+
+        def responder(request):
+            requests.append(request.url.path)
+            if request.method == 'POST':
+                return httpx.Response(200, json={'results': [
+                    {'code': 'RESERVED_IP_ADDRESS', 'message': 'Reserved.'},
+                    {'code': 'INTERNAL', 'message': 'Oops.'}]})
+            return httpx.Response(400, json={'code': 'INVALID_IP_ADDRESS', 'message': 'Invalid.',
+                                             'resolution': 'Fix it.'})
+
+        async with build_client(responder, negative_cache=InMemoryCache(), retry_max_attempts=1) as client:
+            await client.batch_lookup_ips(['10.0.0.1', '1.1.1.1'])
+            response = await client.batch_lookup_ips(['10.0.0.1'])
+            self.assertEqual('RESERVED_IP_ADDRESS', response.data[0].code)
+            for _ in range(2):
+                with self.assertRaises(ApiError):
+                    await client.lookup_ip('invalid')
+
+        self.assertEqual(['/', '/invalid'], requests)
+
+    async def test_field_subsets_projected_from_cached_entries(self):
+        """
+        Test that async lookups selecting a subset of the fields of a cached entry are answered from it
+        """
+        requests = []
+
+        def responder(request):
+            ips = json.loads(request.content)
+            requests.append(str(request.url))
+            return httpx.Response(200, json={'results': [
+                {'ip': ip, 'hostname': 'dns.google', 'security': {'is_vpn': False}} for ip in ips]})
+
+        async with build_client(responder, cache=InMemoryCache()) as client:
+            await client.batch_lookup_ips(['8.8.8.8'], hostname=True)
+            info = (await client.lookup_ip('8.8.8.8', fields='security')).data
+            self.assertEqual(IpInfo.model_validate({'security': {'is_vpn': False}}), info)
+            info = (await client.batch_lookup_ips(['8.8.8.8'])).data[0]
+            self.assertEqual('8.8.8.8', info.ip)
+            self.assertIsNone(info.hostname)
+
+        self.assertEqual(1, len(requests))
+        self.assertEqual(2, client.statistics.projected)
+
+    async def test_time_zone_recomputed_on_cache_hits(self):
+        """
+        Test that async cache hits are served with the current time of their time zone
+        """
+        frozen = '2026-07-09T10:00:00+02:00'
+
+        def responder(request):
+            return httpx.Response(200, json={'ip': '8.8.8.8', 'time_zone': {
+                'id': 'Europe/Paris', 'current_time': frozen, 'offset': 7200, 'in_daylight_saving': True}})
+
+        async with build_client(responder, cache=InMemoryCache()) as client:
+            self.assertEqual(frozen, (await client.lookup_ip('8.8.8.8')).data.time_zone.current_time)
+            self.assertNotEqual(frozen, (await client.lookup_ip('8.8.8.8')).data.time_zone.current_time)
+
+    async def test_reserved_and_invalid_ips_short_circuited(self):
+        """
+        Test that reserved and malformed IPs are answered locally by the async client
+        """
+        requests = []
+
+        def responder(request):
+            ips = json.loads(request.content)
+            requests.append(ips)
+            return httpx.Response(200, json={'results': [{'ip': ip} for ip in ips]})
+
+        async with build_client(responder, local_ip_validation=True) as client:
+            response = await client.batch_lookup_ips(['172.16.0.1', '8.8.8.8', 'not an ip'])
+            with self.assertRaises(ApiError):
+                await client.lookup_ip('127.0.0.1')
+
+        self.assertEqual([['8.8.8.8']], requests)
+        self.assertEqual(['RESERVED_IP_ADDRESS', 'INVALID_IP_ADDRESS'], [response.data[i].code for i in (0, 2)])
+        self.assertEqual('8.8.8.8', response.data[1].ip)
+
+    async def test_adaptive_batching(self):
+        """
+        Test that adaptive batching halves concurrency after a 429 error and reports its choices
+        """
+        throttle = [True]
+
+        def responder(request):
+            if throttle:
+                throttle.pop()
+                return httpx.Response(429, json={'code': 'TOO_MANY_REQUESTS', 'message': 'Slow down.',
+                                                 'resolution': 'Wait.'})
+            return httpx.Response(200, json={'results': [{'ip': ip} for ip in json.loads(request.content)]})
+
+        ips = ['1.1.1.{}'.format(i) for i in range(200)]
+        async with build_client(responder, max_batch_size=64, batch_concurrency=4, adaptive_batching=True,
+                                retry_max_attempts=1) as client:
+            with self.assertRaises(ApiError):
+                await client.batch_lookup_ips(ips[:10])
+            response = await client.batch_lookup_ips(ips)
+
+            self.assertEqual(ips, [entry.ip for entry in response.data])
+            self.assertEqual((64, 2, 4), (response.batching.chunk_size, response.batching.concurrency,
+                                          response.batching.chunks))
+            self.assertEqual(1, next(iter(client.batch_tuners.values())).throttled)
+
     async def test_batch_response_length_mismatch_raises_client_error(self):
         """
         Test that a batch response with fewer results than requested items
@@ -14,9 +14,18 @@
     limitations under the License.
 """
 
+import os
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 
-from ipregistry.cache import InMemoryCache, NoCache
+from ipregistry import AutonomousSystem, IpInfo, UserAgent
+from ipregistry.cache import (ConcurrentInMemoryCache, InMemoryCache, NoCache, SharedMemoryCache,
+                              PrefixCache, SqliteCache, TieredCache, TinyLfuCache, TtlPolicy, fcntl)
+from ipregistry.core import _build_cache_key
+from ipregistry.json import Connection, RequesterAutonomousSystem
 
 
 class TestIpregistryCache(unittest.TestCase):
@@ -64,6 +73,650 @@ class TestIpregistryCache(unittest.TestCase):
         self.assertEqual(None, cache.get("b"))
         self.assertEqual(None, cache.get("c"))
 
+    def test_defaultcache_bulk_operations(self):
+        """
+        Test that get_many, put_many and invalidate_many fall back to single-key operations
+        """
+        cache = InMemoryCache()
+        cache.put_many({"a": 1, "b": 2})
+        self.assertEqual([1, None, 2], cache.get_many(["a", "c", "b"]))
+        cache.invalidate_many(["a"])
+        self.assertEqual([None, 2], cache.get_many(["a", "b"]))
+
+    def test_defaultcache_stale_while_revalidate(self):
+        """
+        Test that entries past their TTL are still served during the grace period and
+        reported for refresh, and dropped after it
+        """
+        cache = InMemoryCache(ttl=0.05, stale_ttl=0.2)
+        cache.put("a", 1)
+        self.assertEqual([], cache.keys_to_refresh(["a", "missing"]))
+        time.sleep(0.08)
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual(["a"], cache.keys_to_refresh(["a", "missing"]))
+        cache.put("a", 2)
+        self.assertEqual([], cache.keys_to_refresh(["a"]))
+        time.sleep(0.3)
+        self.assertIsNone(cache.get("a"))
+
+    def test_defaultcache_refresh_ahead(self):
+        """
+        Test that entries are reported for refresh during the last part of their TTL
+        """
+        cache = InMemoryCache(ttl=0.2, refresh_ahead=0.5)
+        cache.put("a", 1)
+        self.assertEqual([], cache.keys_to_refresh(["a"]))
+        time.sleep(0.12)
+        self.assertEqual(["a"], cache.keys_to_refresh(["a"]))
+        self.assertEqual(1, cache.get("a"))
+
+    def test_defaultcache_ttl_jitter(self):
+        """
+        Test that TTL jitter spreads the expiration of entries written together
+        """
+        cache = InMemoryCache(ttl=100, ttl_jitter=0.2)
+        cache.put_many({str(i): i for i in range(50)})
+        expirations = {value[2] for value in cache._cache.values()}
+        self.assertGreater(len(expirations), 1)
+        now = cache._cache.timer()
+        self.assertTrue(all(now + 79 < expiration < now + 121 for expiration in expirations))
+
+    def test_defaultcache_invalid_refresh_settings(self):
+        """
+        Test that out of range stale and refresh settings are rejected
+        """
+        with self.assertRaises(ValueError):
+            InMemoryCache(stale_ttl=-1)
+        with self.assertRaises(ValueError):
+            InMemoryCache(refresh_ahead=1)
+        with self.assertRaises(ValueError):
+            InMemoryCache(ttl_jitter=-0.1)
+
+    def test_defaultcache_compact_storage(self):
+        """
+        Test that compact entries are stored as bytes, optionally compressed, and decoded on hit
+        """
+        info = IpInfo.model_validate({'ip': '8.8.8.8', 'location': {'city': 'Mountain View'},
+                                      'security': {'is_vpn': False}})
+        sizes = []
+        for compress in (False, True):
+            cache = InMemoryCache(compact=True, compress=compress, ttl=100, stale_ttl=10)
+            cache.put_many({"a": info, "b": {"raw": [1, 2]}})
+            self.assertTrue(all(isinstance(value[0], bytes) for value in cache._cache.values()))
+            self.assertEqual([info, {"raw": [1, 2]}, None], cache.get_many(["a", "b", "c"]))
+            sizes.append(len(cache._cache["a"][0]))
+        self.assertLess(sizes[1], sizes[0])
+
+    def test_defaultcache_max_bytes(self):
+        """
+        Test that compact entries are evicted by total serialized size and oversized entries are not cached
+        """
+        cache = InMemoryCache(maxsize=2, compact=True, max_bytes=100)
+        cache.put_many({str(i): "x" * 20 for i in range(4)})
+        self.assertEqual(4, len(cache._cache))
+        cache.put("4", "x" * 40)
+        self.assertLessEqual(cache._cache.currsize, 100)
+        self.assertEqual([None, "x" * 20, "x" * 40], cache.get_many(["0", "3", "4"]))
+        cache.put("3", "x" * 200)
+        self.assertIsNone(cache.get("3"))
+        with self.assertRaises(ValueError):
+            InMemoryCache(compress=True)
+        with self.assertRaises(ValueError):
+            InMemoryCache(compact=True, max_bytes=0)
+
+    def test_defaultcache_max_bytes_estimates_objects(self):
+        """
+        Test that object entries are evicted by estimated footprint and the byte usage is reported
+        """
+        small = IpInfo(ip='8.8.8.8')
+        large = AutonomousSystem.model_validate({
+            'asn': 15169, 'prefixes': {'ipv4': [{'cidr': '8.8.{}.0/24'.format(i)} for i in range(200)]}})
+        cache = InMemoryCache(maxsize=10, max_bytes=150000)
+        self.assertIsNone(InMemoryCache().bytes_used)
+        self.assertEqual(0, cache.bytes_used)
+
+        cache.put("small", small)
+        small_size = cache.bytes_used
+        self.assertGreater(small_size, 0)
+        cache.put("large", large)
+        self.assertGreater(cache.bytes_used - small_size, 50 * small_size)
+
+        cache.put_many({str(i): IpInfo(ip='1.1.1.{}'.format(i)) for i in range(40)})
+        self.assertLessEqual(cache.bytes_used, 150000)
+        self.assertIsNone(cache.get("large"))
+        cache.invalidate_all()
+        self.assertEqual(0, cache.bytes_used)
+
+    def test_ttl_policy(self):
+        """
+        Test that TTL policies choose TTLs by the populated fields of entries, then by their type
+        """
+        policy = TtlPolicy(default=600, by_type={AutonomousSystem: 86400, 'UserAgent': 3600},
+                           by_field={'security': 60, 'location': 7200})
+        self.assertEqual(60, policy.ttl(IpInfo.model_validate({'location': {}, 'security': {}})))
+        self.assertEqual(7200, policy.ttl(IpInfo.model_validate({'location': {'city': 'Paris'}})))
+        self.assertEqual(600, policy.ttl(IpInfo(ip='8.8.8.8')))
+        self.assertEqual(86400, policy.ttl(RequesterAutonomousSystem(asn=15169)))
+        self.assertEqual(3600, policy.ttl(UserAgent(header='curl')))
+        self.assertEqual(600, policy.ttl({'raw': 1}))
+        with self.assertRaises(ValueError):
+            TtlPolicy(by_field={'security': -1})
+
+    def test_defaultcache_ttl_policy(self):
+        """
+        Test that cache backends expire entries after the TTL chosen by their policy
+        """
+        policy = TtlPolicy(default=10, by_field={'security': 0.05})
+        threat = IpInfo.model_validate({'ip': '8.8.8.8', 'security': {'is_tor': False}})
+        location = IpInfo.model_validate({'ip': '8.8.8.8', 'location': {'city': 'Paris'}})
+        with tempfile.TemporaryDirectory() as directory:
+            caches = [InMemoryCache(ttl=policy), InMemoryCache(ttl=policy, compact=True), TinyLfuCache(ttl=policy),
+                      SqliteCache(os.path.join(directory, "cache.db"), ttl=policy)]
+            for cache in caches:
+                cache.put_many({"threat": threat, "location": location})
+            time.sleep(0.08)
+            for cache in caches:
+                self.assertEqual([None, location], cache.get_many(["threat", "location"]))
+            caches[-1].close()
+
+    def test_concurrentcache_keys_to_refresh(self):
+        """
+        Test that the concurrent cache forwards refresh settings to its segments
+        """
+        cache = ConcurrentInMemoryCache(ttl=0.05, segments=4, stale_ttl=10)
+        cache.put_many({str(i): i for i in range(8)})
+        time.sleep(0.08)
+        self.assertEqual(list(range(8)), cache.get_many([str(i) for i in range(8)]))
+        self.assertEqual({str(i) for i in range(8)}, set(cache.keys_to_refresh([str(i) for i in range(8)])))
+
+    def test_concurrentcache_compact_storage(self):
+        """
+        Test that the concurrent cache forwards compact storage settings and splits max_bytes across segments
+        """
+        cache = ConcurrentInMemoryCache(segments=4, compact=True, compress=True, max_bytes=4000)
+        cache.put_many({str(i): {"value": i} for i in range(8)})
+        self.assertEqual([{"value": i} for i in range(8)], cache.get_many([str(i) for i in range(8)]))
+        self.assertTrue(all(segment._cache.maxsize == 1000 for segment in cache._segments))
+        self.assertEqual(sum(segment.bytes_used for segment in cache._segments), cache.bytes_used)
+        self.assertIsNone(ConcurrentInMemoryCache().bytes_used)
+
+    def test_concurrentcache_bulk_operations(self):
+        """
+        Test that bulk operations on the concurrent cache preserve key order across segments
+        """
+        cache = ConcurrentInMemoryCache(segments=4)
+        cache.put_many({str(i): i for i in range(32)})
+        keys = [str(i) for i in range(31, -1, -1)] + ["missing"]
+        self.assertEqual(list(range(31, -1, -1)) + [None], cache.get_many(keys))
+        cache.invalidate_many(["0", "1"])
+        self.assertEqual([None, None, 2], cache.get_many(["0", "1", "2"]))
+
+    def test_concurrentcache_get_put_invalidate(self):
+        """
+        Test that the concurrent cache behaves like the in-memory cache
+        """
+        cache = ConcurrentInMemoryCache(segments=4)
+        self.assertEqual(None, cache.get("a"))
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(1, cache.get("a"))
+        cache.invalidate("a")
+        self.assertEqual(None, cache.get("a"))
+        self.assertEqual(2, cache.get("b"))
+        cache.invalidate_all()
+        self.assertEqual(None, cache.get("b"))
+
+    def test_concurrentcache_threads(self):
+        """
+        Test that concurrent puts and gets from many threads keep every entry
+        """
+        cache = ConcurrentInMemoryCache(maxsize=4096, segments=8)
+
+        def worker(thread_id):
+            for i in range(200):
+                key = "{}-{}".format(thread_id, i)
+                cache.put(key, i)
+                self.assertEqual(i, cache.get(key))
+
+        threads = [threading.Thread(target=worker, args=(t,)) for t in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(199, cache.get("15-199"))
+
+    def test_concurrentcache_invalid_segments(self):
+        """
+        Test that a segment count lower than 1 is rejected
+        """
+        with self.assertRaises(ValueError):
+            ConcurrentInMemoryCache(segments=0)
+
+    def test_tinylfucache_get_put_invalidate(self):
+        """
+        Test that the TinyLFU cache stores, expires and invalidates entries
+        """
+        cache = TinyLfuCache(maxsize=16, ttl=0.05)
+        self.assertIsNone(cache.get("a"))
+        cache.put_many({"a": 1, "b": 2})
+        cache.put("a", 3)
+        self.assertEqual([3, 2], cache.get_many(["a", "b"]))
+        cache.invalidate("a")
+        self.assertIsNone(cache.get("a"))
+        time.sleep(0.08)
+        self.assertIsNone(cache.get("b"))
+        cache.put("c", 4)
+        cache.invalidate_all()
+        self.assertIsNone(cache.get("c"))
+
+    def test_tinylfucache_resists_scans(self):
+        """
+        Test that a scan of one-off keys does not evict frequently requested entries
+        """
+        hot = ["hot-{}".format(i) for i in range(50)]
+        caches = [InMemoryCache(maxsize=100), TinyLfuCache(maxsize=100)]
+        for cache in caches:
+            for _ in range(3):
+                for key in hot:
+                    if cache.get(key) is None:
+                        cache.put(key, key)
+            for i in range(5000):
+                key = "scan-{}".format(i)
+                if cache.get(key) is None:
+                    cache.put(key, key)
+        lru, tinylfu = [sum(cache.get(key) is not None for key in hot) for cache in caches]
+        self.assertEqual(0, lru)
+        self.assertGreaterEqual(tinylfu, 45)
+        self.assertGreater(caches[1].rejected, 4000)
+
+    def test_tinylfucache_invalid_settings(self):
+        """
+        Test that invalid TinyLFU cache settings are rejected
+        """
+        with self.assertRaises(ValueError):
+            TinyLfuCache(maxsize=1)
+        with self.assertRaises(ValueError):
+            TinyLfuCache(window=1)
+
+    def test_tieredcache_promotes_and_counts_per_tier(self):
+        """
+        Test that tiered lookups read each tier for the previous tiers' misses and promote hits
+        """
+        l1 = InMemoryCache(maxsize=2)
+        l2 = InMemoryCache(maxsize=100)
+        cache = TieredCache([l1, l2])
+        cache.put_many({str(i): i for i in range(5)})
+        self.assertEqual([None, None, None, 3, 4], l1.get_many([str(i) for i in range(5)]))
+
+        self.assertEqual([0, 3, None], cache.get_many(["0", "3", "missing"]))
+        self.assertEqual(0, l1.get("0"))
+        l1_statistics, l2_statistics = cache.statistics
+        self.assertEqual((1, 2, 1), (l1_statistics.hits, l1_statistics.misses, l1_statistics.reads))
+        self.assertEqual((1, 1, 1), (l2_statistics.hits, l2_statistics.misses, l2_statistics.reads))
+        self.assertAlmostEqual(0.5, l2_statistics.hit_rate)
+        self.assertGreater(l2_statistics.average_latency, 0)
+
+        cache.invalidate_many(["3", "4"])
+        self.assertEqual([None, None], l2.get_many(["3", "4"]))
+        cache.invalidate_all()
+        self.assertIsNone(cache.get("1"))
+
+    def test_tieredcache_write_behind(self):
+        """
+        Test that write-behind writes reach the lower tiers in batches and are readable before
+        """
+        l1 = InMemoryCache(maxsize=1)
+        l2 = InMemoryCache(maxsize=100)
+        cache = TieredCache([l1, l2], write_behind=True, write_batch_size=3)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual([None, None], l2.get_many(["a", "b"]))
+        self.assertEqual([1, 2], cache.get_many(["a", "b"]))
+        cache.put("c", 3)
+        self.assertEqual([1, 2, 3], l2.get_many(["a", "b", "c"]))
+        cache.put("d", 4)
+        cache.close()
+        self.assertEqual(4, l2.get("d"))
+        with self.assertRaises(ValueError):
+            TieredCache([])
+        with self.assertRaises(ValueError):
+            TieredCache([l1, "l2"])
+
+    def test_prefixcache_shares_prefix_fields(self):
+        """
+        Test that missed IPs are answered with the shared fields of an entry in the longest matching route
+        """
+        def key(ip, **options):
+            return _build_cache_key('ip', ip, options)
+
+        def info(ip, route, city):
+            return IpInfo.model_validate({
+                'ip': ip, 'type': 'IPv4', 'hostname': 'host.example', 'connection': {'asn': 64500, 'route': route},
+                'location': {'city': city}, 'security': {'is_cloud_provider': True, 'is_vpn': True}})
+
+        cache = PrefixCache(InMemoryCache(), security_policy='network')
+        cache.put_many({key('100.64.1.2'): info('100.64.1.2', '100.64.0.0/16', 'Paris'),
+                        key('100.64.9.1'): info('100.64.9.1', '100.64.9.0/24', 'Lyon')})
+
+        shared = cache.get(key('100.64.200.9'))
+        self.assertEqual(('100.64.200.9', 'IPv4', 'Paris', 64500), (
+            shared.ip, shared.type, shared.location.city, shared.connection.asn))
+        self.assertIsNone(shared.hostname)
+        self.assertEqual((True, None), (shared.security.is_cloud_provider, shared.security.is_vpn))
+        self.assertEqual('Lyon', cache.get_many([key('100.64.9.200')])[0].location.city)
+        self.assertEqual([None, None], cache.get_many([key('100.65.0.1'), key('100.64.200.9', hostname=True)]))
+        self.assertEqual(2, cache.prefix_hits)
+
+        cache.invalidate(key('100.64.9.1'))
+        self.assertEqual('Paris', cache.get(key('100.64.9.200')).location.city)
+        cache.cache.invalidate(key('100.64.1.2'))
+        self.assertIsNone(cache.get(key('100.64.200.9')))
+
+    def test_prefixcache_settings(self):
+        """
+        Test that prefix sharing honors the security policy, shared fields and route length limits
+        """
+        key = _build_cache_key('ip', '10.1.2.3', {})
+        entry = IpInfo.model_validate({'ip': '10.1.2.3', 'connection': {'route': '10.1.0.0/16'},
+                                       'location': {'city': 'Paris'}, 'security': {'is_vpn': True}})
+        cache = PrefixCache(InMemoryCache(), shared_fields=('connection',), security_policy='include')
+        cache.put(key, entry)
+        shared = cache.get(_build_cache_key('ip', '10.1.9.9', {}))
+        self.assertIsNone(shared.location)
+        self.assertTrue(shared.security.is_vpn)
+
+        cache = PrefixCache(InMemoryCache(), min_ipv4_prefixlen=24)
+        cache.put(key, entry)
+        self.assertIsNone(cache.get(_build_cache_key('ip', '10.1.9.9', {})))
+
+        cache = PrefixCache(InMemoryCache(), max_prefixes=1)
+        cache.put(key, entry)
+        cache.put(_build_cache_key('ip', '10.2.0.1', {}), entry.model_copy(
+            update={'ip': '10.2.0.1', 'connection': Connection(route='10.2.0.0/16')}))
+        self.assertIsNone(cache.get(_build_cache_key('ip', '10.1.9.9', {})))
+        self.assertIsNotNone(cache.get(_build_cache_key('ip', '10.2.9.9', {})))
+
+        for kwargs in ({'shared_fields': ('hostname',)}, {'security_policy': 'clean'}, {'max_prefixes': 0}):
+            with self.assertRaises(ValueError):
+                PrefixCache(InMemoryCache(), **kwargs)
+
+    def test_sqlitecache_persists_across_instances(self):
+        """
+        Test that entries written by a SqliteCache are read back by a new instance
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.db')
+            cache = SqliteCache(path)
+            cache.put('8.8.8.8', IpInfo(ip='8.8.8.8', type='IPv4'))
+            cache.put('counter', 1)
+            cache.close()
+
+            cache = SqliteCache(path)
+            value = cache.get('8.8.8.8')
+            self.assertIsInstance(value, IpInfo)
+            self.assertEqual('IPv4', value.type)
+            self.assertEqual(1, cache.get('counter'))
+            cache.close()
+
+    def test_sqlitecache_buffers_writes(self):
+        """
+        Test that buffered writes are visible before being committed in a batch
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.db')
+            cache = SqliteCache(path, write_batch_size=3)
+            cache.put('a', 1)
+            cache.put('b', 2)
+            self.assertEqual([1, 2, None], cache.get_many(['a', 'b', 'c']))
+            reader = SqliteCache(path)
+            self.assertEqual(None, reader.get('a'))
+            cache.put('c', 3)
+            self.assertEqual([1, 2, 3], reader.get_many(['a', 'b', 'c']))
+            reader.close()
+            cache.close()
+
+    @unittest.skipIf(not hasattr(os, 'fork'), "fork is not available")
+    def test_sqlitecache_forked_process(self):
+        """
+        Test that a forked child opens its own connection and does not write the buffered entries of its parent
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.db')
+            cache = SqliteCache(path, write_batch_size=10)
+            cache.put('from-parent', 1)
+            inherited = cache._connections[0]
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    cache.put_many({'from-child': 42})
+                    if cache.get_many(['from-parent', 'from-child']) == [None, 42] \
+                            and inherited not in cache._connections:
+                        status = 0
+                finally:
+                    os._exit(status)
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(0, status)
+            reader = SqliteCache(path)
+            self.assertEqual([None, 42], reader.get_many(['from-parent', 'from-child']))
+            cache.close()
+            self.assertEqual([1, 42], reader.get_many(['from-parent', 'from-child']))
+            reader.close()
+
+    def test_sqlitecache_ttl_and_invalidation(self):
+        """
+        Test that expired and invalidated entries are no longer returned
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            cache = SqliteCache(os.path.join(directory, 'cache.db'), ttl=0.05)
+            cache.put_many({'a': 1, 'b': 2, 'c': 3})
+            cache.invalidate('a')
+            self.assertEqual([None, 2, 3], cache.get_many(['a', 'b', 'c']))
+            cache.invalidate_all()
+            self.assertEqual(None, cache.get('b'))
+            cache.put_many({'d': 4})
+            time.sleep(0.1)
+            self.assertEqual(None, cache.get('d'))
+            cache.close()
+
+    def test_sqlitecache_ignores_other_schema_versions(self):
+        """
+        Test that entries tagged with another schema version are treated as misses
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.db')
+            cache = SqliteCache(path)
+            cache.put_many({'a': 1})
+            cache.close()
+
+            connection = sqlite3.connect(path)
+            with connection:
+                connection.execute("UPDATE entries SET schema = 'outdated'")
+            connection.close()
+
+            cache = SqliteCache(path)
+            self.assertEqual(None, cache.get('a'))
+            cache.close()
+
+    def test_sqlitecache_maxsize(self):
+        """
+        Test that the entries closest to expiration are evicted beyond maxsize
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            cache = SqliteCache(os.path.join(directory, 'cache.db'), maxsize=2)
+            cache.put_many({'a': 1})
+            cache.put_many({'b': 2})
+            cache.put_many({'c': 3})
+            self.assertEqual([None, 2, 3], cache.get_many(['a', 'b', 'c']))
+            cache.close()
+
+    @unittest.skipIf(fcntl is None, "fcntl is not available")
+    def test_sharedmemorycache_shared_between_instances(self):
+        """
+        Test that entries written through one mapping are read through another one
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.shm')
+            writer = SharedMemoryCache(path, slots=64)
+            reader = SharedMemoryCache(path, slots=64)
+            writer.put('8.8.8.8', IpInfo(ip='8.8.8.8', type='IPv4'))
+            writer.put_many({'a': 1, b'b': 2})
+            self.assertEqual('IPv4', reader.get('8.8.8.8').type)
+            self.assertEqual([1, 2, None], reader.get_many(['a', b'b', 'b']))
+            reader.invalidate('a')
+            self.assertEqual(None, writer.get('a'))
+            writer.invalidate_all()
+            self.assertEqual(None, reader.get('8.8.8.8'))
+            writer.close()
+            reader.close()
+
+    @unittest.skipIf(fcntl is None, "fcntl is not available")
+    def test_sharedmemorycache_shared_with_forked_process(self):
+        """
+        Test that a forked child writes entries visible to its parent
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            cache = SharedMemoryCache(os.path.join(directory, 'cache.shm'), slots=64)
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    cache.put('from-child', 42)
+                finally:
+                    os._exit(0)
+            os.waitpid(pid, 0)
+            self.assertEqual(42, cache.get('from-child'))
+            cache.close()
+
+    @unittest.skipIf(fcntl is None, "fcntl is not available")
+    def test_sharedmemorycache_eviction_and_limits(self):
+        """
+        Test that a full table evicts entries, expired entries are ignored
+        and oversized entries are not cached
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            cache = SharedMemoryCache(os.path.join(directory, 'cache.shm'), slots=4, slot_size=64)
+            cache.put_many({str(i): i for i in range(10)})
+            self.assertEqual(4, sum(value is not None for value in cache.get_many([str(i) for i in range(10)])))
+            cache.put('large', 'x' * 100)
+            self.assertEqual(None, cache.get('large'))
+
+            expiring = SharedMemoryCache(os.path.join(directory, 'expiring.shm'), ttl=0.05, slots=4)
+            expiring.put('a', 1)
+            time.sleep(0.1)
+            self.assertEqual(None, expiring.get('a'))
+            cache.close()
+            expiring.close()
+
+    @unittest.skipIf(fcntl is None, "fcntl is not available")
+    def test_sharedmemorycache_rejects_other_layout(self):
+        """
+        Test that a file created with another layout is rejected instead of resized or misread
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.shm')
+            cache = SharedMemoryCache(path, slots=8, slot_size=256)
+            cache.put('a', 1)
+            with self.assertRaises(ValueError):
+                SharedMemoryCache(path, slots=16, slot_size=256)
+            with self.assertRaises(ValueError):
+                SharedMemoryCache(path, slots=16, slot_size=128)
+            self.assertEqual(1, cache.get('a'))
+            cache.close()
+
+    def test_sharedmemorycache_reset_on_schema_change(self):
+        """
+        Test that a file written with another schema version is reset in place
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.shm')
+            cache = SharedMemoryCache(path, slots=8)
+            cache.put('a', 1)
+            cache.close()
+            with open(path, 'r+b') as file:
+                file.seek(16)
+                file.write(b'0' * 16)
+            size = os.path.getsize(path)
+            cache = SharedMemoryCache(path, slots=8)
+            self.assertEqual(None, cache.get('a'))
+            self.assertEqual(size, os.path.getsize(path))
+            cache.close()
+
+    def test_snapshot_round_trip(self):
+        """
+        Test that snapshots reload live entries and their remaining TTLs into every cache backend
+        """
+        ip_info = IpInfo.model_validate({'ip': '8.8.8.8', 'location': {'city': 'Mountain View'}})
+        entries = {_build_cache_key('ip', '8.8.8.8', {}): ip_info, "asn": {"asn": 15169}, "short": 1}
+        with tempfile.TemporaryDirectory() as directory:
+            def backends():
+                return [InMemoryCache(), InMemoryCache(compact=True, compress=True),
+                        ConcurrentInMemoryCache(segments=4, compact=True), TinyLfuCache(),
+                        SqliteCache(os.path.join(directory, "cache-{}.db".format(time.monotonic_ns()))),
+                        SharedMemoryCache(os.path.join(directory, "cache-{}.shm".format(time.monotonic_ns())),
+                                          slots=64, slot_size=1024),
+                        TieredCache([InMemoryCache(), InMemoryCache()], write_behind=True)]
+
+            for source, target in zip(backends(), backends()):
+                source.put_many({key: value for key, value in entries.items() if key != "short"})
+                source._load_records([("short", b'\x001', 0.05)])
+                path = os.path.join(directory, "snapshot.bin")
+                self.assertEqual(3, source.export_snapshot(path))
+                self.assertEqual(3, target.load_snapshot(path))
+                self.assertEqual(list(entries.values()), target.get_many(list(entries)))
+                time.sleep(0.08)
+                self.assertEqual([ip_info, {"asn": 15169}, None], target.get_many(list(entries)))
+                self.assertEqual(2, target.load_snapshot(path))
+                for cache in (source, target):
+                    if hasattr(cache, 'close'):
+                        cache.close()
+
+    def test_snapshot_skips_expired_and_outdated_entries(self):
+        """
+        Test that loading a snapshot subtracts the time elapsed since its export and checks its format
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "snapshot.bin")
+            source = InMemoryCache(ttl=0.05)
+            source.put_many({str(i): i for i in range(100)})
+            self.assertEqual(100, source.export_snapshot(path))
+            time.sleep(0.08)
+            self.assertEqual(0, InMemoryCache().load_snapshot(path))
+
+            source = InMemoryCache()
+            source.put_many({str(i): i for i in range(100)})
+            source.export_snapshot(path)
+            with open(path, 'r+b') as file:
+                file.seek(8)
+                file.write(b'outdatedoutdated')
+            self.assertEqual(0, InMemoryCache().load_snapshot(path))
+
+            with open(path, 'wb') as file:
+                file.write(b'not a snapshot')
+            self.assertRaises(ValueError, InMemoryCache().load_snapshot, path)
+            source.export_snapshot(path)
+            with open(path, 'r+b') as file:
+                file.truncate(os.path.getsize(path) - 8)
+            self.assertRaises(ValueError, InMemoryCache().load_snapshot, path)
+
+    def test_snapshot_reindexes_prefix_cache(self):
+        """
+        Test that a prefix cache loading a snapshot indexes the routes of the loaded entries
+        """
+        source = PrefixCache(InMemoryCache(), min_ipv4_prefixlen=16)
+        source.put(_build_cache_key('ip', '8.8.8.8', {}), IpInfo.model_validate(
+            {'ip': '8.8.8.8', 'connection': Connection(asn=15169, route='8.8.8.0/24'),
+             'location': {'city': 'Mountain View'}}))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "snapshot.bin")
+            self.assertEqual(1, source.export_snapshot(path))
+            target = PrefixCache(InMemoryCache(), min_ipv4_prefixlen=16)
+            self.assertEqual(1, target.load_snapshot(path))
+            shared = target.get(_build_cache_key('ip', '8.8.8.4', {}))
+            self.assertEqual('8.8.8.4', shared.ip)
+            self.assertEqual('Mountain View', shared.location.city)
+            self.assertEqual(0, NoCache().export_snapshot(path))
+
     def test_nocache_get(self):
         """
         Test that get always returns None with NoCache implementation
@@ -72,6 +725,8 @@ class TestIpregistryCache(unittest.TestCase):
         self.assertEqual(None, cache.get("a"))
         cache.put("a", 1)
         self.assertEqual(None, cache.get("a"))
+        cache.put_many({"a": 1})
+        self.assertEqual([None], cache.get_many(["a"]))
 
 
 if __name__ == '__main__':
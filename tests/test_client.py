@@ -14,13 +14,17 @@
     limitations under the License.
 """
 
+import datetime
 import os
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
 from ipregistry import ApiError, AutonomousSystem, IpInfo, LookupError, ClientError, UserAgent
 from ipregistry.cache import InMemoryCache, NoCache
-from ipregistry.core import IpregistryClient, IpregistryConfig
-from ipregistry.model import ApiResponse, ApiResponseCredits, ApiResponseThrottling
+from ipregistry.core import IpregistryClient, IpregistryConfig, _build_cache_key, _with_current_time
+from ipregistry.model import ApiResponse, ApiResponseCredits, ApiResponseThrottling, IpregistryLookupError
 from ipregistry.model import RequesterAutonomousSystem, RequesterIpInfo
 from ipregistry.request import IpregistryRequestHandler
 
@@ -58,6 +62,90 @@ class CountingRequestHandler(IpregistryRequestHandler):
         return self.__response(UserAgent(header='curl'))
 
 
+class BlockingRequestHandler(CountingRequestHandler):
+    """Request handler stub whose requests block until released."""
+
+    def __init__(self, error=None):
+        super().__init__()
+        self.release = threading.Event()
+        self.error = error
+
+    def __wait(self):
+        self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+
+    def batch_lookup_ips(self, ips, options):
+        self.__wait()
+        return super().batch_lookup_ips(ips, options)
+
+    def lookup_ip(self, ip, options):
+        self.__wait()
+        return super().lookup_ip(ip, options)
+
+
+def run_in_threads(count, target):
+    """Run target in count threads and return the values or exceptions they produce."""
+    results = [None] * count
+
+    def run(index):
+        try:
+            results[index] = target()
+        except Exception as e:
+            results[index] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+class RecordingCache(InMemoryCache):
+    """In-memory cache recording the bulk operations it receives."""
+
+    def __init__(self):
+        super().__init__()
+        self.operations = []
+
+    def get_many(self, keys):
+        self.operations.append(('get_many', len(keys)))
+        return super().get_many(keys)
+
+    def put_many(self, entries):
+        self.operations.append(('put_many', len(entries)))
+        super().put_many(entries)
+
+
+class ThreadRecordingCache(InMemoryCache):
+    """In-memory cache recording the threads its bulk operations run on."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.threads = set()
+
+    def get_many(self, keys):
+        self.threads.add(threading.get_ident())
+        return super().get_many(keys)
+
+    def put_many(self, entries):
+        self.threads.add(threading.get_ident())
+        super().put_many(entries)
+
+
+class FailingCache(InMemoryCache):
+    """In-memory cache whose first bulk write fails, like a locked database."""
+
+    def __init__(self):
+        super().__init__()
+        self.failures = 1
+
+    def put_many(self, entries):
+        if self.failures > 0:
+            self.failures -= 1
+            raise OSError('database is locked')
+        super().put_many(entries)
+
+
 class TestIpregistryClient(unittest.TestCase):
     """Offline client tests that never hit the Ipregistry API."""
 
@@ -114,6 +202,500 @@ class TestIpregistryClient(unittest.TestCase):
         client.batch_lookup_ips(['1.1.1.1', '1.1.1.2'])
         self.assertEqual(1, handler.calls)
 
+    def test_batch_lookup_uses_bulk_cache_operations(self):
+        """
+        Test that batch lookups read and write the cache with one bulk call each
+        and only request the cache misses
+        """
+        handler = CountingRequestHandler()
+        cache = RecordingCache()
+        cache.put(_build_cache_key('ip', '1.1.1.2', {}), IpInfo(ip='1.1.1.2'))
+        client = IpregistryClient("tryout", cache=cache, requestHandler=handler, max_batch_size=2)
+
+        ips = ['1.1.1.{}'.format(i) for i in range(5)]
+        response = client.batch_lookup_ips(ips)
+
+        self.assertEqual(ips, [info.ip for info in response.data])
+        self.assertEqual([('get_many', 5), ('put_many', 4)], cache.operations)
+        self.assertEqual(2, handler.calls)
+
+    def test_concurrent_lookups_coalesced(self):
+        """
+        Test that concurrent lookups of the same IP issue a single request
+        """
+        handler = BlockingRequestHandler()
+        client = IpregistryClient("tryout", cache=InMemoryCache(), requestHandler=handler)
+
+        threads, results = run_in_threads(8, lambda: client.lookup_ip('8.8.8.8'))
+        time.sleep(0.05)
+        handler.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, handler.calls)
+        self.assertEqual(['8.8.8.8'] * 8, [response.data.ip for response in results])
+
+    def test_batch_waits_for_in_flight_lookup(self):
+        """
+        Test that batch items already requested by a concurrent lookup are not requested again
+        """
+        handler = BlockingRequestHandler()
+        client = IpregistryClient("tryout", requestHandler=handler)
+
+        threads, results = run_in_threads(1, lambda: client.lookup_ip('8.8.8.8'))
+        time.sleep(0.05)
+        batch_threads, batch_results = run_in_threads(
+            1, lambda: client.batch_lookup_ips(['1.1.1.1', '8.8.8.8']))
+        time.sleep(0.05)
+        handler.release.set()
+        for thread in threads + batch_threads:
+            thread.join()
+
+        self.assertEqual(2, handler.calls)
+        self.assertEqual(['1.1.1.1', '8.8.8.8'], [info.ip for info in batch_results[0].data])
+        self.assertEqual('8.8.8.8', results[0].data.ip)
+
+    def test_coalesced_lookup_failure_propagated(self):
+        """
+        Test that a failed request is reported to every coalesced caller
+        and that later lookups issue a new request
+        """
+        handler = BlockingRequestHandler(error=ClientError('boom'))
+        client = IpregistryClient("tryout", requestHandler=handler)
+
+        threads, results = run_in_threads(4, lambda: client.lookup_ip('8.8.8.8'))
+        time.sleep(0.05)
+        handler.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(all(isinstance(result, ClientError) for result in results))
+        handler.error = None
+        self.assertEqual('8.8.8.8', client.lookup_ip('8.8.8.8').data.ip)
+
+    def test_cache_write_failures_ignored(self):
+        """
+        Test that lookups succeed and release their in-flight keys when the cache fails to store results
+        """
+        handler = CountingRequestHandler()
+        cache = FailingCache()
+        client = IpregistryClient("tryout", cache=cache, requestHandler=handler)
+
+        self.assertEqual(['8.8.8.8', '1.1.1.1'], [info.ip for info in client.batch_lookup_ips(
+            ['8.8.8.8', '1.1.1.1']).data])
+        self.assertEqual('8.8.8.8', client.lookup_ip('8.8.8.8').data.ip)
+        self.assertEqual(0, len(client._in_flight._futures))
+        self.assertEqual(2, handler.calls)
+        self.assertEqual('8.8.8.8', client.lookup_ip('8.8.8.8').data.ip)
+        self.assertEqual(2, handler.calls)
+
+    def test_stale_entries_served_while_refreshed_once(self):
+        """
+        Test that stale entries are served right away while a single background
+        request refreshes them, for single and batch lookups
+        """
+        handler = BlockingRequestHandler()
+        handler.release.set()
+        cache = InMemoryCache(ttl=0.05, stale_ttl=10)
+        client = IpregistryClient("tryout", cache=cache, requestHandler=handler)
+        client.batch_lookup_ips(['1.1.1.1', '8.8.8.8'])
+        time.sleep(0.08)
+
+        handler.release.clear()
+        start = time.monotonic()
+        for _ in range(5):
+            self.assertEqual('8.8.8.8', client.lookup_ip('8.8.8.8').data.ip)
+        response = client.batch_lookup_ips(['1.1.1.1', '8.8.8.8', '1.1.1.1'])
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(['1.1.1.1', '8.8.8.8', '1.1.1.1'], [info.ip for info in response.data])
+
+        handler.release.set()
+        client.close()
+        self.assertEqual(3, handler.calls)
+        self.assertEqual(2, client.statistics.refreshes)
+        self.assertEqual([], cache.keys_to_refresh(['1.1.1.1', '8.8.8.8']))
+
+    def test_refreshed_entries_stored_on_caller_thread(self):
+        """
+        Test that entries refreshed in the background are stored by the next lookup on its caller's thread
+        """
+        handler = CountingRequestHandler()
+        cache = ThreadRecordingCache(ttl=0.05, stale_ttl=10)
+        client = IpregistryClient("tryout", cache=cache, requestHandler=handler)
+        client.batch_lookup_ips(['1.1.1.1', '8.8.8.8'])
+        time.sleep(0.08)
+
+        client.batch_lookup_ips(['1.1.1.1', '8.8.8.8'])
+        keys = [_build_cache_key('ip', ip, {}) for ip in ['1.1.1.1', '8.8.8.8']]
+        deadline = time.monotonic() + 2
+        while len(client._refreshed) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(2, len(cache.keys_to_refresh(keys)))
+
+        client.lookup_ip('9.9.9.9')
+        self.assertEqual([], cache.keys_to_refresh(keys))
+        self.assertEqual({threading.get_ident()}, cache.threads)
+        client.close()
+
+    def test_failed_refresh_keeps_serving_stale_entry(self):
+        """
+        Test that a failed background refresh is not raised to callers
+        """
+        handler = BlockingRequestHandler()
+        handler.release.set()
+        client = IpregistryClient("tryout", cache=InMemoryCache(ttl=0.05, stale_ttl=10), requestHandler=handler)
+        client.lookup_ip('8.8.8.8')
+        time.sleep(0.08)
+
+        handler.error = ClientError('boom')
+        self.assertEqual('8.8.8.8', client.lookup_ip('8.8.8.8').data.ip)
+        client.close()
+        self.assertEqual('8.8.8.8', client.lookup_ip('8.8.8.8').data.ip)
+
+    def test_deterministic_lookup_errors_negatively_cached(self):
+        """
+        Test that deterministic per-item errors are answered from the negative cache
+        while transient ones are requested again
+        """
+        errors = {'10.0.0.1': 'RESERVED_IP_ADDRESS', 'invalid': 'INVALID_IP_ADDRESS', '1.1.1.1': 'INTERNAL'}
+        requested = []
+
+        class ErrorHandler(CountingRequestHandler):
+            def batch_lookup_ips(self, ips, options):
+                requested.extend(ips)
+                response = super().batch_lookup_ips(ips, options)
+                response.data = [IpregistryLookupError({'code': errors[ip], 'message': 'Error.'}) if ip in errors
+                                 else info for ip, info in zip(ips, response.data)]
+                return response
+
+            def lookup_ip(self, ip, options):
+                requested.append(ip)
+                if ip in errors:
+                    raise ApiError(errors[ip], 'Error.', 'Fix it.')
+                return super().lookup_ip(ip, options)
+
+        client = IpregistryClient("tryout", cache=InMemoryCache(), negative_cache=InMemoryCache(maxsize=16, ttl=60),
+                                  requestHandler=ErrorHandler())
+        ips = ['10.0.0.1', 'invalid', '1.1.1.1', '8.8.8.8']
+        client.batch_lookup_ips(ips)
+        response = client.batch_lookup_ips(ips)
+
+        self.assertEqual(ips + ['1.1.1.1'], requested)
+        self.assertEqual(['RESERVED_IP_ADDRESS', 'INVALID_IP_ADDRESS', 'INTERNAL'],
+                         [error.code for error in response.data[:3]])
+        self.assertIsInstance(response.data[0], IpregistryLookupError)
+
+        with self.assertRaises(ApiError) as context:
+            client.lookup_ip('invalid')
+        self.assertEqual('INVALID_IP_ADDRESS', context.exception.code)
+        with self.assertRaises(ApiError):
+            client.lookup_ip('1.1.1.1')
+        self.assertEqual(ips + ['1.1.1.1', '1.1.1.1'], requested)
+
+    def test_single_lookup_errors_negatively_cached(self):
+        """
+        Test that a deterministic error raised by a single lookup is cached and raised again
+        """
+        class ReservedHandler(CountingRequestHandler):
+            def lookup_ip(self, ip, options):
+                self.calls += 1
+                raise ApiError('RESERVED_IP_ADDRESS', 'Reserved.', 'Use a public IP.')
+
+        handler = ReservedHandler()
+        client = IpregistryClient("tryout", negative_cache=InMemoryCache(), requestHandler=handler)
+        for _ in range(3):
+            with self.assertRaises(ApiError) as context:
+                client.lookup_ip('192.168.1.1')
+            self.assertEqual('Use a public IP.', context.exception.resolution)
+        self.assertEqual(1, handler.calls)
+        self.assertEqual(2, client.statistics.cache_hits)
+
+    def test_transient_codes_cannot_be_negatively_cached(self):
+        """
+        Test that transient or unknown error codes are rejected from the negative cache configuration
+        """
+        with self.assertRaises(ValueError):
+            IpregistryClient("tryout", negative_cache=InMemoryCache(), negative_cache_codes=['TOO_MANY_REQUESTS'])
+        with self.assertRaises(ValueError):
+            IpregistryClient("tryout", negative_cache=InMemoryCache(), negative_cache_codes=['NOT_A_CODE'])
+        with self.assertRaises(ValueError):
+            IpregistryClient("tryout", negative_cache={})
+
+    def test_reserved_and_invalid_ips_short_circuited(self):
+        """
+        Test that reserved and malformed IPs are answered locally, without being requested
+        """
+        requested = []
+
+        class RecordingHandler(CountingRequestHandler):
+            def batch_lookup_ips(self, ips, options):
+                requested.extend(ips)
+                return super().batch_lookup_ips(ips, options)
+
+        handler = RecordingHandler()
+        client = IpregistryClient("tryout", requestHandler=handler, local_ip_validation=True, max_batch_size=1)
+        response = client.batch_lookup_ips(['10.0.0.1', '8.8.8.8', 'garbage', '::1', '1.1.1.1'])
+
+        self.assertEqual(['8.8.8.8', '1.1.1.1'], requested)
+        self.assertEqual(['RESERVED_IP_ADDRESS', 'INVALID_IP_ADDRESS', 'RESERVED_IP_ADDRESS'],
+                         [response.data[i].code for i in (0, 2, 3)])
+        self.assertEqual(['8.8.8.8', '1.1.1.1'], [response.data[i].ip for i in (1, 4)])
+
+        with self.assertRaises(ApiError) as context:
+            client.lookup_ip('192.168.1.1')
+        self.assertEqual('RESERVED_IP_ADDRESS', context.exception.code)
+        self.assertEqual(2, handler.calls)
+        self.assertEqual(4, client.statistics.short_circuited)
+        self.assertEqual(0, client.statistics.cache_hits)
+
+    def test_origin_lookup_not_short_circuited(self):
+        """
+        Test that the empty string standing for the origin IP is still looked up
+        """
+        client = IpregistryClient("tryout", requestHandler=CountingRequestHandler(), local_ip_validation=True)
+        self.assertEqual('4.4.4.4', client.lookup_ip('').data.ip)
+
+    def test_batch_lookup_deduplicates_items(self):
+        """
+        Test that repeated items are sent once, across chunks too, and that
+        every position receives the result
+        """
+        requested = []
+
+        class RecordingHandler(CountingRequestHandler):
+            def batch_lookup_ips(self, ips, options):
+                requested.extend(ips)
+                return super().batch_lookup_ips(ips, options)
+
+        handler = RecordingHandler()
+        client = IpregistryClient("tryout", requestHandler=handler, max_batch_size=2)
+
+        ips = ['1.1.1.1', '8.8.8.8', '1.1.1.1', '8.8.4.4', '8.8.8.8', '1.1.1.1']
+        response = client.batch_lookup_ips(ips)
+
+        self.assertEqual(ips, [info.ip for info in response.data])
+        self.assertEqual(['1.1.1.1', '8.8.8.8', '8.8.4.4'], requested)
+        self.assertEqual(2, handler.calls)
+        self.assertEqual(3, client.statistics.deduplicated)
+        self.assertEqual(3, client.statistics.sends_saved)
+
+    def test_statistics(self):
+        """
+        Test that cache hits, misses and consumed credits are counted
+        """
+        class CreditsHandler(CountingRequestHandler):
+            def batch_lookup_ips(self, ips, options):
+                response = super().batch_lookup_ips(ips, options)
+                response.credits.consumed = len(ips)
+                return response
+
+        client = IpregistryClient("tryout", cache=InMemoryCache(), requestHandler=CreditsHandler())
+        client.batch_lookup_ips(['1.1.1.1', '1.1.1.2'])
+        client.batch_lookup_ips(['1.1.1.1', '1.1.1.3'])
+        client.lookup_ip('1.1.1.3')
+
+        statistics = client.statistics
+        self.assertEqual(2, statistics.cache_hits)
+        self.assertEqual(3, statistics.cache_misses)
+        self.assertEqual(3, statistics.credits_consumed)
+        self.assertAlmostEqual(0.4, statistics.hit_rate)
+        self.assertIn('hit_rate=0.400', str(statistics))
+
+    def test_iter_lookup_ips_streams_in_order(self):
+        """
+        Test that iter_lookup_ips reads its input lazily and yields entries in input order
+        """
+        handler = CountingRequestHandler()
+        client = IpregistryClient("tryout", requestHandler=handler, max_batch_size=3, batch_concurrency=2)
+        consumed = []
+
+        def ips():
+            for i in range(20):
+                consumed.append(i)
+                yield '1.1.{}.{}'.format(i // 256, i % 256)
+
+        entries = client.iter_lookup_ips(ips())
+        self.assertEqual('1.1.0.0', next(entries).ip)
+        self.assertLessEqual(len(consumed), 9)
+
+        self.assertEqual(['1.1.0.{}'.format(i) for i in range(1, 20)], [entry.ip for entry in entries])
+        self.assertEqual(7, handler.calls)
+
+    def test_iter_lookup_ips_uses_cache_on_consuming_thread(self):
+        """
+        Test that iter_lookup_ips reads and writes the cache on the consuming thread only
+        """
+        handler = CountingRequestHandler()
+        cache = ThreadRecordingCache()
+        client = IpregistryClient("tryout", cache=cache, requestHandler=handler, max_batch_size=3,
+                                  batch_concurrency=4)
+        ips = ['1.1.1.{}'.format(i) for i in range(20)]
+
+        self.assertEqual(ips, [entry.ip for entry in client.iter_lookup_ips(ips)])
+        self.assertEqual(ips, [entry.ip for entry in client.iter_lookup_ips(ips)])
+        self.assertEqual({threading.get_ident()}, cache.threads)
+        self.assertEqual(7, handler.calls)
+
+        entries = client.iter_lookup_ips(['2.2.2.{}'.format(i) for i in range(20)])
+        next(entries)
+        entries.close()
+        self.assertEqual('2.2.2.5', client.lookup_ip('2.2.2.5').data.ip)
+
+    def test_iter_lookup_ips_sequential(self):
+        """
+        Test that iter_lookup_ips also works with batch_concurrency=1 and uses the cache
+        """
+        handler = CountingRequestHandler()
+        client = IpregistryClient("tryout", cache=InMemoryCache(), requestHandler=handler,
+                                  max_batch_size=2, batch_concurrency=1)
+        client.lookup_ip('1.1.1.1')
+
+        entries = list(client.iter_lookup_ips(['1.1.1.{}'.format(i) for i in range(5)]))
+        self.assertEqual(['1.1.1.{}'.format(i) for i in range(5)], [entry.ip for entry in entries])
+        self.assertEqual(4, handler.calls)
+
+    def test_batch_executor_reused_and_shut_down_on_close(self):
+        """
+        Test that chunked batches reuse one executor owned by the client,
+        which is shut down by close
+        """
+        threads = set()
+
+        class ThreadRecordingHandler(CountingRequestHandler):
+            def batch_lookup_ips(self, ips, options):
+                threads.add(threading.current_thread().name)
+                return super().batch_lookup_ips(ips, options)
+
+        client = IpregistryClient("tryout", requestHandler=ThreadRecordingHandler(), max_batch_size=1,
+                                  batch_concurrency=2, max_workers=2)
+        client.batch_lookup_ips(['1.1.1.1', '1.1.1.2'])
+        executor = client._executor
+        client.batch_lookup_ips(['1.1.1.3', '1.1.1.4'])
+
+        self.assertIs(executor, client._executor)
+        self.assertTrue(all(name.startswith('ipregistry') for name in threads))
+        client.close()
+        self.assertIsNone(client._executor)
+        with self.assertRaises(RuntimeError):
+            executor.submit(print)
+
+    def test_executor_not_recreated_after_close(self):
+        """
+        Test that chunked batches fail and background refreshes are skipped once the client is closed
+        """
+        cache = InMemoryCache(ttl=0.01, stale_ttl=10)
+        client = IpregistryClient("tryout", cache=cache, requestHandler=CountingRequestHandler(), max_batch_size=1)
+        client.lookup_ip('8.8.8.8')
+        client.close()
+        time.sleep(0.02)
+
+        self.assertEqual('8.8.8.8', client.lookup_ip('8.8.8.8').data.ip)
+        with self.assertRaises(ClientError):
+            client.batch_lookup_ips(['1.1.1.1', '1.1.1.2'])
+        self.assertIsNone(client._executor)
+        self.assertEqual(0, len(client._in_flight._futures))
+
+    def test_batch_custom_executor_not_shut_down(self):
+        """
+        Test that a given executor is used for chunks and left running by close
+        """
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix='custom') as executor:
+            client = IpregistryClient("tryout", requestHandler=CountingRequestHandler(), max_batch_size=1,
+                                      executor=executor)
+            response = client.batch_lookup_ips(['1.1.1.1', '1.1.1.2'])
+            client.close()
+            self.assertEqual(['1.1.1.1', '1.1.1.2'], [info.ip for info in response.data])
+            self.assertEqual(1, executor.submit(lambda: 1).result())
+
+        with self.assertRaises(ValueError):
+            IpregistryClient("tryout", executor=object())
+
+    def test_batch_chunks_capped_across_callers(self):
+        """
+        Test that max_workers caps chunk requests in flight across concurrent batch calls
+        """
+        lock = threading.Lock()
+        in_flight = [0, 0]
+
+        class SlowHandler(CountingRequestHandler):
+            def batch_lookup_ips(self, ips, options):
+                with lock:
+                    in_flight[0] += 1
+                    in_flight[1] = max(in_flight[1], in_flight[0])
+                time.sleep(0.02)
+                with lock:
+                    in_flight[0] -= 1
+                return super().batch_lookup_ips(ips, options)
+
+        client = IpregistryClient("tryout", requestHandler=SlowHandler(), max_batch_size=1,
+                                  batch_concurrency=4, max_workers=2)
+        batches = iter([['1.1.{}.{}'.format(i, j) for j in range(3)] for i in range(3)])
+        threads, results = run_in_threads(3, lambda: client.batch_lookup_ips(next(batches)))
+        for thread in threads:
+            thread.join()
+        client.close()
+
+        self.assertEqual(2, in_flight[1])
+        self.assertTrue(all(len(response.data) == 3 for response in results))
+
+    def test_fixed_batching_reported(self):
+        """
+        Test that chunked batch responses report how they were split
+        """
+        client = IpregistryClient("tryout", requestHandler=CountingRequestHandler(), max_batch_size=4,
+                                  batch_concurrency=2)
+        batching = client.batch_lookup_ips(['1.1.1.{}'.format(i) for i in range(10)]).batching
+        self.assertEqual((4, 2, 3), (batching.chunk_size, batching.concurrency, batching.chunks))
+
+    def test_adaptive_batching_reacts_to_throttling_and_errors(self):
+        """
+        Test that adaptive batching halves concurrency on 429 errors and chunk size on
+        other failures, and that responses report the values chosen
+        """
+        class FlakyHandler(CountingRequestHandler):
+            errors = []
+
+            def batch_lookup_ips(self, ips, options):
+                if self.errors:
+                    raise self.errors.pop()
+                return super().batch_lookup_ips(ips, options)
+
+        handler = FlakyHandler()
+        client = IpregistryClient("tryout", requestHandler=handler, max_batch_size=64, batch_concurrency=4,
+                                  adaptive_batching=True)
+        ips = ['1.1.{}.{}'.format(i // 256, i % 256) for i in range(300)]
+
+        response = client.batch_lookup_ips(ips)
+        self.assertEqual(ips, [entry.ip for entry in response.data])
+        self.assertEqual(64, response.batching.chunk_size)
+        self.assertEqual(5, response.batching.chunks)
+
+        tuner = next(iter(client.batch_tuners.values()))
+        handler.errors.append(ApiError('TOO_MANY_REQUESTS', 'Slow down.', 'Wait.'))
+        with self.assertRaises(ApiError):
+            client.batch_lookup_ips(ips[:10])
+        self.assertEqual((64, 2), tuner.settings())
+
+        handler.errors.append(ClientError('timeout'))
+        with self.assertRaises(ClientError):
+            client.batch_lookup_ips(ips[:10])
+        self.assertEqual((32, 2), tuner.settings())
+
+        response = client.batch_lookup_ips(ips[100:])
+        self.assertEqual(ips[100:], [entry.ip for entry in response.data])
+        self.assertLessEqual(response.batching.concurrency, 3)
+        self.assertEqual((1, 1), (tuner.throttled, tuner.errors))
+        client.close()
+
+    def test_adaptive_batching_tunes_per_payload(self):
+        """
+        Test that batches with different options are tuned independently
+        """
+        client = IpregistryClient("tryout", requestHandler=CountingRequestHandler(), adaptive_batching=True)
+        client.batch_lookup_ips(['8.8.8.8'])
+        client.batch_lookup_ips(['8.8.8.8'], fields='location')
+        self.assertEqual(2, len(client.batch_tuners))
+
     def test_batch_response_length_mismatch_raises_client_error(self):
         """
         Test that a batch response with fewer results than requested items
@@ -191,7 +773,14 @@ class TestIpregistryClient(unittest.TestCase):
         Test that cache key building handles boolean and non-string option values
         """
         build_cache_key = IpregistryClient._IpregistryClient__build_cache_key
-        self.assertEqual('8.8.8.8;hostname=true;n=5', build_cache_key('8.8.8.8', {'hostname': True, 'n': 5}))
+        self.assertEqual(b'4\x08\x08\x08\x08\x00hostname=true;n=5',
+                         build_cache_key('ip', '8.8.8.8', {'hostname': True, 'n': 5}))
+        self.assertNotEqual(build_cache_key('ip', '8.8.8.8', {'hostname': True}),
+                            build_cache_key('ip', '8.8.8.8', {'hostname': False}))
+        # True and 1 are equal and hash alike, but are sent as different query values.
+        for first, second in ((True, 1), (0, False)):
+            self.assertNotEqual(build_cache_key('ip', '8.8.8.8', {'hostname': first}),
+                                build_cache_key('ip', '8.8.8.8', {'hostname': second}))
 
     def test_build_cache_key_deterministic(self):
         """
@@ -200,10 +789,127 @@ class TestIpregistryClient(unittest.TestCase):
         """
         build_cache_key = IpregistryClient._IpregistryClient__build_cache_key
         self.assertEqual(
-            build_cache_key('8.8.8.8', {'hostname': True, 'fields': 'location'}),
-            build_cache_key('8.8.8.8', {'fields': 'location', 'hostname': True})
+            build_cache_key('ip', '8.8.8.8', {'hostname': True, 'fields': 'location'}),
+            build_cache_key('ip', '8.8.8.8', {'fields': 'location', 'hostname': True})
         )
 
+    def test_build_cache_key_canonical(self):
+        """
+        Test that equivalent IPs, ASNs and fields selections share the same cache key
+        """
+        build_cache_key = IpregistryClient._IpregistryClient__build_cache_key
+        self.assertEqual(build_cache_key('ip', '2001:DB8::1', {}), build_cache_key('ip', '2001:db8:0::1', {}))
+        self.assertEqual(17, len(build_cache_key('ip', '2001:db8::1', {})))
+        self.assertEqual(build_cache_key('asn', 15169, {}), build_cache_key('asn', 'AS15169', {}))
+        self.assertEqual(build_cache_key('ip', '8.8.8.8', {'fields': 'location,ip'}),
+                         build_cache_key('ip', '8.8.8.8', {'fields': 'ip, location,ip'}))
+        self.assertNotEqual(build_cache_key('ip', 'garbage', {}), build_cache_key('user_agent', 'garbage', {}))
+
+    def test_asn_lookups_share_cache_entries(self):
+        """
+        Test that single and batch ASN lookups of the same ASN share their cache entry
+        """
+        handler = CountingRequestHandler()
+        client = IpregistryClient("tryout", cache=InMemoryCache(), requestHandler=handler)
+        client.batch_lookup_asns([15169])
+        self.assertEqual(15169, client.lookup_asn('15169').data.asn)
+        self.assertEqual(15169, client.lookup_asn(15169).data.asn)
+        self.assertEqual(1, handler.calls)
+
+
+    def test_field_subsets_projected_from_cached_entries(self):
+        """
+        Test that lookups selecting a subset of the fields or options of a cached entry are answered from it
+        """
+        requested = []
+
+        class FullHandler(CountingRequestHandler):
+            def batch_lookup_ips(self, ips, options):
+                requested.append(dict(options))
+                response = super().batch_lookup_ips(ips, options)
+                response.data = [IpInfo.model_validate({
+                    'ip': ip, 'hostname': 'dns.google', 'security': {'is_vpn': False},
+                    'location': {'city': 'Mountain View', 'country': {'code': 'US', 'name': 'United States'}}})
+                    for ip in ips]
+                return response
+
+            def lookup_ip(self, ip, options):
+                requested.append(dict(options))
+                return super().lookup_ip(ip, options)
+
+        client = IpregistryClient("tryout", cache=InMemoryCache(), requestHandler=FullHandler())
+        client.batch_lookup_ips(['8.8.8.8', '8.8.4.4'], hostname=True)
+
+        info = client.lookup_ip('8.8.8.8', fields='security').data
+        self.assertEqual(IpInfo.model_validate({'security': {'is_vpn': False}}), info)
+
+        info = client.batch_lookup_ips(['8.8.4.4'], fields='location.country.code,ip').data[0]
+        self.assertEqual('8.8.4.4', info.ip)
+        self.assertEqual('US', info.location.country.code)
+        self.assertIsNone(info.location.country.name)
+        self.assertIsNone(info.location.city)
+        self.assertIsNone(info.security)
+
+        info = client.lookup_ip('8.8.4.4').data
+        self.assertIsNone(info.hostname)
+        self.assertEqual('Mountain View', info.location.city)
+
+        self.assertEqual([{'hostname': True}], requested)
+        self.assertEqual(3, client.statistics.projected)
+
+        # Entries cached with a field selection cover its subsets only.
+        client.batch_lookup_ips(['1.1.1.1'], fields='location')
+        self.assertEqual('US', client.lookup_ip('1.1.1.1', fields='location.country').data.location.country.code)
+        client.lookup_ip('1.1.1.1', fields='security')
+        client.lookup_ip('1.1.1.1', fields='location', hostname=True)
+        self.assertEqual(4, client.statistics.projected)
+        self.assertEqual(4, len(requested))
+
+
+    def test_time_zone_recomputed_on_cache_hits(self):
+        """
+        Test that cached IP entries are served with the current time of their time zone
+        """
+        frozen = {'id': 'America/Los_Angeles', 'abbreviation': 'PDT', 'current_time': '2026-07-09T10:00:00-07:00',
+                  'name': 'Pacific Daylight Time', 'offset': -25200, 'in_daylight_saving': True}
+
+        class TimeZoneHandler(CountingRequestHandler):
+            def batch_lookup_ips(self, ips, options):
+                response = super().batch_lookup_ips(ips, options)
+                response.data = [IpInfo.model_validate({'ip': ip, 'time_zone': frozen}) for ip in ips]
+                return response
+
+        cache = InMemoryCache()
+        client = IpregistryClient("tryout", cache=cache, requestHandler=TimeZoneHandler())
+        self.assertEqual(frozen['current_time'], client.batch_lookup_ips(['8.8.8.8']).data[0].time_zone.current_time)
+        for time_zone in (client.batch_lookup_ips(['8.8.8.8']).data[0].time_zone,
+                          client.lookup_ip('8.8.8.8').data.time_zone):
+            self.assertNotEqual(frozen['current_time'], time_zone.current_time)
+            self.assertEqual(time_zone.offset, datetime.datetime.fromisoformat(
+                time_zone.current_time).utcoffset().total_seconds())
+        cached = cache.get(_build_cache_key('ip', '8.8.8.8', {}))
+        self.assertEqual(frozen['current_time'], cached.time_zone.current_time)
+
+    def test_with_current_time(self):
+        """
+        Test that time zone clocks are computed from the zone id, or from the offset for unknown zones
+        """
+        winter = datetime.datetime(2026, 1, 15, 12, 30, 45, 123, tzinfo=datetime.timezone.utc)
+        info = IpInfo.model_validate({'time_zone': {
+            'id': 'America/Los_Angeles', 'abbreviation': 'PDT', 'current_time': '2026-07-09T10:00:00-07:00',
+            'offset': -25200, 'in_daylight_saving': True}})
+        time_zone = _with_current_time(info, winter).time_zone
+        self.assertEqual(('2026-01-15T04:30:45-08:00', -28800, False, 'PST'), (
+            time_zone.current_time, time_zone.offset, time_zone.in_daylight_saving, time_zone.abbreviation))
+
+        unknown = info.model_copy(update={'time_zone': info.time_zone.model_copy(update={'id': 'Nowhere/Unknown'})})
+        time_zone = _with_current_time(unknown, winter).time_zone
+        self.assertEqual(('2026-01-15T05:30:45-07:00', -25200, True), (
+            time_zone.current_time, time_zone.offset, time_zone.in_daylight_saving))
+        self.assertEqual('2026-07-09T10:00:00-07:00', info.time_zone.current_time)
+        no_time_zone = IpInfo(ip='8.8.8.8')
+        self.assertIs(no_time_zone, _with_current_time(no_time_zone, winter))
+
 
 @unittest.skipUnless(os.getenv('IPREGISTRY_API_KEY'), "IPREGISTRY_API_KEY is not set")
 class TestIpregistryClientLive(unittest.TestCase):
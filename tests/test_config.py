@@ -34,6 +34,8 @@ class TestIpregistryConfig(unittest.TestCase):
         self.assertTrue(request_handler._config.retry_on_server_error)
         self.assertFalse(request_handler._config.retry_on_too_many_requests)
         self.assertIsNone(request_handler._config.user_agent)
+        self.assertIsNone(request_handler._config.max_concurrent_requests)
+        self.assertIsNone(request_handler.concurrency_limiter.limit)
 
     def test_config_optional_parameters(self):
         """
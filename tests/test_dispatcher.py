@@ -0,0 +1,320 @@
+"""
+    Copyright 2019 Ipregistry (https://ipregistry.co).
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       https://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import asyncio
+import json
+import threading
+import time
+import unittest
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from ipregistry import AsyncIpregistryClient, IpInfo, IpregistryClient, IpregistryConfig
+from ipregistry.dispatcher import AsyncBatchDispatcher, BatchDispatcher
+from ipregistry.model import ApiResponse, ApiResponseCredits, ApiResponseThrottling, ClientError, \
+    IpregistryLookupError
+from ipregistry.request import IpregistryRequestHandler
+
+
+class BatchRecordingRequestHandler(IpregistryRequestHandler):
+    """Offline request handler stub recording batch calls."""
+
+    def __init__(self):
+        super().__init__(IpregistryConfig("tryout"))
+        self.batches = []
+
+    def batch_lookup_asns(self, asns, options):
+        raise NotImplementedError
+
+    def batch_lookup_ips(self, ips, options):
+        self.batches.append((list(ips), dict(options)))
+        return ApiResponse(
+            ApiResponseCredits(len(ips), 100),
+            [IpregistryLookupError({'code': 'INVALID_IP_ADDRESS', 'message': 'Invalid IP.'}) if ip == 'invalid'
+             else IpInfo(ip=ip) for ip in ips],
+            ApiResponseThrottling())
+
+    def batch_parse_user_agents(self, user_agents, options):
+        raise NotImplementedError
+
+    def lookup_asn(self, asn, options):
+        raise NotImplementedError
+
+    def lookup_ip(self, ip, options):
+        raise NotImplementedError
+
+    def origin_lookup_ip(self, options):
+        raise NotImplementedError
+
+    def origin_parse_user_agent(self, options):
+        raise NotImplementedError
+
+
+class BlockingBatchRequestHandler(BatchRecordingRequestHandler):
+    """Request handler stub whose batches including a blocked IP wait until released."""
+
+    def __init__(self, blocked_ip):
+        super().__init__()
+        self.blocked_ip = blocked_ip
+        self.release = threading.Event()
+
+    def batch_lookup_ips(self, ips, options):
+        if self.blocked_ip in ips:
+            self.release.wait(5)
+        return super().batch_lookup_ips(ips, options)
+
+
+class FailingSlots:
+    """Batch slots stub failing when acquired, breaking the dispatcher's collector."""
+
+    def acquire(self):
+        raise RuntimeError("Broken collector.")
+
+    def release(self):
+        pass
+
+
+class TestBatchDispatcher(unittest.TestCase):
+    def test_lookups_within_window_are_batched(self):
+        """
+        Test that lookups submitted within the delay window are sent as one batch
+        and each caller gets its own entry
+        """
+        handler = BatchRecordingRequestHandler()
+        client = IpregistryClient("tryout", requestHandler=handler)
+
+        with BatchDispatcher(client, max_delay=0.05) as dispatcher:
+            futures = [dispatcher.submit('1.1.1.{}'.format(i)) for i in range(5)]
+            responses = [future.result() for future in futures]
+
+        self.assertEqual([(['1.1.1.{}'.format(i) for i in range(5)], {})], handler.batches)
+        self.assertEqual(['1.1.1.{}'.format(i) for i in range(5)], [response.data.ip for response in responses])
+        self.assertEqual(100, responses[0].credits.remaining)
+
+    def test_max_items_and_options_split_batches(self):
+        """
+        Test that batches are capped at max_items and never mix lookup options
+        """
+        handler = BatchRecordingRequestHandler()
+        client = IpregistryClient("tryout", requestHandler=handler)
+
+        with BatchDispatcher(client, max_delay=0.05, max_items=2) as dispatcher:
+            futures = [dispatcher.submit('1.1.1.1'), dispatcher.submit('1.1.1.2', hostname=True),
+                       dispatcher.submit('1.1.1.3')]
+            for future in futures:
+                future.result()
+
+        # Batches are sent concurrently, in any order.
+        self.assertCountEqual([(['1.1.1.1'], {}), (['1.1.1.2'], {'hostname': True}), (['1.1.1.3'], {})],
+                              handler.batches)
+
+        # True and 1 are equal but sent as different query values.
+        handler.batches.clear()
+        with BatchDispatcher(client, max_delay=0.05) as dispatcher:
+            for future in [dispatcher.submit('1.1.1.1', hostname=True), dispatcher.submit('1.1.1.2', hostname=1)]:
+                future.result()
+        self.assertCountEqual([(['1.1.1.1'], (bool, True)), (['1.1.1.2'], (int, 1))],
+                              [(ips, (type(options['hostname']), options['hostname']))
+                               for ips, options in handler.batches])
+
+    def test_lookup_error_raised_to_caller(self):
+        """
+        Test that a failed entry raises its IpregistryLookupError to its caller only
+        """
+        handler = BatchRecordingRequestHandler()
+        client = IpregistryClient("tryout", requestHandler=handler)
+
+        with BatchDispatcher(client, max_delay=0.05) as dispatcher:
+            valid = dispatcher.submit('8.8.8.8')
+            with self.assertRaises(IpregistryLookupError) as context:
+                dispatcher.lookup_ip('invalid')
+            self.assertEqual('INVALID_IP_ADDRESS', context.exception.code)
+            self.assertEqual('8.8.8.8', valid.result().data.ip)
+
+    def test_full_queue_sheds_load(self):
+        """
+        Test that lookups beyond max_queue_size are rejected with a ClientError
+        """
+        handler = BatchRecordingRequestHandler()
+        client = IpregistryClient("tryout", requestHandler=handler)
+
+        with BatchDispatcher(client, max_delay=0.2, max_queue_size=2) as dispatcher:
+            dispatcher.submit('1.1.1.1')
+            dispatcher.submit('1.1.1.2')
+            with self.assertRaises(ClientError):
+                dispatcher.submit('1.1.1.3')
+
+        self.assertEqual([(['1.1.1.1', '1.1.1.2'], {})], handler.batches)
+
+    def test_batches_sent_while_previous_ones_are_in_flight(self):
+        """
+        Test that lookups arriving while a batch is in flight are sent without waiting for it
+        """
+        handler = BlockingBatchRequestHandler('1.1.1.1')
+        client = IpregistryClient("tryout", requestHandler=handler)
+
+        with BatchDispatcher(client, max_delay=0.01) as dispatcher:
+            blocked = dispatcher.submit('1.1.1.1')
+            time.sleep(0.05)
+            self.assertEqual('8.8.8.8', dispatcher.submit('8.8.8.8').result(timeout=2).data.ip)
+            self.assertFalse(blocked.done())
+            handler.release.set()
+            self.assertEqual('1.1.1.1', blocked.result(timeout=2).data.ip)
+
+    def test_unhashable_options_rejected_on_submit(self):
+        """
+        Test that options which cannot be grouped are rejected with a ValueError by submit
+        """
+        handler = BatchRecordingRequestHandler()
+        client = IpregistryClient("tryout", requestHandler=handler)
+
+        with BatchDispatcher(client, max_delay=0.01) as dispatcher:
+            with self.assertRaises(ValueError):
+                dispatcher.submit('1.1.1.1', fields=['location'])
+            self.assertEqual('8.8.8.8', dispatcher.submit('8.8.8.8').result(timeout=2).data.ip)
+
+    def test_collector_failure_resolves_lookups(self):
+        """
+        Test that a failing collector fails the lookups it took and the queued ones, and later lookups restart it
+        """
+        handler = BatchRecordingRequestHandler()
+        client = IpregistryClient("tryout", requestHandler=handler)
+
+        with BatchDispatcher(client, max_delay=0.05) as dispatcher:
+            slots, dispatcher._slots = dispatcher._slots, FailingSlots()
+            futures = [dispatcher.submit('1.1.1.1'), dispatcher.submit('1.1.1.2', hostname=True)]
+            for future in futures:
+                with self.assertRaises(RuntimeError):
+                    future.result(timeout=2)
+
+            dispatcher._slots = slots
+            self.assertEqual('8.8.8.8', dispatcher.submit('8.8.8.8').result(timeout=2).data.ip)
+        self.assertEqual([(['8.8.8.8'], {})], handler.batches)
+
+    def test_invalid_settings(self):
+        """
+        Test that invalid dispatcher settings are rejected
+        """
+        client = IpregistryClient("tryout", requestHandler=BatchRecordingRequestHandler())
+        with self.assertRaises(ValueError):
+            BatchDispatcher(client, max_items=2048)
+        with self.assertRaises(ValueError):
+            BatchDispatcher(client, max_queue_size=0)
+        with self.assertRaises(ValueError):
+            BatchDispatcher(client, max_concurrent_batches=0)
+
+
+@unittest.skipIf(httpx is None, "httpx is not installed")
+class TestAsyncBatchDispatcher(unittest.IsolatedAsyncioTestCase):
+    async def test_lookups_within_window_are_batched(self):
+        """
+        Test that concurrent async lookups are sent as one batch request
+        """
+        requests = []
+
+        def responder(request):
+            ips = json.loads(request.content)
+            requests.append(ips)
+            return httpx.Response(200, json={'results': [
+                {'code': 'INVALID_IP_ADDRESS', 'message': 'Invalid IP.'} if ip == 'invalid' else {'ip': ip}
+                for ip in ips]})
+
+        http_client = httpx.AsyncClient(transport=httpx.MockTransport(responder))
+        async with AsyncIpregistryClient(IpregistryConfig("tryout"), client=http_client) as client:
+            async with AsyncBatchDispatcher(client, max_delay=0.05) as dispatcher:
+                responses = await asyncio.gather(
+                    dispatcher.lookup_ip('1.1.1.1'),
+                    dispatcher.lookup_ip('invalid'),
+                    dispatcher.lookup_ip('8.8.8.8'),
+                    return_exceptions=True)
+
+        self.assertEqual([['1.1.1.1', 'invalid', '8.8.8.8']], requests)
+        self.assertEqual('1.1.1.1', responses[0].data.ip)
+        self.assertIsInstance(responses[1], IpregistryLookupError)
+        self.assertEqual('8.8.8.8', responses[2].data.ip)
+
+    async def test_full_queue_sheds_load(self):
+        """
+        Test that async lookups beyond max_queue_size are rejected with a ClientError
+        """
+        def responder(request):
+            ips = json.loads(request.content)
+            return httpx.Response(200, json={'results': [{'ip': ip} for ip in ips]})
+
+        http_client = httpx.AsyncClient(transport=httpx.MockTransport(responder))
+        async with AsyncIpregistryClient(IpregistryConfig("tryout"), client=http_client) as client:
+            async with AsyncBatchDispatcher(client, max_delay=0.05, max_queue_size=1) as dispatcher:
+                future = dispatcher.submit('1.1.1.1')
+                with self.assertRaises(ClientError):
+                    dispatcher.submit('1.1.1.2')
+                self.assertEqual('1.1.1.1', (await future).data.ip)
+
+    async def test_failed_dispatches_resolve_lookups(self):
+        """
+        Test that a cancelled batch or dispatching task resolves its lookups and later lookups are still dispatched
+        """
+        class CancelledClient:
+            def __init__(self):
+                self.calls = 0
+
+            async def batch_lookup_ips(self, ips, **options):
+                self.calls += 1
+                if self.calls == 1:
+                    raise asyncio.CancelledError()
+                return ApiResponse(ApiResponseCredits(), [IpInfo(ip=ip) for ip in ips], ApiResponseThrottling())
+
+        async with AsyncBatchDispatcher(CancelledClient(), max_delay=0.01) as dispatcher:
+            with self.assertRaises(asyncio.CancelledError):
+                await asyncio.wait_for(dispatcher.submit('1.1.1.1'), 1)
+            self.assertEqual('8.8.8.8', (await asyncio.wait_for(dispatcher.lookup_ip('8.8.8.8'), 1)).data.ip)
+
+            queued = dispatcher.submit('1.1.1.1')
+            dispatcher._task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await asyncio.wait_for(queued, 1)
+            self.assertEqual('9.9.9.9', (await asyncio.wait_for(dispatcher.lookup_ip('9.9.9.9'), 1)).data.ip)
+
+    async def test_collector_failure_resolves_collected_lookups(self):
+        """
+        Test that a failing collector fails the lookups it already took from the queue
+        """
+        class RecordingClient:
+            def __init__(self):
+                self.batches = []
+
+            async def batch_lookup_ips(self, ips, **options):
+                self.batches.append(list(ips))
+                return ApiResponse(ApiResponseCredits(), [IpInfo(ip=ip) for ip in ips], ApiResponseThrottling())
+
+        client = RecordingClient()
+        async with AsyncBatchDispatcher(client, max_delay=0.05) as dispatcher:
+            with self.assertRaises(ValueError):
+                dispatcher.submit('1.1.1.1', fields=['location'])
+
+            futures = [dispatcher.submit('1.1.1.1'), dispatcher.submit('1.1.1.2', hostname=True)]
+            dispatcher._slots = FailingSlots()
+            for future in futures:
+                with self.assertRaises(RuntimeError):
+                    await asyncio.wait_for(future, 1)
+            self.assertEqual('8.8.8.8', (await asyncio.wait_for(dispatcher.lookup_ip('8.8.8.8'), 1)).data.ip)
+        self.assertEqual([['8.8.8.8']], client.batches)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+"""
+    Copyright 2019 Ipregistry (https://ipregistry.co).
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       https://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import asyncio
+import threading
+import time
+import unittest
+
+from ipregistry.limits import (AdaptiveBatchTuner, AsyncConcurrencyLimiter, AsyncRateLimiter, ConcurrencyLimiter,
+                               RateLimiter)
+from ipregistry.model import ApiError, ApiResponseThrottling
+
+
+class TestConcurrencyLimiter(unittest.TestCase):
+    def test_limit_is_enforced(self):
+        """
+        Test that no more than limit holders are admitted at once and waits are recorded
+        """
+        limiter = ConcurrencyLimiter(2)
+
+        def hold():
+            with limiter:
+                time.sleep(0.02)
+
+        threads = [threading.Thread(target=hold) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(2, limiter.peak_in_use)
+        self.assertEqual(0, limiter.in_use)
+        self.assertEqual(6, limiter.acquisitions)
+        self.assertGreater(limiter.total_wait_time, 0)
+        self.assertGreater(limiter.average_wait_time, 0)
+
+    def test_unlimited_tracks_occupancy(self):
+        """
+        Test that a limiter without limit never blocks but tracks occupancy
+        """
+        limiter = ConcurrencyLimiter()
+        limiter.acquire()
+        limiter.acquire()
+        self.assertEqual(2, limiter.in_use)
+        limiter.release()
+        limiter.release()
+        self.assertEqual(2, limiter.peak_in_use)
+        self.assertIn('peak_in_use=2', str(limiter))
+
+    def test_invalid_limit(self):
+        """
+        Test that a limit lower than 1 is rejected
+        """
+        with self.assertRaises(ValueError):
+            ConcurrencyLimiter(0)
+
+
+class TestAsyncConcurrencyLimiter(unittest.IsolatedAsyncioTestCase):
+    async def test_limit_is_enforced(self):
+        """
+        Test that no more than limit tasks are admitted at once
+        """
+        limiter = AsyncConcurrencyLimiter(2)
+
+        async def hold():
+            async with limiter:
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*[hold() for _ in range(6)])
+
+        self.assertEqual(2, limiter.peak_in_use)
+        self.assertEqual(0, limiter.in_use)
+        self.assertEqual(6, limiter.acquisitions)
+        self.assertGreater(limiter.total_wait_time, 0)
+
+    async def test_cancelled_waiter_does_not_leak_slot(self):
+        """
+        Test that a waiting task cancelled before getting a slot leaves the limiter consistent
+        """
+        limiter = AsyncConcurrencyLimiter(1)
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        self.assertEqual(1, limiter.waiting)
+        waiter.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+        limiter.release()
+
+        self.assertEqual(0, limiter.in_use)
+        self.assertEqual(0, limiter.waiting)
+        await asyncio.wait_for(limiter.acquire(), 1)
+        self.assertEqual(1, limiter.in_use)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_not_paced_before_calibration(self):
+        """
+        Test that requests are not delayed until rate limit headers have been seen
+        """
+        limiter = RateLimiter()
+        limiter.update(ApiResponseThrottling())
+        for _ in range(100):
+            self.assertEqual(0, limiter._reserve())
+        self.assertIsNone(limiter.rate)
+
+    def test_remaining_spread_until_reset(self):
+        """
+        Test that the remaining requests are spread evenly until the limit resets
+        """
+        limiter = RateLimiter()
+        limiter.update(ApiResponseThrottling(limit=100, remaining=20, reset=10))
+        self.assertEqual(2, limiter.rate)
+
+        delays = [limiter._reserve() for _ in range(4)]
+        self.assertEqual([0, 0], delays[:2])
+        self.assertAlmostEqual(0.5, delays[2], places=2)
+        self.assertAlmostEqual(1.0, delays[3], places=2)
+        self.assertEqual(2, limiter.delayed)
+
+    def test_exhausted_waits_for_reset(self):
+        """
+        Test that no request is sent before the reset once the limit is exhausted
+        """
+        limiter = RateLimiter()
+        limiter.update(ApiResponseThrottling(limit=10, remaining=0, reset=5))
+        self.assertGreaterEqual(limiter._reserve(), 5)
+
+    def test_repeated_exhausted_responses_owe_one_window(self):
+        """
+        Test that concurrent responses reporting the same exhausted window delay requests until its reset only
+        """
+        limiter = RateLimiter()
+        for _ in range(8):
+            limiter.update(ApiResponseThrottling(limit=100, remaining=0, reset=10))
+        delay = limiter._reserve()
+        self.assertGreaterEqual(delay, 10)
+        self.assertLess(delay, 11)
+
+    def test_acquire_sleeps(self):
+        """
+        Test that acquire blocks for the reserved delay
+        """
+        limiter = RateLimiter()
+        limiter.update(ApiResponseThrottling(limit=100, remaining=50, reset=1))
+        start = time.monotonic()
+        for _ in range(52):
+            limiter.acquire()
+        self.assertGreater(time.monotonic() - start, 0.03)
+
+
+class TestAsyncRateLimiter(unittest.IsolatedAsyncioTestCase):
+    async def test_acquire_sleeps(self):
+        """
+        Test that async acquire waits for the reserved delay without blocking the loop
+        """
+        limiter = AsyncRateLimiter()
+        limiter.update(ApiResponseThrottling(limit=100, remaining=50, reset=1))
+        start = time.monotonic()
+        await asyncio.gather(*[limiter.acquire() for _ in range(52)])
+        self.assertGreater(time.monotonic() - start, 0.03)
+        self.assertEqual(2, limiter.delayed)
+
+
+class TestAdaptiveBatchTuner(unittest.TestCase):
+    def test_additive_increase(self):
+        """
+        Test that fast chunks grow the chunk size by min_chunk_size and the concurrency
+        by one per round, without exceeding the maximums
+        """
+        tuner = AdaptiveBatchTuner(1024, 4, min_chunk_size=64)
+        tuner.chunk_size, tuner.concurrency = 512, 2
+        tuner.record(0.1)
+        self.assertEqual((576, 2), tuner.settings())
+        tuner.record(0.1)
+        self.assertEqual((640, 3), tuner.settings())
+        for _ in range(20):
+            tuner.record(0.1)
+        self.assertEqual((1024, 4), tuner.settings())
+
+    def test_multiplicative_decrease(self):
+        """
+        Test that throttled chunks halve the concurrency and failed or slow chunks the chunk size
+        """
+        tuner = AdaptiveBatchTuner(1024, 8, min_chunk_size=100, target_latency=1)
+        tuner.record(0.1, ApiError('TOO_MANY_REQUESTS', 'Slow down.', 'Wait.'))
+        self.assertEqual((1024, 4), tuner.settings())
+        tuner.record(0.1, ApiError('INTERNAL', 'Oops.', 'Retry.'))
+        self.assertEqual((512, 4), tuner.settings())
+        tuner.record(5)
+        tuner.record(5)
+        tuner.record(5)
+        self.assertEqual((100, 4), tuner.settings())
+        self.assertEqual((5, 1, 1), (tuner.chunks, tuner.throttled, tuner.errors))
+        self.assertAlmostEqual(3.04, tuner.average_latency)
+
+
+if __name__ == '__main__':
+    unittest.main()
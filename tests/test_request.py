@@ -14,12 +14,14 @@
     limitations under the License.
 """
 
+import threading
+import time
 import unittest
 
 import requests
 import requests_mock
 
-from ipregistry.core import IpregistryConfig
+from ipregistry.core import IpregistryClient, IpregistryConfig
 from ipregistry.model import ApiError, ClientError
 from ipregistry.request import DefaultRequestHandler
 
@@ -72,6 +74,18 @@ class TestIpregistryRequestHandler(unittest.TestCase):
         handler.batch_parse_user_agents(['Mozilla/5.0'], {'fields': 'name'})
         self.assertEqual(['results.name'], adapter.last_request.qs['fields'])
 
+    def test_batch_asns_sent_once_per_number(self):
+        """
+        Test that ASNs sharing a cache key, with or without the AS prefix, are sent as a single AS-prefixed item
+        """
+        handler, adapter = build_mocked_handler()
+        adapter.register_uri('POST', 'https://api.ipregistry.co/',
+                             json={'results': [{'asn': 15169}, {'asn': 13335}]})
+        client = IpregistryClient("tryout", requestHandler=handler)
+        response = client.batch_lookup_asns(['AS15169', 15169, 'as13335', '13335'])
+        self.assertEqual(['AS15169', 'AS13335'], adapter.last_request.json())
+        self.assertEqual([15169, 15169, 13335, 13335], [entry.asn for entry in response.data])
+
     def test_single_lookup_fields_are_not_prefixed(self):
         """
         Test that single lookups keep the fields selection unchanged
@@ -230,6 +244,62 @@ class TestIpregistryRequestHandler(unittest.TestCase):
             handler.lookup_ip('8.8.8.8', {})
         self.assertEqual(2, adapter.call_count)
 
+    def test_concurrency_limited_across_request_paths(self):
+        """
+        Test that single lookups and batch requests share the handler concurrency limit
+        """
+        handler, adapter = build_mocked_handler(max_concurrent_requests=1)
+
+        def slow_json(ip_info):
+            def callback(request, context):
+                time.sleep(0.02)
+                return ip_info
+            return callback
+
+        adapter.register_uri('GET', 'https://api.ipregistry.co/8.8.8.8', json=slow_json({'ip': '8.8.8.8'}))
+        adapter.register_uri('POST', 'https://api.ipregistry.co/', json=slow_json({'results': [{'ip': '1.1.1.1'}]}))
+        adapter.register_uri('GET', 'https://api.ipregistry.co/', json=slow_json({'ip': '4.4.4.4'}))
+
+        threads = [threading.Thread(target=handler.lookup_ip, args=('8.8.8.8', {})),
+                   threading.Thread(target=handler.batch_lookup_ips, args=(['1.1.1.1'], {})),
+                   threading.Thread(target=handler.origin_lookup_ip, args=({},))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        limiter = handler.concurrency_limiter
+        self.assertEqual(1, limiter.peak_in_use)
+        self.assertEqual(3, limiter.acquisitions)
+        self.assertGreater(limiter.total_wait_time, 0)
+
+    def test_adaptive_rate_limit_calibrated_from_headers(self):
+        """
+        Test that the adaptive rate limiter is recalibrated from every response, including 429s
+        """
+        handler, adapter = build_mocked_handler(adaptive_rate_limit=True, retry_max_attempts=1)
+        adapter.register_uri('GET', 'https://api.ipregistry.co/8.8.8.8', [
+            {'status_code': 200, 'json': {'ip': '8.8.8.8'},
+             'headers': {'x-rate-limit-limit': '100', 'x-rate-limit-remaining': '40', 'x-rate-limit-reset': '20'}},
+            {'status_code': 429, 'json': {'code': 'TOO_MANY_REQUESTS', 'message': 'Slow down.', 'resolution': 'Wait.'},
+             'headers': {'x-rate-limit-limit': '100', 'x-rate-limit-remaining': '0', 'x-rate-limit-reset': '30'}},
+        ])
+
+        response = handler.lookup_ip('8.8.8.8', {})
+        self.assertEqual(40, response.throttling.remaining)
+        self.assertEqual(2, handler.rate_limiter.rate)
+
+        with self.assertRaises(ApiError):
+            handler.lookup_ip('8.8.8.8', {})
+        self.assertGreaterEqual(handler.rate_limiter._reserve(), 30)
+
+    def test_adaptive_rate_limit_disabled_by_default(self):
+        """
+        Test that requests are not paced unless adaptive rate limiting is enabled
+        """
+        handler, _ = build_mocked_handler()
+        self.assertIsNone(handler.rate_limiter)
+
     def test_origin_lookup_ip_not_double_retried(self):
         """
         Test that origin_lookup_ip does not retry on top of lookup_ip retries
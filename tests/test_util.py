@@ -16,7 +16,34 @@
 
 import unittest
 
-from ipregistry.util import UserAgents
+from ipregistry.model import ErrorCode
+from ipregistry.util import IpAddresses, UserAgents
+
+
+class TestIpAddresses(unittest.TestCase):
+    def test_classify_reserved(self):
+        """
+        Test that private, loopback, link-local, CGNAT, documentation and multicast addresses are reserved
+        """
+        for ip in ('10.1.2.3', '172.16.0.1', '192.168.255.255', '127.0.0.1', '169.254.1.1', '100.64.0.1',
+                   '192.0.2.1', '198.51.100.7', '203.0.113.9', '224.0.0.1', '255.255.255.255', '0.0.0.0',
+                   '::1', '::', 'fe80::1', 'fd00::1', '2001:db8::1', 'ff02::1', '::ffff:192.168.0.1'):
+            self.assertEqual(ErrorCode.RESERVED_IP_ADDRESS, IpAddresses.classify(ip), ip)
+
+    def test_classify_invalid(self):
+        """
+        Test that malformed addresses are invalid
+        """
+        for ip in ('', 'garbage', '1.2.3', '256.1.1.1', '1.1.1.1 ', '2001:db8::g', None):
+            self.assertEqual(ErrorCode.INVALID_IP_ADDRESS, IpAddresses.classify(ip), ip)
+
+    def test_classify_public(self):
+        """
+        Test that public addresses, including ones next to reserved ranges, must be looked up
+        """
+        for ip in ('8.8.8.8', '1.1.1.1', '100.63.255.255', '100.128.0.0', '172.32.0.1', '11.0.0.0',
+                   '223.255.255.255', '2606:4700::1111', '2001:db9::1', '::ffff:8.8.8.8'):
+            self.assertIsNone(IpAddresses.classify(ip), ip)
 
 
 class TestIpregistryUserAgent(unittest.TestCase):